@@ -11,6 +11,11 @@ import os
 
 from django.core.asgi import get_asgi_application
 
+from myinfo.transport import close_on_shutdown
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
 application = get_asgi_application()
+
+# close the Myinfo HTTP client of the server's event loop when the server stops
+application = close_on_shutdown(application)
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -107,3 +108,28 @@ STATIC_URL = '/static/'
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Shared by all the workers with Redis, per process otherwise (single worker only)
+if os.environ.get("REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ["REDIS_URL"],
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+
+# Myinfo
+MYINFO_CALLBACK_URL = os.environ.get("MYINFO_CALLBACK_URL", "http://localhost:3001/callback")
+MYINFO_ASYNC_CALLBACK_URL = os.environ.get(
+    "MYINFO_ASYNC_CALLBACK_URL", "http://localhost:3001/async/callback"
+)
+# where in-flight login flows are kept: "cache" (shared by all workers) or "memory"
+MYINFO_FLOW_STATE_STORE = os.environ.get("MYINFO_FLOW_STATE_STORE", "cache")
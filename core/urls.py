@@ -1,5 +1,8 @@
 from django.urls import path, include
 
+from myinfo_users.views import MyInfoMetricsView
+
 urlpatterns = [
     path('', include('myinfo_users.urls')),
+    path('metrics', MyInfoMetricsView.as_view(), name='metrics'),
 ]
@@ -0,0 +1,15 @@
+"""
+gunicorn settings, read from the working directory: `gunicorn core.wsgi`.
+
+With `--preload` and MYINFO_WARMUP=preload, the master warms up what the workers inherit (keys,
+JWKS) and each worker warms up its own keypair pool and connections here, before taking traffic.
+"""
+
+
+def post_fork(server, worker):
+    from myinfo import settings as myinfo_settings
+
+    if myinfo_settings.MYINFO_WARMUP == "preload":
+        from myinfo.warmup import warm_up_process
+
+        warm_up_process()
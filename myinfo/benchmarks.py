@@ -0,0 +1,227 @@
+"""
+Microbenchmarks of the myinfo.security primitives, with JSON baselines to catch regressions.
+
+Payloads are produced by the emulator (see myinfo.emulator) with the client keys from
+myinfo.settings, so tokens have the same shape and size as real Myinfo responses. The
+`decrypt_jwe` cases grow the cpfcontributions/cpfemployers/noahistory histories to cover the
+large persons that dominate the callback CPU time.
+"""
+import json
+import os
+import platform
+import statistics
+import timeit
+from contextlib import contextmanager
+from importlib.metadata import version
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+from unittest.mock import patch
+
+import cryptography
+from cryptography.hazmat.backends import default_backend
+
+from myinfo import settings as myinfo_settings
+from myinfo.emulator import MyInfoEmulator, build_persona
+from myinfo.security import (
+    DPoPSigner,
+    decrypt_jwe,
+    encode_json_segment,
+    generate_client_assertion,
+    generate_code_challenge,
+    generate_dpop_header,
+    generate_ephemeral_session_keypair,
+    jwks_store,
+    sign_es256_compact,
+    verify_jws,
+)
+
+DEFAULT_BASELINE_PATH = os.path.join(".benchmarks", "myinfo_security.json")
+DEFAULT_THRESHOLD = 0.2
+
+BENCHMARK_JWKS_URL = "https://benchmark.invalid/.well-known/keys.json"
+PERSON_SUB = "de2ea8ab-0c54-4fb1-9e91-d6e0f0d1b5b6"
+PERSON_URL = f"{myinfo_settings.MYINFO_DOMAIN}/com/v4/person/{PERSON_SUB}"
+TOKEN_URL = f"{myinfo_settings.MYINFO_DOMAIN}/com/v4/token"
+
+# (history months, NOA years) of the persons decrypted by the decrypt_jwe cases
+PERSON_SIZES = {"default": (15, 2), "large": (120, 10), "huge": (360, 30)}
+
+
+class Benchmark(NamedTuple):
+    name: str
+    fn: Callable[[], object]
+    payload_bytes: int = 0
+
+
+class Regression(NamedTuple):
+    name: str
+    baseline: float
+    current: float
+
+    @property
+    def ratio(self) -> float:
+        return self.current / self.baseline
+
+
+@contextmanager
+def benchmark_environment(emulator: MyInfoEmulator):
+    """
+    Serves the emulator JWKS from the process cache, so that no benchmark touches the network.
+    """
+    jwks_store._store(BENCHMARK_JWKS_URL, json.dumps(emulator.get_jwks()), ttl=24 * 3600)
+    try:
+        with patch.multiple(
+            myinfo_settings,
+            MYINFO_JWKS_DATA_VERIFICATION_URL=BENCHMARK_JWKS_URL,
+            MYINFO_JWKS_TOKEN_VERIFICATION_URL=BENCHMARK_JWKS_URL,
+        ):
+            yield
+    finally:
+        jwks_store.clear()
+
+
+def get_benchmarks(emulator: MyInfoEmulator) -> List[Benchmark]:
+    keypair = generate_ephemeral_session_keypair()
+    dpop_signer = DPoPSigner(keypair)
+    code_verifier = "T3BDc2tiTWJwcDdkZWR2Vk5hMHJabE8zMlZNRk96UE4"
+    ath = generate_code_challenge(code_verifier)
+
+    access_token = sign_es256_compact(
+        emulator.signing_key.get_op_key("sign"),
+        encode_json_segment({"typ": "JWT", "alg": "ES256", "kid": emulator.signing_kid}),
+        {
+            "sub": PERSON_SUB,
+            "jti": "8cb5b8bcc44e4b3c9f4e8d8b7b5f4c1e",
+            "scope": myinfo_settings.MYINFO_SCOPE,
+            "client_id": myinfo_settings.MYINFO_CLIENT_ID,
+            "cnf": {"jkt": dpop_signer.thumbprint},
+            "iat": 1700000000,
+            "exp": 1700001800,
+        },
+    )
+    jwkset = jwks_store.get(BENCHMARK_JWKS_URL)
+
+    benchmarks = [
+        Benchmark("code_challenge", lambda: generate_code_challenge(code_verifier)),
+        Benchmark("ephemeral_keypair", generate_ephemeral_session_keypair),
+        Benchmark(
+            "client_assertion",
+            lambda: generate_client_assertion(TOKEN_URL, dpop_signer.thumbprint),
+        ),
+        Benchmark(
+            "dpop_header",
+            lambda: generate_dpop_header(PERSON_URL, keypair, method="GET", ath=ath),
+        ),
+        Benchmark("dpop_proof", lambda: dpop_signer.sign(PERSON_URL, method="GET", ath=ath)),
+        Benchmark("verify_jws", lambda: verify_jws(access_token, jwkset), len(access_token)),
+    ]
+    for size, (history_months, noa_years) in PERSON_SIZES.items():
+        encrypted = emulator.encrypt_person(
+            build_persona(history_months=history_months, noa_years=noa_years)
+        )
+        benchmarks.append(
+            Benchmark(
+                f"decrypt_jwe[{size}]", lambda data=encrypted: decrypt_jwe(data), len(encrypted)
+            )
+        )
+    return benchmarks
+
+
+def measure(fn: Callable[[], object], repeat: int = 5, min_time: float = 0.2) -> dict:
+    """
+    Times `fn` in `repeat` rounds of at least `min_time` seconds each and returns the seconds per
+    call of the fastest and median rounds.
+    """
+    # warm up the lazily loaded keys and caches outside of the timed rounds
+    fn()
+    timer = timeit.Timer(fn)
+    iterations = 1
+    while True:
+        elapsed = timer.timeit(iterations)
+        if elapsed >= min_time:
+            break
+        iterations = max(iterations * 2, int(iterations * min_time / max(elapsed, 1e-9)))
+
+    rounds = [elapsed / iterations] + [
+        timer.timeit(iterations) / iterations for _ in range(repeat - 1)
+    ]
+    return {
+        "min": min(rounds),
+        "median": statistics.median(rounds),
+        "rounds": len(rounds),
+        "iterations": iterations,
+    }
+
+
+def run(
+    names: Optional[Iterable[str]] = None, repeat: int = 5, min_time: float = 0.2
+) -> Dict[str, dict]:
+    """
+    Runs the benchmarks whose name contains one of `names` (all of them by default).
+    """
+    emulator = MyInfoEmulator()
+
+    results = {}
+    with benchmark_environment(emulator):
+        for benchmark in get_benchmarks(emulator):
+            if names and not any(name in benchmark.name for name in names):
+                continue
+            result = measure(benchmark.fn, repeat=repeat, min_time=min_time)
+            result["payload_bytes"] = benchmark.payload_bytes
+            results[benchmark.name] = result
+    return results
+
+
+def get_machine_info() -> dict:
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cryptography": cryptography.__version__,
+        "jwcrypto": version("jwcrypto"),
+        "openssl": default_backend().openssl_version_text(),
+    }
+
+
+def save_baseline(results: Dict[str, dict], path: str = DEFAULT_BASELINE_PATH) -> None:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"machine": get_machine_info(), "benchmarks": results}, f, indent=2)
+
+
+def load_baseline(path: str = DEFAULT_BASELINE_PATH) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(
+    results: Dict[str, dict], baseline: dict, threshold: float = DEFAULT_THRESHOLD, stat="median"
+) -> List[Regression]:
+    """
+    Returns the benchmarks slower than their baseline by more than `threshold` (0.2 is 20%).
+    Benchmarks missing from the baseline are ignored.
+    """
+    regressions = []
+    for name, result in results.items():
+        previous = baseline["benchmarks"].get(name)
+        if previous is None:
+            continue
+        if result[stat] > previous[stat] * (1 + threshold):
+            regressions.append(Regression(name, previous[stat], result[stat]))
+    return regressions
+
+
+def format_results(results: Dict[str, dict], baseline: Optional[dict] = None) -> str:
+    lines = [f"{'benchmark':<22}{'min':>12}{'median':>12}{'ops/s':>12}{'bytes':>10}{'vs base':>10}"]
+    for name, result in results.items():
+        change = ""
+        previous = (baseline or {}).get("benchmarks", {}).get(name)
+        if previous:
+            change = f"{result['median'] / previous['median'] - 1:+.1%}"
+        lines.append(
+            f"{name:<22}{result['min'] * 1e6:>10.1f}us{result['median'] * 1e6:>10.1f}us"
+            f"{1 / result['median']:>12.0f}{result['payload_bytes'] or '':>10}{change:>10}"
+        )
+    return "\n".join(lines)
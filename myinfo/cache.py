@@ -0,0 +1,329 @@
+"""
+Two-tier cache of Myinfo artifacts: a small in-process L1 in front of the shared Django cache (L2).
+
+Each namespace has its own TTL and decides whether it may be served from the L1. JWKS documents
+are already kept in process, parsed, by myinfo.security.JWKSStore, which only reads this cache on
+a miss, so they skip the L1. Flow state and idempotency records must be seen by all the workers as
+soon as they change, so they skip the L1 as well and always go to the shared cache.
+"""
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional
+
+from django.conf import settings as django_settings
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+from redis.exceptions import ResponseError
+
+from myinfo import metrics
+from myinfo import settings as myinfo_settings
+
+
+class _Negative(object):
+    def __repr__(self):
+        return "NEGATIVE"
+
+    def __bool__(self):
+        return False
+
+
+# Returned by `TieredCache.get` for keys cached as known to be missing
+NEGATIVE = _Negative()
+# Stored in place of NEGATIVE, which does not survive pickling by the L2 backend
+_NEGATIVE_MARKER = "__myinfo_cache_negative__"
+_MISSING = object()
+
+
+class LocalCache(object):
+    """
+    In-process LRU cache with per-entry expiry.
+
+    It takes no lock: every operation is a single step on an OrderedDict, which the GIL keeps
+    consistent, and the races left (two threads evicting or refreshing the same key) only cost a
+    miss.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key: str, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            self._data.pop(key, None)
+            return default
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            pass
+        return value
+
+    def set(self, key: str, value, ttl: float) -> None:
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            try:
+                self._data.popitem(last=False)
+            except KeyError:
+                break
+
+    def pop(self, key: str, default=None):
+        entry = self._data.pop(key, None)
+        if entry is None or entry[0] <= time.monotonic():
+            return default
+        return entry[1]
+
+    def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def _has_redis_internals(shared: RedisCache) -> bool:
+    client = getattr(shared, "_cache", None)
+    return hasattr(client, "get_client") and hasattr(client, "_serializer")
+
+
+def _redis_pop(shared: RedisCache, key: str):
+    # The Django cache API has no atomic get-and-delete, so this uses private attributes of
+    # django.core.cache.backends.redis, as of Django 4.0 to 5.1 (5.1.6 in requirements.txt):
+    # RedisCache._cache (the RedisCacheClient), its get_client(key, write=True) and its _serializer.
+    # myinfo.tests.test_cache checks them against the installed Django, and `pop` falls back to the
+    # generic get + delete where they are missing.
+    shared_key = shared.make_and_validate_key(key)
+    client = shared._cache.get_client(shared_key, write=True)
+    try:
+        raw = client.getdel(shared_key)
+    except ResponseError:
+        # GETDEL is Redis >= 6.2
+        pipeline = client.pipeline(transaction=True)
+        pipeline.get(shared_key)
+        pipeline.delete(shared_key)
+        raw, _ = pipeline.execute()
+    return _MISSING if raw is None else shared._cache._serializer.loads(raw)
+
+
+class Namespace(NamedTuple):
+    ttl: float
+    local: bool
+    negative_ttl: float
+
+
+class TieredCache(object):
+    """
+    Cache of one namespace, with an optional in-process L1 and the Django cache `alias` as L2.
+
+    Without Django settings (e.g. plain pytest runs), the L2 is skipped. Known-missing keys can be
+    cached with `set_negative`, for which `get` returns NEGATIVE.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        ttl: float,
+        local: bool = True,
+        negative_ttl: Optional[float] = None,
+        maxsize: Optional[int] = None,
+        alias: str = "default",
+    ):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.alias = alias
+        maxsize = myinfo_settings.MYINFO_L1_CACHE_MAXSIZE if maxsize is None else maxsize
+        self.local = LocalCache(maxsize) if local else None
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    @property
+    def shared(self):
+        if not django_settings.configured:
+            return None
+        return caches[self.alias]
+
+    def make_key(self, key: str) -> str:
+        return f"myinfo:{self.namespace}:{key}"
+
+    def get(self, key: str, default=None):
+        key = self.make_key(key)
+        if self.local is not None:
+            value = self.local.get(key, _MISSING)
+            if value is not _MISSING:
+                return self._hit(value, "l1_hit")
+
+        shared = self.shared
+        value = _MISSING if shared is None else shared.get(key, _MISSING)
+        if value is _MISSING:
+            self.misses += 1
+            metrics.CACHE_REQUESTS.inc(cache=self.namespace, result="l2_miss")
+            return default
+
+        if value == _NEGATIVE_MARKER:
+            value = NEGATIVE
+        if self.local is not None:
+            # the remaining TTL of the L2 entry is unknown, the L1 copy lives at most the
+            # namespace's TTL
+            self.local.set(key, value, self.negative_ttl if value is NEGATIVE else self.ttl)
+        return self._hit(value, "l2_hit")
+
+    def set(self, key: str, value, ttl: Optional[float] = None) -> None:
+        self._set(self.make_key(key), value, self.ttl if ttl is None else ttl)
+
+    def set_negative(self, key: str, ttl: Optional[float] = None) -> None:
+        """
+        Caches `key` as known to be missing, so that lookups skip the upstream source for `ttl`.
+        """
+        self._set(self.make_key(key), NEGATIVE, self.negative_ttl if ttl is None else ttl)
+
+    def add(self, key: str, value, ttl: Optional[float] = None) -> bool:
+        """
+        Sets `key` only if it is missing, and returns whether it was set. Atomic on the L2 backend,
+        so that it can serve as a lock between workers.
+        """
+        key = self.make_key(key)
+        ttl = self.ttl if ttl is None else ttl
+        shared = self.shared
+        if shared is not None:
+            added = shared.add(key, value, ttl)
+            if added and self.local is not None:
+                self.local.set(key, value, ttl)
+            return added
+        if self.local is None:
+            return True
+        if self.local.get(key, _MISSING) is not _MISSING:
+            return False
+        self.local.set(key, value, ttl)
+        return True
+
+    def pop(self, key: str, default=None):
+        """
+        Returns and deletes `key`. On Redis it is a single GETDEL (a MULTI GET + DEL before Redis
+        6.2), so that of concurrent callers (in any process) only one gets the value. On other
+        backends it is a get followed by a delete, and only the caller whose delete removed the
+        entry gets it: that holds only where `delete` reports whether the key existed, as LocMem's
+        does.
+        """
+        key = self.make_key(key)
+        local_value = _MISSING
+        if self.local is not None:
+            local_value = self.local.pop(key, _MISSING)
+
+        shared = self.shared
+        if shared is None:
+            value = local_value
+        elif isinstance(shared, RedisCache) and _has_redis_internals(shared):
+            value = _redis_pop(shared, key)
+        else:
+            value = shared.get(key, _MISSING)
+            if value is not _MISSING and not shared.delete(key):
+                value = _MISSING
+
+        if value is _MISSING or value == _NEGATIVE_MARKER or value is NEGATIVE:
+            return default
+        return value
+
+    def delete(self, key: str) -> None:
+        key = self.make_key(key)
+        if self.local is not None:
+            self.local.delete(key)
+        shared = self.shared
+        if shared is not None:
+            shared.delete(key)
+
+    def clear_local(self) -> None:
+        if self.local is not None:
+            self.local.clear()
+
+    def stats(self) -> dict:
+        lookups = self.l1_hits + self.l2_hits + self.negative_hits + self.misses
+        hits = lookups - self.misses
+        return {
+            "l1_hits": self.l1_hits,
+            "l2_hits": self.l2_hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_ratio": hits / lookups if lookups else 0.0,
+            "l1_size": len(self.local) if self.local is not None else 0,
+        }
+
+    def _hit(self, value, result: str):
+        if value is NEGATIVE:
+            self.negative_hits += 1
+            metrics.CACHE_REQUESTS.inc(cache=self.namespace, result="negative_hit")
+            return NEGATIVE
+        if result == "l1_hit":
+            self.l1_hits += 1
+        else:
+            self.l2_hits += 1
+        metrics.CACHE_REQUESTS.inc(cache=self.namespace, result=result)
+        return value
+
+    def _set(self, key: str, value, ttl: float) -> None:
+        if self.local is not None:
+            self.local.set(key, value, ttl)
+        shared = self.shared
+        if shared is not None:
+            shared.set(key, _NEGATIVE_MARKER if value is NEGATIVE else value, ttl)
+
+
+def get_namespaces() -> Dict[str, Namespace]:
+    return {
+        "jwks": Namespace(
+            ttl=myinfo_settings.MYINFO_JWKS_CACHE_TTL,
+            local=False,
+            negative_ttl=myinfo_settings.MYINFO_JWKS_REFRESH_INTERVAL,
+        ),
+        "flow": Namespace(
+            ttl=myinfo_settings.MYINFO_FLOW_STATE_TTL,
+            local=False,
+            negative_ttl=myinfo_settings.MYINFO_FLOW_STATE_TTL,
+        ),
+        "idempotency": Namespace(
+            ttl=myinfo_settings.MYINFO_IDEMPOTENCY_TTL,
+            local=False,
+            negative_ttl=myinfo_settings.MYINFO_IDEMPOTENCY_TTL,
+        ),
+    }
+
+
+_caches: Dict[str, TieredCache] = {}
+
+
+def get_cache(namespace: str) -> TieredCache:
+    """
+    Returns the process-wide cache of `namespace` ("jwks", "flow" or "idempotency").
+    """
+    tiered_cache = _caches.get(namespace)
+    if tiered_cache is None:
+        config = get_namespaces()[namespace]
+        tiered_cache = _caches.setdefault(
+            namespace,
+            TieredCache(
+                namespace, config.ttl, local=config.local, negative_ttl=config.negative_ttl
+            ),
+        )
+    return tiered_cache
+
+
+metrics.registry.register(
+    metrics.Gauge(
+        "myinfo_cache_hit_ratio",
+        "Share of lookups in each Myinfo cache namespace answered from the L1 or L2 cache.",
+        ["cache"],
+        callback=lambda: {
+            (namespace,): tiered_cache.stats()["hit_ratio"]
+            for namespace, tiered_cache in _caches.items()
+        },
+    )
+)
@@ -1,24 +1,57 @@
 import base64
 import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from hashlib import sha256
 from json import JSONDecodeError
+from typing import List, Optional, Union
 from urllib.parse import quote, urlencode
 
+import httpx
 import requests
-from myinfo import settings
+from myinfo import metrics, resilience, settings, transport
+from myinfo.person import Person, decrypt_person
 from myinfo.security import (
+    DPoPSigner,
+    crypto_executor,
     decrypt_jwe,
     generate_client_assertion,
     generate_code_challenge,
-    generate_dpop_header,
-    generate_ephemeral_session_keypair,
     get_jwkset,
-    verify_jws,
+    jwks_store,
+    keypair_pool,
+    verify_jws_from_url,
 )
 from requests import HTTPError
 
 log = logging.getLogger(__name__)
 
+_prefetch_executor = None
+_prefetch_executor_pid = None
+_prefetch_lock = threading.Lock()
+
+
+def get_prefetch_executor() -> ThreadPoolExecutor:
+    """
+    Returns the thread pool running background prefetches of the current process.
+    """
+    global _prefetch_executor, _prefetch_executor_pid
+
+    if _prefetch_executor is None or _prefetch_executor_pid != os.getpid():
+        with _prefetch_lock:
+            if _prefetch_executor is None or _prefetch_executor_pid != os.getpid():
+                _prefetch_executor = ThreadPoolExecutor(
+                    max_workers=settings.MYINFO_PREFETCH_WORKERS,
+                    thread_name_prefix="myinfo-prefetch",
+                )
+                _prefetch_executor_pid = os.getpid()
+    return _prefetch_executor
+
+
+def get_jwks_urls() -> tuple:
+    return settings.MYINFO_JWKS_TOKEN_VERIFICATION_URL, settings.MYINFO_JWKS_DATA_VERIFICATION_URL
+
 
 class MyInfoClient(object):
     """
@@ -26,17 +59,20 @@ class MyInfoClient(object):
     Test data: https://www.ndi-api.gov.sg/library/trusted-data/myinfo/resources-personas.
     """
 
-    API_TIMEOUT = 30
+    CONNECT_TIMEOUT = settings.MYINFO_CONNECT_TIMEOUT
+    READ_TIMEOUT = settings.MYINFO_READ_TIMEOUT
     # MyInfo fields
     context = ""
     version = ""
     client_id = ""
 
-    def __init__(self, name=None):
+    def __init__(self, name=None, session: requests.Session = None):
         """
-        Initialize a request session to interface with remote API
+        Use the process-wide pooled session to interface with remote API
         """
-        self.session = requests.Session()
+        if session is None and settings.MYINFO_HTTP_POOLED:
+            session = transport.get_session()
+        self.session = session or transport.create_session()
 
     @classmethod
     def get_url(cls, resource: str):
@@ -49,31 +85,88 @@ class MyInfoClient(object):
         #  https://public.cloud.myinfo.gov.sg/myinfobiz/myinfo-biz-specs-v2.0.1.html#section/Environments
         return f"{settings.MYINFO_DOMAIN}/{cls.context}/{cls.version}/{resource}"
 
-    def request(self, api_url, method="GET", extra_headers=None, params=None, data=None):
+    @staticmethod
+    def get_request_headers(extra_headers=None) -> dict:
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Accept": "application/json",
+        }
+        if extra_headers:
+            headers.update(extra_headers)
+        return headers
+
+    @staticmethod
+    def parse_response(response):
+        try:
+            return response.json()
+        except JSONDecodeError:
+            return response.text
+
+    def request(
+        self,
+        api_url,
+        method="GET",
+        extra_headers=None,
+        params=None,
+        data=None,
+        endpoint="other",
+        deadline: resilience.Deadline = None,
+    ):
         """
+        `endpoint` names the upstream endpoint in metrics, e.g. "token" or "person", and selects
+        its circuit breaker and bulkhead. With a `deadline`, the wait for a bulkhead slot and the
+        timeouts are capped at its remaining budget.
+
         Returns:
             dict or str
 
         Raises:
             requests.RequestException
+            myinfo.resilience.CircuitOpenError: when `endpoint` is failing, without calling it.
+            myinfo.resilience.DeadlineExceeded: when `deadline` can't cover the call.
+            myinfo.resilience.BulkheadFullError: when `endpoint` has too many calls in flight.
         """
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Accept": "application/json",
-        }
-        if extra_headers:
-            headers.update(extra_headers)
+        headers = self.get_request_headers(extra_headers)
+        if deadline is not None:
+            deadline.check(endpoint)
+        bulkhead = resilience.get_bulkhead(endpoint)
+        breaker = resilience.get_breaker(endpoint)
+        probe = failed = False
+        response = None
+        bulkhead.acquire(deadline)
+        try:
+            timeout = (self.CONNECT_TIMEOUT, self.READ_TIMEOUT)
+            if deadline is not None:
+                timeout = deadline.get_timeout(*timeout)
+            probe = breaker.before_call()
 
-        # log.debug("headers = %s", headers)
-        response = self.session.request(
-            method,
-            url=api_url,
-            params=params,
-            data=data,
-            timeout=self.API_TIMEOUT,
-            verify=settings.CERT_VERIFY,
-            headers=headers,
-        )
+            # log.debug("headers = %s", headers)
+            with metrics.STAGE_DURATION.time(stage=f"{endpoint}_{method.lower()}"):
+                response = self.session.request(
+                    method,
+                    url=api_url,
+                    params=params,
+                    data=data,
+                    timeout=timeout,
+                    verify=settings.CERT_VERIFY,
+                    headers=headers,
+                )
+        except requests.RequestException as e:
+            metrics.UPSTREAM_RESPONSES.inc(endpoint=endpoint, status="error")
+            if isinstance(e, requests.Timeout) and deadline is not None and deadline.expired:
+                # cut short by our own budget, not a sign of upstream failure
+                metrics.DEADLINE_EXCEEDED.inc(stage=endpoint)
+                raise resilience.DeadlineExceeded(endpoint) from e
+            failed = True
+            breaker.record_failure()
+            raise
+        finally:
+            bulkhead.release()
+            if probe and response is None and not failed:
+                # ended without an outcome (our own deadline, cancelled): let the next call probe
+                breaker.release_probe()
+        metrics.UPSTREAM_RESPONSES.inc(endpoint=endpoint, status=response.status_code)
+        breaker.record_status(response.status_code)
 
         try:
             response.raise_for_status()
@@ -81,10 +174,7 @@ class MyInfoClient(object):
             log.exception("HTTPError: %s", e.response.content)
             raise
 
-        try:
-            return response.json()
-        except JSONDecodeError:
-            return response.text
+        return self.parse_response(response)
 
 
 class MyInfoPersonalClientV4(MyInfoClient):
@@ -100,7 +190,9 @@ class MyInfoPersonalClientV4(MyInfoClient):
         return self.get_url("person") + f"/{sub}/"
 
     @classmethod
-    def get_authorise_url(cls, oauth_state: str, callback_url: str) -> str:
+    def get_authorise_url(
+        cls, oauth_state: str, callback_url: str, scope_profile: Optional[str] = None
+    ) -> str:
         """
         Return a redirect URL to SingPass login page for user's authentication and consent.
         """
@@ -108,7 +200,7 @@ class MyInfoPersonalClientV4(MyInfoClient):
 
         query = {
             "client_id": cls.client_id,
-            "scope": cls.get_scope(),
+            "scope": cls.get_scope(scope_profile),
             "purpose_id": cls.purpose_id,
             "response_type": "code",
             "code_challenge": code_challenge,
@@ -121,19 +213,29 @@ class MyInfoPersonalClientV4(MyInfoClient):
         return authorise_url
 
     @classmethod
-    def get_scope(cls):
-        return settings.MYINFO_SCOPE
+    def get_scope(cls, scope_profile: Optional[str] = None) -> str:
+        """
+        Returns the attributes of `scope_profile` (MYINFO_DEFAULT_SCOPE_PROFILE by default), from
+        MYINFO_SCOPE_PROFILES.
 
-    def get_access_token(
-        self, auth_code: str, state: str, callback_url: str, session_ephemeral_keypair=None
+        Raises:
+            ValueError: when there is no such profile.
+        """
+        scope_profile = scope_profile or settings.MYINFO_DEFAULT_SCOPE_PROFILE
+        try:
+            return settings.MYINFO_SCOPE_PROFILES[scope_profile]
+        except KeyError:
+            raise ValueError(f"Unknown Myinfo scope profile {scope_profile!r}") from None
+
+    def build_token_request(
+        self, auth_code: str, state: str, callback_url: str, dpop_signer: DPoPSigner
     ):
         """
-        Generate an access token when presented with a valid authcode obtained from the Authorise API.
-        This token can then be used to request for the user's data that were consented.
+        Returns the URL, headers and form data of the token request.
         """
         api_url = self.get_url("token")
-        jkt_thumbprint = session_ephemeral_keypair.thumbprint()
-        client_assertion = generate_client_assertion(api_url, jkt_thumbprint)
+        with metrics.STAGE_DURATION.time(stage="client_assertion"):
+            client_assertion = generate_client_assertion(api_url, dpop_signer.thumbprint)
         data = {
             "code": auth_code,
             "grant_type": "authorization_code",
@@ -143,54 +245,388 @@ class MyInfoPersonalClientV4(MyInfoClient):
             "client_assertion_type": "urn:ietf:params:oauth:client-assertion-type:jwt-bearer",
             "code_verifier": state,
         }
-        dpop_header = generate_dpop_header(api_url, session_ephemeral_keypair)
+        dpop_header = dpop_signer.sign(api_url)
+        headers = {"DPoP": dpop_header, "Cache-Control": "no-cache"}
+        return api_url, headers, data
+
+    def build_person_request(
+        self,
+        access_token: str,
+        decoded_access_token: dict,
+        dpop_signer: DPoPSigner,
+        scope_profile: Optional[str] = None,
+    ):
+        """
+        Returns the URL, headers and query params of the person request.
+        """
+        api_url = self.get_retrieve_resource_url(decoded_access_token["sub"])
+        params = {
+            "scope": self.get_scope(scope_profile),
+        }
+
+        # generate ath to append into DPoP
+        access_token_hash = sha256(access_token.encode()).digest()
+        ath = base64.urlsafe_b64encode(access_token_hash).decode().replace("=", "")
+
+        dpop_header = dpop_signer.sign(api_url, method="GET", ath=ath)
+        headers = {
+            "Authorization": f"DPoP {access_token}",
+            "dpop": dpop_header,
+            "Cache-Control": "no-cache",
+        }
+        return api_url, headers, params
+
+    @staticmethod
+    def verify_access_token(access_token: str, deadline: resilience.Deadline = None) -> dict:
+        return verify_jws_from_url(
+            access_token, settings.MYINFO_JWKS_TOKEN_VERIFICATION_URL, deadline
+        )
+
+    def get_access_token(
+        self,
+        auth_code: str,
+        state: str,
+        callback_url: str,
+        session_ephemeral_keypair=None,
+        dpop_signer: DPoPSigner = None,
+        deadline: resilience.Deadline = None,
+    ):
+        """
+        Generate an access token when presented with a valid authcode obtained from the Authorise API.
+        This token can then be used to request for the user's data that were consented.
+        """
+        dpop_signer = dpop_signer or DPoPSigner(session_ephemeral_keypair)
+        api_url, headers, data = self.build_token_request(
+            auth_code, state, callback_url, dpop_signer
+        )
 
         resp = self.request(
             api_url,
             method="POST",
-            extra_headers={"DPoP": dpop_header, "Cache-Control": "no-cache"},
+            extra_headers=headers,
             data=data,
+            endpoint="token",
+            deadline=deadline,
         )
 
         return resp
 
-    def get_person_data(self, access_token: str, session_ephemeral_keypair):
-        jwkset = get_jwkset(settings.MYINFO_JWKS_TOKEN_VERIFICATION_URL)
-        decoded_access_token = verify_jws(access_token, jwkset)
-        api_url = self.get_retrieve_resource_url(decoded_access_token["sub"])
-        params = {
-            "scope": self.get_scope(),
-        }
-
-        # generate ath to append into DPoP
-        access_token_hash = sha256(access_token.encode()).digest()
-        ath = base64.urlsafe_b64encode(access_token_hash).decode().replace("=", "")
+    def get_person_data(
+        self,
+        access_token: str,
+        session_ephemeral_keypair=None,
+        dpop_signer: DPoPSigner = None,
+        deadline: resilience.Deadline = None,
+        scope_profile: Optional[str] = None,
+    ):
+        if deadline is not None:
+            deadline.check("access_token_verify")
+        with metrics.STAGE_DURATION.time(stage="access_token_verify"):
+            decoded_access_token = crypto_executor.run(
+                self.verify_access_token, access_token, deadline
+            )
+        dpop_signer = dpop_signer or DPoPSigner(session_ephemeral_keypair)
+        return resilience.retry_policy.call(
+            "person",
+            self.request_person_data,
+            access_token,
+            decoded_access_token,
+            dpop_signer,
+            deadline,
+            scope_profile,
+            deadline=deadline,
+        )
 
-        dpop_header = generate_dpop_header(
-            api_url, session_ephemeral_keypair, method="GET", ath=ath
+    def request_person_data(
+        self,
+        access_token: str,
+        decoded_access_token: dict,
+        dpop_signer: DPoPSigner,
+        deadline: resilience.Deadline = None,
+        scope_profile: Optional[str] = None,
+    ):
+        """
+        One attempt of the person request, with its own DPoP proof: a proof is bound to a single
+        request by its `jti`, so retries can't reuse it.
+        """
+        api_url, headers, params = self.build_person_request(
+            access_token, decoded_access_token, dpop_signer, scope_profile
         )
 
         resp = self.request(
             api_url,
             method="GET",
-            extra_headers={
-                "Authorization": f"DPoP {access_token}",
-                "dpop": dpop_header,
-                "Cache-Control": "no-cache",
-            },
+            extra_headers=headers,
             params=params,
+            endpoint="person",
+            deadline=deadline,
         )
         return resp
 
-    def retrieve_resource(self, auth_code: str, state: str, callback_url: str) -> dict:
-        session_ephemeral_keypair = generate_ephemeral_session_keypair()
+    def prefetch_jwks(self) -> List[Future]:
+        """
+        Warms the JWKS store in the background for the verification URLs that are missing or
+        stale. The verification steps later read the store as usual, waiting for a fetch that is
+        still in flight.
+        """
+        key_urls = [key_url for key_url in get_jwks_urls() if not jwks_store.is_fresh(key_url)]
+        if not key_urls:
+            return []
+        executor = get_prefetch_executor()
+        return [executor.submit(get_jwkset, key_url) for key_url in key_urls]
+
+    def retrieve_resource(
+        self,
+        auth_code: str,
+        state: str,
+        callback_url: str,
+        concurrent: bool = None,
+        session_ephemeral_keypair=None,
+        deadline: resilience.Deadline = None,
+        as_person: bool = False,
+        scope_profile: Optional[str] = None,
+    ) -> Union[dict, Person]:
+        """
+        Runs the whole token + person flow. In concurrent mode (MYINFO_CONCURRENT_RETRIEVE), both
+        JWKS documents are fetched while the keypair, client assertion and token exchange proceed,
+        so the critical path is down to the token and person round trips.
+
+        `session_ephemeral_keypair` is the keypair stored with the flow state, if any. Otherwise
+        one is taken from the pool.
+
+        Every stage draws from `deadline` (MYINFO_CALLBACK_BUDGET seconds from now by default), and
+        the flow raises myinfo.resilience.DeadlineExceeded as soon as the budget left can't cover
+        the next one.
+
+        With `as_person`, returns a myinfo.person.Person over the payload, parsed on first access.
+
+        `scope_profile` must be the one the flow was authorised with (see `get_authorise_url`).
+        """
+        if deadline is None:
+            deadline = resilience.Deadline(settings.MYINFO_CALLBACK_BUDGET)
+        if concurrent is None:
+            concurrent = settings.MYINFO_CONCURRENT_RETRIEVE
+        if concurrent:
+            self.prefetch_jwks()
+
+        # the same keypair signs both DPoP proofs of the flow
+        with metrics.STAGE_DURATION.time(stage="keypair"):
+            dpop_signer = DPoPSigner(session_ephemeral_keypair or keypair_pool.take())
         access_token_resp = self.get_access_token(
             auth_code=auth_code,
             state=state,
             callback_url=callback_url,
-            session_ephemeral_keypair=session_ephemeral_keypair,
+            dpop_signer=dpop_signer,
+            deadline=deadline,
         )
         access_token = access_token_resp["access_token"]
-        person_data = self.get_person_data(access_token, session_ephemeral_keypair)
+        person_data = self.get_person_data(
+            access_token,
+            dpop_signer=dpop_signer,
+            deadline=deadline,
+            scope_profile=scope_profile,
+        )
+
+        deadline.check("person_decrypt")
+        return crypto_executor.run(
+            decrypt_person if as_person else decrypt_jwe, person_data, deadline
+        )
+
+
+class AsyncMyInfoClient(MyInfoClient):
+    """
+    asyncio counterpart of MyInfoClient, on the `httpx.AsyncClient` of the running event loop.
+    """
+
+    def __init__(self, name=None, http: httpx.AsyncClient = None):
+        super().__init__(name)
+        self._http = http
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = transport.get_async_client()
+        return self._http
+
+    async def request(
+        self,
+        api_url,
+        method="GET",
+        extra_headers=None,
+        params=None,
+        data=None,
+        endpoint="other",
+        deadline: resilience.Deadline = None,
+    ):
+        """
+        Returns:
+            dict or str
+
+        Raises:
+            httpx.HTTPError
+            myinfo.resilience.CircuitOpenError: when `endpoint` is failing, without calling it.
+            myinfo.resilience.DeadlineExceeded: when `deadline` can't cover the call.
+            myinfo.resilience.BulkheadFullError: when `endpoint` has too many calls in flight.
+        """
+        headers = self.get_request_headers(extra_headers)
+        if deadline is not None:
+            deadline.check(endpoint)
+        bulkhead = resilience.get_bulkhead(endpoint)
+        breaker = resilience.get_breaker(endpoint)
+        probe = failed = False
+        response = None
+        await bulkhead.aacquire(deadline)
+        try:
+            connect_timeout, read_timeout = self.CONNECT_TIMEOUT, self.READ_TIMEOUT
+            if deadline is not None:
+                connect_timeout, read_timeout = deadline.get_timeout(connect_timeout, read_timeout)
+            probe = breaker.before_call()
+
+            with metrics.STAGE_DURATION.time(stage=f"{endpoint}_{method.lower()}"):
+                response = await self.http.request(
+                    method,
+                    api_url,
+                    params=params,
+                    data=data,
+                    timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                    headers=headers,
+                )
+        except httpx.RequestError as e:
+            metrics.UPSTREAM_RESPONSES.inc(endpoint=endpoint, status="error")
+            timed_out = isinstance(e, httpx.TimeoutException)
+            if timed_out and deadline is not None and deadline.expired:
+                metrics.DEADLINE_EXCEEDED.inc(stage=endpoint)
+                raise resilience.DeadlineExceeded(endpoint) from e
+            failed = True
+            breaker.record_failure()
+            raise
+        finally:
+            bulkhead.release()
+            if probe and response is None and not failed:
+                # ended without an outcome (our own deadline, cancelled): let the next call probe
+                breaker.release_probe()
+        metrics.UPSTREAM_RESPONSES.inc(endpoint=endpoint, status=response.status_code)
+        breaker.record_status(response.status_code)
 
-        return decrypt_jwe(person_data)
+        try:
+            response.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            log.exception("HTTPError: %s", e.response.content)
+            raise
+
+        return self.parse_response(response)
+
+
+class AsyncMyInfoPersonalClientV4(AsyncMyInfoClient, MyInfoPersonalClientV4):
+    """
+    Same API as MyInfoPersonalClientV4, with coroutines for the upstream calls.
+    JWS verification and JWE decryption are CPU-bound and run on the crypto executor.
+    """
+
+    async def get_access_token(
+        self,
+        auth_code: str,
+        state: str,
+        callback_url: str,
+        session_ephemeral_keypair=None,
+        dpop_signer: DPoPSigner = None,
+        deadline: resilience.Deadline = None,
+    ):
+        dpop_signer = dpop_signer or DPoPSigner(session_ephemeral_keypair)
+        api_url, headers, data = self.build_token_request(
+            auth_code, state, callback_url, dpop_signer
+        )
+        return await self.request(
+            api_url,
+            method="POST",
+            extra_headers=headers,
+            data=data,
+            endpoint="token",
+            deadline=deadline,
+        )
+
+    async def get_person_data(
+        self,
+        access_token: str,
+        session_ephemeral_keypair=None,
+        dpop_signer: DPoPSigner = None,
+        deadline: resilience.Deadline = None,
+        scope_profile: Optional[str] = None,
+    ):
+        if deadline is not None:
+            deadline.check("access_token_verify")
+        with metrics.STAGE_DURATION.time(stage="access_token_verify"):
+            decoded_access_token = await crypto_executor.run_async(
+                self.verify_access_token, access_token, deadline
+            )
+        dpop_signer = dpop_signer or DPoPSigner(session_ephemeral_keypair)
+        return await resilience.retry_policy.acall(
+            "person",
+            self.request_person_data,
+            access_token,
+            decoded_access_token,
+            dpop_signer,
+            deadline,
+            scope_profile,
+            deadline=deadline,
+        )
+
+    async def request_person_data(
+        self,
+        access_token: str,
+        decoded_access_token: dict,
+        dpop_signer: DPoPSigner,
+        deadline: resilience.Deadline = None,
+        scope_profile: Optional[str] = None,
+    ):
+        api_url, headers, params = self.build_person_request(
+            access_token, decoded_access_token, dpop_signer, scope_profile
+        )
+        return await self.request(
+            api_url,
+            method="GET",
+            extra_headers=headers,
+            params=params,
+            endpoint="person",
+            deadline=deadline,
+        )
+
+    async def retrieve_resource(
+        self,
+        auth_code: str,
+        state: str,
+        callback_url: str,
+        concurrent: bool = None,
+        session_ephemeral_keypair=None,
+        deadline: resilience.Deadline = None,
+        as_person: bool = False,
+        scope_profile: Optional[str] = None,
+    ) -> Union[dict, Person]:
+        if deadline is None:
+            deadline = resilience.Deadline(settings.MYINFO_CALLBACK_BUDGET)
+        if concurrent is None:
+            concurrent = settings.MYINFO_CONCURRENT_RETRIEVE
+        if concurrent:
+            self.prefetch_jwks()
+
+        with metrics.STAGE_DURATION.time(stage="keypair"):
+            dpop_signer = DPoPSigner(session_ephemeral_keypair or keypair_pool.take())
+        access_token_resp = await self.get_access_token(
+            auth_code=auth_code,
+            state=state,
+            callback_url=callback_url,
+            dpop_signer=dpop_signer,
+            deadline=deadline,
+        )
+        access_token = access_token_resp["access_token"]
+        person_data = await self.get_person_data(
+            access_token,
+            dpop_signer=dpop_signer,
+            deadline=deadline,
+            scope_profile=scope_profile,
+        )
+
+        deadline.check("person_decrypt")
+        return await crypto_executor.run_async(
+            decrypt_person if as_person else decrypt_jwe, person_data, deadline
+        )
@@ -0,0 +1,470 @@
+"""
+Local stand-in for the Myinfo v4 APIs, issuing real signed and encrypted responses.
+
+It implements the parts of https://public.cloud.myinfo.gov.sg/myinfo/api/myinfo-kyc-v4.0.html used
+by MyInfoPersonalClientV4, with the same checks as the real service:
+- GET  /com/v4/authorize          redirects to the callback with a single-use auth code
+- POST /com/v4/token              validates the PKCE verifier, DPoP proof and client assertion
+- GET  /com/v4/person/{sub}/      validates the DPoP-bound access token, returns JWE(JWS(person))
+- GET  /.well-known/keys.json     the emulator's signing keys, for both token and data verification
+
+The client's public keys are derived from MYINFO_PRIVATE_KEY_SIG / MYINFO_PRIVATE_KEY_ENC, so the
+app can be pointed at the emulator by only overriding MYINFO_DOMAIN and the JWKS URLs (see
+`get_client_environ`). Latency and error rate can be injected to benchmark the flow.
+"""
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from jwcrypto import jwe, jwk, jws
+from myinfo import settings
+from myinfo.security import (
+    encode_json_segment,
+    generate_code_challenge,
+    private_keys,
+    sign_es256_compact,
+)
+
+log = logging.getLogger(__name__)
+
+ACCESS_TOKEN_TTL = 1800
+AUTH_CODE_TTL = 300
+
+
+class EmulatorError(Exception):
+    def __init__(self, status: int, error: str, description: str):
+        super().__init__(description)
+        self.status = status
+        self.error = error
+        self.description = description
+
+
+def build_persona(uinfin: str = "S9812381D", history_months: int = 15, noa_years: int = 2) -> dict:
+    """
+    Returns a person payload shaped like the Myinfo v4 staging personas, with `history_months`
+    CPF contributions and `noa_years` notices of assessment.
+    """
+
+    def attribute(value=None, code=None, desc=None, source="1"):
+        data = {"lastupdated": "2024-01-26", "source": source, "classification": "C"}
+        if code is not None:
+            data.update({"code": code, "desc": desc})
+        else:
+            data["value"] = value
+        return data
+
+    months = []
+    year, month = 2023, 12
+    for _ in range(history_months):
+        months.append(f"{year:04d}-{month:02d}")
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    months.reverse()
+
+    return {
+        "uinfin": attribute(uinfin),
+        "name": attribute("TAN XIAO HUI"),
+        "sex": attribute(code="F", desc="FEMALE"),
+        "race": attribute(code="CN", desc="CHINESE"),
+        "dob": attribute("1991-12-04"),
+        "residentialstatus": attribute(code="C", desc="CITIZEN"),
+        "nationality": attribute(code="SG", desc="SINGAPORE CITIZEN"),
+        "birthcountry": attribute(code="SG", desc="SINGAPORE"),
+        "passtype": attribute(code="", desc="", source="3"),
+        "passstatus": attribute("", source="3"),
+        "passexpirydate": attribute("", source="3"),
+        "employmentsector": attribute("", source="3"),
+        "mobileno": {
+            "lastupdated": "2024-01-26",
+            "source": "4",
+            "classification": "C",
+            "areacode": {"value": "65"},
+            "prefix": {"value": "+"},
+            "nbr": {"value": "97399245"},
+        },
+        "email": attribute("myinfotesting@gmail.com", source="4"),
+        "regadd": {
+            "country": {"code": "SG", "desc": "SINGAPORE"},
+            "unit": {"value": "128"},
+            "street": {"value": "BEDOK NORTH AVENUE 4"},
+            "lastupdated": "2024-01-26",
+            "block": {"value": "102"},
+            "source": "1",
+            "postal": {"value": "460102"},
+            "classification": "C",
+            "floor": {"value": "09"},
+            "type": "SG",
+            "building": {"value": "PEARL GARDEN"},
+        },
+        "housingtype": attribute(code="", desc=""),
+        "hdbtype": attribute(code="112", desc="2-ROOM FLAT (HDB)"),
+        "cpfcontributions": {
+            "lastupdated": "2024-01-26",
+            "source": "1",
+            "classification": "C",
+            "history": [
+                {
+                    "date": {"value": f"{month}-08"},
+                    "employer": {"value": "DBS BANK LTD" if i % 12 < 9 else "OCBC BANK"},
+                    "amount": {"value": 2035 + 10 * (i % 4)},
+                    "month": {"value": month},
+                }
+                for i, month in enumerate(months)
+            ],
+        },
+        "noahistory": {
+            "lastupdated": "2024-01-26",
+            "source": "1",
+            "classification": "C",
+            "noas": [
+                {
+                    "amount": {"value": 100000 + 5000 * i},
+                    "trade": {"value": 0},
+                    "interest": {"value": 0},
+                    "yearofassessment": {"value": str(2023 - i)},
+                    "taxclearance": {"value": "N"},
+                    "employment": {"value": 100000 + 5000 * i},
+                    "rent": {"value": 0},
+                    "category": {"value": "ORIGINAL"},
+                }
+                for i in range(noa_years)
+            ],
+        },
+        "ownerprivate": attribute(False),
+        "employment": attribute("DBS BANK LTD", source="2"),
+        "occupation": attribute("", source="2"),
+        "cpfemployers": {
+            "lastupdated": "2024-01-26",
+            "source": "1",
+            "classification": "C",
+            "history": [
+                {
+                    "month": {"value": month},
+                    "employer": {"value": "DBS BANK LTD" if i % 12 < 9 else "OCBC BANK"},
+                }
+                for i, month in enumerate(months)
+            ],
+        },
+        "marital": attribute(code="1", desc="SINGLE"),
+    }
+
+
+class MyInfoEmulator(object):
+    """
+    State and protocol checks of the emulator, independent from the HTTP server.
+    """
+
+    def __init__(
+        self,
+        persona: Optional[dict] = None,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        error_rate: float = 0.0,
+    ):
+        self.persona = persona or build_persona()
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.signing_key = jwk.JWK.generate(kty="EC", crv="P-256", alg="ES256", use="sig")
+        self.signing_kid = self.signing_key.thumbprint()
+        self._signing_header = encode_json_segment(
+            {"typ": "JWT", "alg": "ES256", "kid": self.signing_kid}
+        )
+        self._signing_op_key = self.signing_key.get_op_key("sign")
+        self._codes: Dict[str, dict] = {}
+        self._jtis: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def client_signing_key(self) -> jwk.JWK:
+        return jwk.JWK(**private_keys.signing_key.jwk.export_public(as_dict=True))
+
+    @property
+    def client_encryption_key(self) -> jwk.JWK:
+        return jwk.JWK(**private_keys.encryption_key.jwk.export_public(as_dict=True))
+
+    def get_jwks(self) -> dict:
+        public_key = self.signing_key.export_public(as_dict=True)
+        public_key["kid"] = self.signing_kid
+        return {"keys": [public_key]}
+
+    def inject_faults(self) -> None:
+        delay = self.latency + random.uniform(0, self.latency_jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            raise EmulatorError(503, "temporarily_unavailable", "Injected upstream error")
+
+    def authorize(self, query: dict) -> str:
+        """
+        Returns the callback URL with a new auth code.
+        """
+        for name in ("client_id", "redirect_uri", "code_challenge", "scope"):
+            if not query.get(name):
+                raise EmulatorError(400, "invalid_request", f"Missing {name}")
+        if query["client_id"] != settings.MYINFO_CLIENT_ID:
+            raise EmulatorError(400, "invalid_client", "Unknown client_id")
+        if query.get("code_challenge_method") != "S256":
+            raise EmulatorError(400, "invalid_request", "code_challenge_method must be S256")
+
+        code = f"myinfo-com-{uuid.uuid4().hex}"
+        with self._lock:
+            self._codes[code] = {
+                "code_challenge": query["code_challenge"],
+                "redirect_uri": query["redirect_uri"],
+                "scope": query["scope"],
+                "expires_at": time.time() + AUTH_CODE_TTL,
+            }
+        return f"{query['redirect_uri']}?{urlencode({'code': code})}"
+
+    def verify_dpop(
+        self, proof: Optional[str], method: str, path: str, access_token: str = None
+    ) -> str:
+        """
+        Verifies a DPoP proof and returns the thumbprint of its key.
+        """
+        if not proof:
+            raise EmulatorError(401, "invalid_dpop_proof", "Missing DPoP header")
+        token = jws.JWS()
+        try:
+            token.deserialize(proof)
+            header = token.jose_header
+            if header.get("typ") != "dpop+jwt" or header.get("alg") != "ES256":
+                raise ValueError("unexpected DPoP header")
+            proof_key = jwk.JWK(**header["jwk"])
+            token.verify(proof_key)
+            claims = json.loads(token.payload)
+        except Exception as e:
+            raise EmulatorError(401, "invalid_dpop_proof", f"Invalid DPoP proof: {e}")
+
+        now = time.time()
+        if claims.get("htm") != method or urlparse(claims.get("htu", "")).path != path:
+            raise EmulatorError(401, "invalid_dpop_proof", "DPoP htm/htu mismatch")
+        if not claims.get("iat", 0) - 60 <= now <= claims.get("exp", 0):
+            raise EmulatorError(401, "invalid_dpop_proof", "DPoP proof expired")
+        if access_token is not None:
+            ath = generate_code_challenge(access_token)
+            if claims.get("ath") != ath:
+                raise EmulatorError(401, "invalid_dpop_proof", "DPoP ath mismatch")
+        self.check_replay(claims.get("jti"), claims["exp"])
+        return proof_key.thumbprint()
+
+    def check_replay(self, jti: Optional[str], expires_at: float) -> None:
+        if not jti:
+            raise EmulatorError(401, "invalid_request", "Missing jti")
+        now = time.time()
+        with self._lock:
+            if jti in self._jtis:
+                raise EmulatorError(401, "invalid_request", "Replayed jti")
+            self._jtis[jti] = expires_at
+            if len(self._jtis) > 10000:
+                self._jtis = {key: exp for key, exp in self._jtis.items() if exp > now}
+
+    def verify_client_assertion(self, assertion: Optional[str], path: str) -> dict:
+        token = jws.JWS()
+        try:
+            token.deserialize(assertion or "")
+            token.verify(self.client_signing_key)
+            claims = json.loads(token.payload)
+        except Exception as e:
+            raise EmulatorError(401, "invalid_client", f"Invalid client assertion: {e}")
+
+        if claims.get("sub") != settings.MYINFO_CLIENT_ID or claims.get("iss") != claims["sub"]:
+            raise EmulatorError(401, "invalid_client", "Client assertion sub/iss mismatch")
+        if urlparse(claims.get("aud", "")).path != path:
+            raise EmulatorError(401, "invalid_client", "Client assertion aud mismatch")
+        if claims.get("exp", 0) < time.time():
+            raise EmulatorError(401, "invalid_client", "Client assertion expired")
+        self.check_replay(claims.get("jti"), claims["exp"])
+        return claims
+
+    def token(self, form: dict, dpop: Optional[str], path: str) -> dict:
+        jkt = self.verify_dpop(dpop, "POST", path)
+        assertion = self.verify_client_assertion(form.get("client_assertion"), path)
+        if assertion.get("cnf", {}).get("jkt") != jkt:
+            raise EmulatorError(401, "invalid_client", "Client assertion cnf.jkt mismatch")
+
+        with self._lock:
+            grant = self._codes.pop(form.get("code", ""), None)
+        if grant is None or grant["expires_at"] < time.time():
+            raise EmulatorError(400, "invalid_grant", "Unknown or expired auth code")
+        if form.get("redirect_uri") != grant["redirect_uri"]:
+            raise EmulatorError(400, "invalid_grant", "redirect_uri mismatch")
+        if generate_code_challenge(form.get("code_verifier", "")) != grant["code_challenge"]:
+            raise EmulatorError(400, "invalid_grant", "code_verifier mismatch")
+
+        now = int(time.time())
+        access_token = sign_es256_compact(
+            self._signing_op_key,
+            self._signing_header,
+            {
+                "sub": str(uuid.uuid4()),
+                "jti": uuid.uuid4().hex,
+                "scope": grant["scope"],
+                "client_id": settings.MYINFO_CLIENT_ID,
+                "cnf": {"jkt": jkt},
+                "iat": now,
+                "exp": now + ACCESS_TOKEN_TTL,
+            },
+        )
+        return {
+            "access_token": access_token,
+            "token_type": "DPoP",
+            "expires_in": ACCESS_TOKEN_TTL,
+            "scope": grant["scope"],
+        }
+
+    def person(
+        self, authorization: Optional[str], dpop: Optional[str], path: str, query: dict
+    ) -> str:
+        if not authorization or not authorization.startswith("DPoP "):
+            raise EmulatorError(401, "invalid_token", "Missing DPoP access token")
+        access_token = authorization[len("DPoP "):]
+        token = jws.JWS()
+        try:
+            token.deserialize(access_token)
+            token.verify(self.signing_key)
+            claims = json.loads(token.payload)
+        except Exception as e:
+            raise EmulatorError(401, "invalid_token", f"Invalid access token: {e}")
+        if claims["exp"] < time.time():
+            raise EmulatorError(401, "invalid_token", "Access token expired")
+        if path.rstrip("/").rsplit("/", 1)[-1] != claims["sub"]:
+            raise EmulatorError(401, "invalid_token", "sub mismatch")
+
+        jkt = self.verify_dpop(dpop, "GET", path, access_token=access_token)
+        if claims["cnf"]["jkt"] != jkt:
+            raise EmulatorError(401, "invalid_token", "DPoP key is not bound to the access token")
+
+        granted = set(claims["scope"].split())
+        requested = set(query.get("scope", claims["scope"]).split()) & granted
+        person = {name: value for name, value in self.persona.items() if name in requested}
+        return self.encrypt_person(person)
+
+    def encrypt_person(self, person: dict) -> str:
+        """
+        Returns `person` signed by the emulator and encrypted to the client, as a compact JWE.
+        """
+        signed = sign_es256_compact(self._signing_op_key, self._signing_header, person)
+        encryption_key = self.client_encryption_key
+        token = jwe.JWE(
+            signed.encode(),
+            protected={
+                "alg": "ECDH-ES+A256KW",
+                "enc": "A256GCM",
+                "kid": encryption_key.thumbprint(),
+                "cty": "JWT",
+            },
+        )
+        token.add_recipient(encryption_key)
+        return token.serialize(compact=True)
+
+
+class MyInfoEmulatorServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, emulator: MyInfoEmulator, verbose: bool = False):
+        super().__init__(address, MyInfoEmulatorHandler)
+        self.emulator = emulator
+        self.verbose = verbose
+        # CPU spent serving requests, to tell it apart from the app's when both share a process
+        self.cpu_seconds = 0.0
+        self._cpu_lock = threading.Lock()
+
+    def add_cpu_seconds(self, seconds: float) -> None:
+        with self._cpu_lock:
+            self.cpu_seconds += seconds
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class MyInfoEmulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: MyInfoEmulatorServer
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def handle_one_request(self):
+        started_at = time.thread_time()
+        try:
+            super().handle_one_request()
+        finally:
+            self.server.add_cpu_seconds(time.thread_time() - started_at)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def handle_request(self, method: str):
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        emulator = self.server.emulator
+        try:
+            if method == "GET" and url.path.endswith("/.well-known/keys.json"):
+                return self.send(200, json.dumps(emulator.get_jwks()))
+
+            emulator.inject_faults()
+            if method == "GET" and url.path == "/com/v4/authorize":
+                self.send_response(302)
+                self.send_header("Location", emulator.authorize(query))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if method == "POST" and url.path == "/com/v4/token":
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length).decode()
+                form = {name: values[0] for name, values in parse_qs(body).items()}
+                token = emulator.token(form, self.headers.get("DPoP"), url.path)
+                return self.send(200, json.dumps(token))
+            if method == "GET" and url.path.startswith("/com/v4/person/"):
+                person = emulator.person(
+                    self.headers.get("Authorization"), self.headers.get("DPoP"), url.path, query
+                )
+                return self.send(200, person, content_type="application/jose")
+            raise EmulatorError(404, "not_found", f"No route for {method} {url.path}")
+        except EmulatorError as e:
+            body = {"error": e.error, "error_description": e.description}
+            return self.send(e.status, json.dumps(body))
+
+    def send(self, status: int, body: str, content_type: str = "application/json"):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def get_client_environ(base_url: str) -> Dict[str, str]:
+    """
+    Returns the environment variables pointing the app at an emulator served at `base_url`.
+    """
+    return {
+        "MYINFO_DOMAIN": base_url,
+        "MYINFO_JWKS_TOKEN_VERIFICATION_URL": f"{base_url}/.well-known/keys.json",
+        "MYINFO_JWKS_DATA_VERIFICATION_URL": f"{base_url}/.well-known/keys.json",
+    }
+
+
+def start_emulator(
+    host: str = "127.0.0.1", port: int = 0, verbose: bool = False, **options
+) -> MyInfoEmulatorServer:
+    """
+    Starts an emulator server in a daemon thread and returns it. `port=0` picks a free port.
+    """
+    server = MyInfoEmulatorServer((host, port), MyInfoEmulator(**options), verbose=verbose)
+    thread = threading.Thread(target=server.serve_forever, name="myinfo-emulator", daemon=True)
+    thread.start()
+    return server
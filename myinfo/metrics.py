@@ -0,0 +1,216 @@
+"""
+In-process metrics for the Myinfo flow, exposed in the Prometheus text format.
+
+Recording is a dict lookup and a few additions under an uncontended lock, so instrumenting the
+request path costs well under a microsecond per observation. Metrics are per process: with several
+workers, each one exposes its own values (scrape every worker, or aggregate them in Prometheus).
+"""
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_labels(labelnames: Tuple[str, ...], labelvalues: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, object] = {}
+        self._lock = threading.Lock()
+
+    def get_labelvalues(self, labels: dict) -> Tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def samples(self) -> Iterable[Tuple[str, str, object]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{name}{labels} {format_value(value)}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels) -> None:
+        key = self.get_labelvalues(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self.get_labelvalues(labels), 0)
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield self.name, format_labels(self.labelnames, key), value
+
+
+class Gauge(Metric):
+    """
+    A gauge either set explicitly, or read from `callback` at render time. The callback returns a
+    number, or a dict of label values tuples to numbers.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), callback: Callable = None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels) -> None:
+        with self._lock:
+            self._values[self.get_labelvalues(labels)] = value
+
+    def get(self, **labels):
+        return self._values.get(self.get_labelvalues(labels), 0)
+
+    def samples(self):
+        values = self._values
+        if self.callback is not None:
+            values = self.callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+        for key, value in sorted(values.items()):
+            yield self.name, format_labels(self.labelnames, key), value
+
+
+class _Timer(object):
+    __slots__ = ("histogram", "labels", "started_at")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.started_at, **self.labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(float(bucket) for bucket in sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.get_labelvalues(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # per-bucket (non cumulative) counts, +Inf last, then sum and count
+                series = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, **labels) -> _Timer:
+        """
+        Context manager observing the duration of its block, in seconds.
+        """
+        return _Timer(self, labels)
+
+    def get_count(self, **labels) -> int:
+        series = self._values.get(self.get_labelvalues(labels))
+        return series[-1] if series else 0
+
+    def samples(self):
+        for key, series in sorted(self._values.items()):
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                labels = format_labels(self.labelnames, key, f'le="{format_value(upper_bound)}"')
+                yield f"{self.name}_bucket", labels, cumulative
+            yield f"{self.name}_sum", format_labels(self.labelnames, key), series[-2]
+            yield f"{self.name}_count", format_labels(self.labelnames, key), series[-1]
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+registry = Registry()
+
+STAGE_DURATION = registry.register(
+    Histogram(
+        "myinfo_stage_duration_seconds",
+        "Duration of each stage of the Myinfo flow.",
+        ["stage"],
+    )
+)
+UPSTREAM_RESPONSES = registry.register(
+    Counter(
+        "myinfo_upstream_responses_total",
+        "Responses from Myinfo by endpoint and HTTP status ('error' when no response was received).",
+        ["endpoint", "status"],
+    )
+)
+CACHE_REQUESTS = registry.register(
+    Counter(
+        "myinfo_cache_requests_total",
+        "Lookups in the Myinfo caches and pools, by result.",
+        ["cache", "result"],
+    )
+)
+CRYPTO_TASK_DURATION = registry.register(
+    Histogram(
+        "myinfo_crypto_task_duration_seconds",
+        "Time from submission to completion of tasks on the crypto executor.",
+    )
+)
+RETRIES = registry.register(
+    Counter(
+        "myinfo_upstream_retries_total",
+        "Retried calls to Myinfo by endpoint.",
+        ["endpoint"],
+    )
+)
+DEADLINE_EXCEEDED = registry.register(
+    Counter(
+        "myinfo_deadline_exceeded_total",
+        "Flows aborted because their deadline could not cover the next stage, by stage.",
+        ["stage"],
+    )
+)
+REJECTED_REQUESTS = registry.register(
+    Counter(
+        "myinfo_rejected_requests_total",
+        "Calls rejected by a bulkhead, and callbacks shed by admission control, by limiter.",
+        ["limiter"],
+    )
+)
@@ -0,0 +1,301 @@
+"""
+Typed, read-only view of a decrypted Myinfo v4 person payload.
+
+Reference: https://public.cloud.myinfo.gov.sg/myinfo/api/myinfo-kyc-v4.0.html#tag/Person
+
+A `Person` built with `from_json` keeps the verified payload as sent and only parses it on first
+access, so a cached or pickled profile costs one string, and `to_json` hands the same string back
+without serializing. Accessors wrap the parsed dicts in place instead of copying them: attributes
+are `Attribute` views ({value, code, desc, lastupdated, source, classification}), and the entries
+of cpfcontributions, cpfemployers and noahistory are only wrapped when read, with the `{"value"}`
+of their fields unwrapped:
+
+    person = decrypt_person(encrypted)
+    person.uinfin.value
+    person.sex.code
+    sum(contribution.amount for contribution in person.cpfcontributions.history)
+
+All the wrappers are slotted and hold a single reference to their dict.
+"""
+import json
+from collections.abc import Sequence
+from typing import Any, Callable, Dict, Optional, Union
+
+from myinfo.resilience import Deadline
+from myinfo.security import decrypt_jwe_payload
+
+
+class _Key(object):
+    """
+    Reads `key` from the wrapped dict.
+    """
+
+    __slots__ = ("key",)
+
+    def __init__(self, key: Optional[str] = None):
+        self.key = key
+
+    def __set_name__(self, owner, name):
+        if self.key is None:
+            self.key = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance._data.get(self.key)
+
+
+class _Value(_Key):
+    """
+    Reads the "value" of the `{"value": ...}` field `key`.
+    """
+
+    __slots__ = ()
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        field = instance._data.get(self.key)
+        return field.get("value") if field is not None else None
+
+
+class _Field(_Key):
+    """
+    Wraps the dict at `key` in `wrapper`, or returns None when it is absent.
+    """
+
+    __slots__ = ("wrapper",)
+
+    def __init__(self, wrapper: Callable[[dict], Any], key: Optional[str] = None):
+        super().__init__(key)
+        self.wrapper = wrapper
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        data = instance._data.get(self.key)
+        return self.wrapper(data) if data is not None else None
+
+
+class _View(object):
+    __slots__ = ("_data",)
+
+    def __init__(self, data: dict):
+        self._data = data
+
+    def to_dict(self) -> dict:
+        return self._data
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other._data == self._data
+
+
+class Attribute(_View):
+    """
+    A Myinfo attribute and its metadata.
+    """
+
+    __slots__ = ()
+
+    value = _Key()
+    code = _Key()
+    desc = _Key()
+    lastupdated = _Key()
+    source = _Key()
+    classification = _Key()
+    unavailable = _Key()
+
+
+class History(Sequence):
+    """
+    Entries of a history, wrapped in `entry` when read.
+    """
+
+    __slots__ = ("_items", "_entry")
+
+    def __init__(self, items: list, entry: Callable[[dict], _View]):
+        self._items = items
+        self._entry = entry
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._entry(item) for item in self._items[index]]
+        return self._entry(self._items[index])
+
+    def __iter__(self):
+        entry = self._entry
+        for item in self._items:
+            yield entry(item)
+
+    def to_list(self) -> list:
+        return self._items
+
+    def __repr__(self):
+        return f"History({len(self)} {self._entry.__name__})"
+
+
+class MobileNo(Attribute):
+    __slots__ = ()
+
+    areacode = _Value()
+    prefix = _Value()
+    nbr = _Value()
+
+
+class Address(Attribute):
+    __slots__ = ()
+
+    type = _Key()
+    block = _Value()
+    building = _Value()
+    floor = _Value()
+    unit = _Value()
+    street = _Value()
+    postal = _Value()
+    country = _Field(Attribute)
+
+
+class CPFContribution(_View):
+    __slots__ = ()
+
+    date = _Value()
+    month = _Value()
+    amount = _Value()
+    employer = _Value()
+
+
+class CPFEmployer(_View):
+    __slots__ = ()
+
+    month = _Value()
+    employer = _Value()
+
+
+class NoticeOfAssessment(_View):
+    __slots__ = ()
+
+    yearofassessment = _Value()
+    amount = _Value()
+    employment = _Value()
+    trade = _Value()
+    rent = _Value()
+    interest = _Value()
+    taxclearance = _Value()
+    category = _Value()
+
+
+class CPFContributions(Attribute):
+    __slots__ = ()
+
+    @property
+    def history(self) -> History:
+        return History(self._data.get("history") or [], CPFContribution)
+
+
+class CPFEmployers(Attribute):
+    __slots__ = ()
+
+    @property
+    def history(self) -> History:
+        return History(self._data.get("history") or [], CPFEmployer)
+
+
+class NOAHistory(Attribute):
+    __slots__ = ()
+
+    @property
+    def noas(self) -> History:
+        return History(self._data.get("noas") or [], NoticeOfAssessment)
+
+
+class Person(object):
+    """
+    A person payload, from its JSON (`from_json`) or an already parsed dict. Attributes missing
+    from the payload (not in the scope) read as None.
+    """
+
+    __slots__ = ("_raw", "_parsed")
+
+    # Personal
+    uinfin = _Field(Attribute)
+    name = _Field(Attribute)
+    sex = _Field(Attribute)
+    race = _Field(Attribute)
+    dob = _Field(Attribute)
+    residentialstatus = _Field(Attribute)
+    nationality = _Field(Attribute)
+    birthcountry = _Field(Attribute)
+    passtype = _Field(Attribute)
+    passstatus = _Field(Attribute)
+    passexpirydate = _Field(Attribute)
+    employmentsector = _Field(Attribute)
+    mobileno = _Field(MobileNo)
+    email = _Field(Attribute)
+    regadd = _Field(Address)
+    housingtype = _Field(Attribute)
+    hdbtype = _Field(Attribute)
+    # Finance
+    cpfcontributions = _Field(CPFContributions)
+    noahistory = _Field(NOAHistory)
+    ownerprivate = _Field(Attribute)
+    # Education & employment
+    employment = _Field(Attribute)
+    occupation = _Field(Attribute)
+    cpfemployers = _Field(CPFEmployers)
+    # Family
+    marital = _Field(Attribute)
+
+    def __init__(self, data: Optional[dict] = None, raw: Optional[str] = None):
+        if data is None and raw is None:
+            raise ValueError("Person needs its data or its JSON")
+        self._parsed = data
+        self._raw = raw
+
+    @classmethod
+    def from_json(cls, raw: Union[str, bytes]) -> "Person":
+        if isinstance(raw, bytes):
+            raw = raw.decode()
+        return cls(raw=raw)
+
+    @property
+    def _data(self) -> Dict[str, dict]:
+        if self._parsed is None:
+            self._parsed = json.loads(self._raw)
+        return self._parsed
+
+    def to_dict(self) -> Dict[str, dict]:
+        return self._data
+
+    def to_json(self) -> str:
+        """
+        Returns the payload as received when there is one, serialized otherwise.
+        """
+        if self._raw is None:
+            self._raw = json.dumps(self._parsed, separators=(",", ":"))
+        return self._raw
+
+    def __getitem__(self, name: str) -> dict:
+        return self._data[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __eq__(self, other):
+        return isinstance(other, Person) and other._data == self._data
+
+    def __reduce__(self):
+        # pickles (cache, process pool) carry the JSON only
+        return Person.from_json, (self.to_json(),)
+
+
+def decrypt_person(encrypted_data: str, deadline: Optional[Deadline] = None) -> Person:
+    """
+    Decrypts and verifies the person JWE, leaving the payload unparsed until it is read.
+    """
+    return Person.from_json(decrypt_jwe_payload(encrypted_data, deadline))
@@ -0,0 +1,419 @@
+"""
+Retries and circuit breakers for the calls to Myinfo.
+
+Idempotent calls (JWKS documents, person data) are retried on connection errors, timeouts and
+transient statuses, after a jittered exponential backoff. The token exchange is never retried:
+auth codes are single-use.
+
+Each upstream endpoint has a circuit breaker. After `failure_threshold` consecutive failures it
+opens and calls fail fast with CircuitOpenError for `recovery_timeout` seconds, instead of tying up
+workers on a degraded upstream. Then one probe call is let through (half-open): its success closes
+the breaker, its failure opens it again.
+
+Each endpoint also has a Bulkhead limiting its concurrent calls, so that a slow endpoint holds at
+most its own share of the worker threads: callers over the limit wait briefly for a slot, then fail
+fast with BulkheadFullError.
+
+A flow has an end-to-end Deadline that each of its upstream calls draws from: their timeouts are
+capped at the remaining budget, and a call the budget can no longer cover is not started.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+import httpx
+import requests
+from myinfo import metrics
+from myinfo import settings as myinfo_settings
+
+log = logging.getLogger(__name__)
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+# values of the myinfo_circuit_breaker_state gauge
+BREAKER_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, endpoint: str, retry_after: float):
+        super().__init__(f"Circuit breaker for Myinfo {endpoint} is open")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage: str):
+        super().__init__(f"Deadline exceeded before Myinfo {stage} completed")
+        self.stage = stage
+
+
+class Deadline(object):
+    """
+    Time budget of a whole flow, e.g. the callback. `min_call` is the least time worth starting an
+    upstream call with.
+    """
+
+    def __init__(self, budget: float, min_call: Optional[float] = None):
+        self.budget = budget
+        self.min_call = myinfo_settings.MYINFO_MIN_CALL_BUDGET if min_call is None else min_call
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    @property
+    def expired(self) -> bool:
+        return self.expires_at <= time.monotonic()
+
+    def check(self, stage: str) -> None:
+        """
+        Raises:
+            DeadlineExceeded: when the remaining budget can't cover `stage`.
+        """
+        if self.remaining() < self.min_call:
+            metrics.DEADLINE_EXCEEDED.inc(stage=stage)
+            raise DeadlineExceeded(stage)
+
+    def get_timeout(self, connect_timeout: float, read_timeout: float) -> tuple:
+        """
+        Returns the (connect, read) timeouts capped at the remaining budget.
+        """
+        remaining = self.remaining()
+        return min(connect_timeout, remaining), min(read_timeout, remaining)
+
+
+class BulkheadFullError(Exception):
+    def __init__(self, endpoint: str):
+        super().__init__(f"Too many concurrent calls to Myinfo {endpoint}")
+        self.endpoint = endpoint
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """
+    Returns whether `exc` is a transient upstream failure, for both requests and httpx.
+    """
+    if isinstance(exc, CircuitOpenError):
+        return False
+    response = getattr(exc, "response", None)
+    if response is not None:
+        return response.status_code in RETRY_STATUSES
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout, httpx.TransportError))
+
+
+class CircuitBreaker(object):
+    def __init__(
+        self,
+        endpoint: str,
+        failure_threshold: Optional[int] = None,
+        recovery_timeout: Optional[float] = None,
+    ):
+        self.endpoint = endpoint
+        self.failure_threshold = (
+            myinfo_settings.MYINFO_BREAKER_FAILURE_THRESHOLD
+            if failure_threshold is None
+            else failure_threshold
+        )
+        self.recovery_timeout = (
+            myinfo_settings.MYINFO_BREAKER_RECOVERY_TIMEOUT
+            if recovery_timeout is None
+            else recovery_timeout
+        )
+        self.failures = 0
+        self.opened_at = 0.0
+        self._state = CLOSED
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self.opened_at >= self.recovery_timeout:
+            return HALF_OPEN
+        return self._state
+
+    def before_call(self) -> bool:
+        """
+        Returns whether the call is the probe of a half-open breaker. A probe must end with
+        `record_success`, `record_failure` or `release_probe`.
+
+        Raises:
+            CircuitOpenError: when the breaker is open, or half-open with a probe in flight.
+        """
+        if self._state == CLOSED:
+            return False
+        with self._lock:
+            state = self.state
+            if state == HALF_OPEN and not self._probing:
+                self._state = HALF_OPEN
+                self._probing = True
+                return True
+            if state == CLOSED:
+                return False
+        retry_after = max(self.opened_at + self.recovery_timeout - time.monotonic(), 0)
+        raise CircuitOpenError(self.endpoint, retry_after)
+
+    def record_success(self) -> None:
+        if self._state == CLOSED and not self.failures:
+            return
+        with self._lock:
+            if self._state != CLOSED:
+                log.info("Circuit breaker for Myinfo %s closed", self.endpoint)
+            self._state = CLOSED
+            self._probing = False
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    log.warning(
+                        "Circuit breaker for Myinfo %s opened after %d failures",
+                        self.endpoint,
+                        self.failures,
+                    )
+                self._state = OPEN
+                self._probing = False
+                self.opened_at = time.monotonic()
+
+    def release_probe(self) -> None:
+        """
+        Gives up the probe of a call that ended without an outcome (cut short by its own deadline,
+        cancelled), so that the next call probes instead.
+        """
+        with self._lock:
+            if self._probing:
+                self._probing = False
+                if self._state == HALF_OPEN:
+                    self._state = OPEN
+
+    def record_status(self, status_code: int) -> None:
+        """
+        Records the response of a call. Statuses other than transient ones (e.g. a 400) mean the
+        upstream is up, and count as successes.
+        """
+        if status_code in RETRY_STATUSES:
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._state = CLOSED
+            self._probing = False
+            self.failures = 0
+            self.opened_at = 0.0
+
+
+class Bulkhead(object):
+    """
+    Limits the concurrent calls to one endpoint to `max_concurrent` (no limit when 0), for the
+    threads and the coroutines of the process alike. A caller over the limit waits up to
+    `max_wait` seconds for a slot.
+    """
+
+    poll_interval = 0.005
+
+    def __init__(
+        self,
+        endpoint: str,
+        max_concurrent: Optional[int] = None,
+        max_wait: Optional[float] = None,
+    ):
+        self.endpoint = endpoint
+        self.max_concurrent = (
+            get_bulkhead_limit(endpoint) if max_concurrent is None else max_concurrent
+        )
+        self.max_wait = myinfo_settings.MYINFO_BULKHEAD_MAX_WAIT if max_wait is None else max_wait
+        self.in_flight = 0
+        self._semaphore = threading.BoundedSemaphore(self.max_concurrent or 1)
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline: Optional[Deadline] = None) -> None:
+        """
+        Raises:
+            BulkheadFullError: when no slot frees up within `max_wait`, or the `deadline`.
+        """
+        if not self.max_concurrent:
+            return self._count(1)
+        if not self._semaphore.acquire(timeout=self._get_wait(deadline)):
+            self._reject()
+        self._count(1)
+
+    async def aacquire(self, deadline: Optional[Deadline] = None) -> None:
+        """
+        Coroutine version of `acquire`, polling for a slot so that the event loop isn't blocked.
+        """
+        if not self.max_concurrent:
+            return self._count(1)
+        give_up_at = time.monotonic() + self._get_wait(deadline)
+        while not self._semaphore.acquire(blocking=False):
+            if time.monotonic() >= give_up_at:
+                self._reject()
+            await asyncio.sleep(self.poll_interval)
+        self._count(1)
+
+    def release(self) -> None:
+        self._count(-1)
+        if self.max_concurrent:
+            self._semaphore.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def _count(self, amount: int) -> None:
+        with self._lock:
+            self.in_flight += amount
+
+    def _get_wait(self, deadline: Optional[Deadline]) -> float:
+        if deadline is None:
+            return self.max_wait
+        return min(self.max_wait, deadline.remaining())
+
+    def _reject(self):
+        metrics.REJECTED_REQUESTS.inc(limiter=f"bulkhead_{self.endpoint}")
+        raise BulkheadFullError(self.endpoint)
+
+
+class RetryPolicy(object):
+    """
+    Up to `attempts` calls in total, waiting a random delay of up to `backoff * 2 ** retry`
+    seconds (capped at `backoff_max`) between them ("full jitter"), so that workers retrying after
+    the same upstream blip don't hit it again in lockstep. `attempts` is at least 1, which means
+    no retries.
+    """
+
+    def __init__(
+        self,
+        attempts: Optional[int] = None,
+        backoff: Optional[float] = None,
+        backoff_max: Optional[float] = None,
+    ):
+        attempts = myinfo_settings.MYINFO_RETRY_ATTEMPTS if attempts is None else attempts
+        # fewer would return None without calling `fn` at all
+        self.attempts = max(1, attempts)
+        self.backoff = myinfo_settings.MYINFO_RETRY_BACKOFF if backoff is None else backoff
+        self.backoff_max = (
+            myinfo_settings.MYINFO_RETRY_BACKOFF_MAX if backoff_max is None else backoff_max
+        )
+
+    def get_delay(self, retry: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** retry))
+
+    def call(self, endpoint: str, fn, *args, deadline: Optional[Deadline] = None):
+        """
+        Returns `fn(*args)`, calling it again on transient failures while `deadline` leaves time
+        for another attempt. `fn` must build its request from scratch, so that every attempt
+        carries a fresh DPoP proof.
+        """
+        for retry in range(self.attempts):
+            try:
+                return fn(*args)
+            except Exception as e:
+                if retry + 1 >= self.attempts or not is_retryable(e):
+                    raise
+                delay = self.get_delay(retry)
+                if deadline is not None and deadline.remaining() < delay + deadline.min_call:
+                    raise
+                log.warning("Retrying Myinfo %s in %.2fs: %r", endpoint, delay, e)
+            metrics.RETRIES.inc(endpoint=endpoint)
+            time.sleep(delay)
+
+    async def acall(self, endpoint: str, fn, *args, deadline: Optional[Deadline] = None):
+        """
+        Coroutine version of `call`, where `fn` is a coroutine function.
+        """
+        for retry in range(self.attempts):
+            try:
+                return await fn(*args)
+            except Exception as e:
+                if retry + 1 >= self.attempts or not is_retryable(e):
+                    raise
+                delay = self.get_delay(retry)
+                if deadline is not None and deadline.remaining() < delay + deadline.min_call:
+                    raise
+                log.warning("Retrying Myinfo %s in %.2fs: %r", endpoint, delay, e)
+            metrics.RETRIES.inc(endpoint=endpoint)
+            await asyncio.sleep(delay)
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(endpoint: str) -> CircuitBreaker:
+    """
+    Returns the process-wide circuit breaker of `endpoint` ("token", "person", "jwks", ...).
+    """
+    breaker = _breakers.get(endpoint)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(endpoint, CircuitBreaker(endpoint))
+    return breaker
+
+
+def reset_breakers() -> None:
+    for breaker in list(_breakers.values()):
+        breaker.reset()
+
+
+def get_bulkhead_limit(endpoint: str) -> int:
+    return myinfo_settings.MYINFO_BULKHEAD_LIMITS.get(
+        endpoint, myinfo_settings.MYINFO_BULKHEAD_DEFAULT_LIMIT
+    )
+
+
+_bulkheads: Dict[str, Bulkhead] = {}
+
+
+def get_bulkhead(endpoint: str) -> Bulkhead:
+    """
+    Returns the process-wide bulkhead of `endpoint`, sized by MYINFO_BULKHEAD_LIMITS.
+    """
+    bulkhead = _bulkheads.get(endpoint)
+    if bulkhead is None:
+        with _breakers_lock:
+            bulkhead = _bulkheads.setdefault(endpoint, Bulkhead(endpoint))
+    return bulkhead
+
+
+retry_policy = RetryPolicy()
+
+metrics.registry.register(
+    metrics.Gauge(
+        "myinfo_circuit_breaker_state",
+        "State of the circuit breaker of each Myinfo endpoint (0 closed, 1 half-open, 2 open).",
+        ["endpoint"],
+        callback=lambda: {
+            (endpoint,): BREAKER_STATE_VALUES[breaker.state]
+            for endpoint, breaker in _breakers.items()
+        },
+    )
+)
+metrics.registry.register(
+    metrics.Gauge(
+        "myinfo_circuit_breaker_failures",
+        "Consecutive transient failures counted by the circuit breaker of each Myinfo endpoint.",
+        ["endpoint"],
+        callback=lambda: {(endpoint,): breaker.failures for endpoint, breaker in _breakers.items()},
+    )
+)
+metrics.registry.register(
+    metrics.Gauge(
+        "myinfo_bulkhead_in_flight",
+        "Calls in flight to each Myinfo endpoint, against the limit of its bulkhead.",
+        ["endpoint"],
+        callback=lambda: {
+            (endpoint,): bulkhead.in_flight for endpoint, bulkhead in _bulkheads.items()
+        },
+    )
+)
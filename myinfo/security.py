@@ -1,14 +1,26 @@
+import asyncio
 import base64
+import collections
 import json
+import os
+import secrets
+import threading
 import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from hashlib import sha256
+from typing import Dict, Iterable, List, NamedTuple, Optional
 
-import requests
 import logging
+from myinfo import metrics
 from myinfo import settings as myinfo_settings
-# from django.core.cache import cache
-from django.utils.crypto import get_random_string
+from myinfo import resilience, transport
+from myinfo.cache import NEGATIVE, get_cache
+from myinfo.snapshot import JWKSSnapshot, get_jwks_snapshot
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
 from jwcrypto import jwe, jwk, jws
+from jwcrypto.common import base64url_decode
 from jwcrypto.jwk import JWK, JWKSet
 
 log = logging.getLogger(__name__)
@@ -27,18 +39,233 @@ def generate_code_challenge(code_verifier: str):
     return base64.urlsafe_b64encode(code_verifier_hash).decode().replace("=", "")
 
 
+def base64url_encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def encode_json_segment(data: dict) -> str:
+    """
+    Returns the base64url encoded compact JSON of `data`, as used for JWS header and payload.
+    """
+    return base64url_encode(json.dumps(data, separators=(",", ":")).encode())
+
+
+def generate_jti() -> str:
+    """
+    Returns a unique 40 characters string, used as the `jti` of client assertions and DPoP proofs.
+    """
+    return secrets.token_urlsafe(30)
+
+
+def sign_es256_compact(
+    private_key: ec.EllipticCurvePrivateKey, encoded_header: str, payload: dict
+) -> str:
+    """
+    Signs `payload` with ES256 and returns the JWS compact serialization.
+
+    `encoded_header` is the already encoded protected header, so that callers can build it once.
+    """
+    signing_input = f"{encoded_header}.{encode_json_segment(payload)}"
+    der_signature = private_key.sign(signing_input.encode(), ec.ECDSA(hashes.SHA256()))
+    r, s = decode_dss_signature(der_signature)
+    return f"{signing_input}.{base64url_encode(r.to_bytes(32, 'big') + s.to_bytes(32, 'big'))}"
+
+
 def generate_ephemeral_session_keypair() -> JWK:
     sig_jwk = jwk.JWK.generate(kty="EC", crv="P-256", alg="ES256", use="sig")
     return sig_jwk
 
 
+class EphemeralKeypairPool(object):
+    """
+    Bounded pool of pre-generated, single-use session ephemeral keypairs.
+
+    `take()` pops a keypair in O(1). Whenever the pool drops below `low_watermark`, a background
+    thread refills it up to `size`; an empty pool falls back to inline generation. The pool is
+    emptied after a fork, so that no keypair is ever handed out by two processes.
+    """
+
+    def __init__(self, size: Optional[int] = None, low_watermark: Optional[int] = None):
+        self.size = myinfo_settings.MYINFO_KEYPAIR_POOL_SIZE if size is None else size
+        self.low_watermark = (
+            myinfo_settings.MYINFO_KEYPAIR_POOL_LOW_WATERMARK
+            if low_watermark is None
+            else low_watermark
+        )
+        self.hits = 0
+        self.misses = 0
+        self._keypairs = collections.deque()
+        self._refill = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = os.getpid()
+
+    def take(self) -> JWK:
+        self._check_fork()
+        try:
+            keypair = self._keypairs.popleft()
+            self.hits += 1
+            metrics.CACHE_REQUESTS.inc(cache="keypair_pool", result="hit")
+        except IndexError:
+            keypair = None
+            self.misses += 1
+            metrics.CACHE_REQUESTS.inc(cache="keypair_pool", result="miss")
+
+        if len(self._keypairs) < self.low_watermark:
+            self._start()
+            self._refill.set()
+        return keypair or generate_ephemeral_session_keypair()
+
+    def fill(self) -> None:
+        """
+        Generates keypairs until the pool is full.
+        """
+        self._check_fork()
+        while len(self._keypairs) < self.size:
+            self._keypairs.append(generate_ephemeral_session_keypair())
+
+    def stats(self) -> dict:
+        return {"size": len(self._keypairs), "hits": self.hits, "misses": self.misses}
+
+    def _check_fork(self) -> None:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._keypairs.clear()
+                    self._thread = None
+                    self._pid = os.getpid()
+
+    def _start(self) -> None:
+        if self._thread is not None or self.size <= 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="myinfo-keypair-pool", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._refill.wait()
+            self._refill.clear()
+            try:
+                self.fill()
+            except Exception:
+                log.exception("Failed to refill the ephemeral keypair pool")
+
+
+keypair_pool = EphemeralKeypairPool()
+
+metrics.registry.register(
+    metrics.Gauge(
+        "myinfo_keypair_pool_size",
+        "Pre-generated session ephemeral keypairs available in the pool.",
+        callback=lambda: len(keypair_pool._keypairs),
+    )
+)
+
+
+class PrivateKey(NamedTuple):
+    source: str
+    jwk: JWK
+    kid: str
+    protected_header: dict
+    encoded_header: str
+    # cryptography key object, only set for signing keys
+    op_key: Optional[ec.EllipticCurvePrivateKey]
+
+
+class PrivateKeyRegistry(object):
+    """
+    Parses and validates the client's private keys once per process.
+
+    Keys are read from the environment first and from `myinfo.settings` otherwise. The raw value is
+    compared on every lookup (a cheap string comparison), so a rotated key is picked up without a
+    restart, while an unchanged key never gets re-parsed.
+    """
+
+    KEY_USES = {
+        "MYINFO_PRIVATE_KEY_SIG": "sig",
+        "MYINFO_PRIVATE_KEY_ENC": "enc",
+    }
+
+    def __init__(self):
+        self._keys: Dict[str, PrivateKey] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_source(name: str) -> str:
+        # ansible vault somehow replaces double quotes with single quotes.
+        source = os.environ.get(name) or getattr(myinfo_settings, name)
+        return source.replace("'", '"')
+
+    def get(self, name: str) -> PrivateKey:
+        source = self.get_source(name)
+        key = self._keys.get(name)
+        if key is None or key.source != source:
+            key = self._load(name, source)
+        return key
+
+    @property
+    def signing_key(self) -> PrivateKey:
+        return self.get("MYINFO_PRIVATE_KEY_SIG")
+
+    @property
+    def encryption_key(self) -> PrivateKey:
+        return self.get("MYINFO_PRIVATE_KEY_ENC")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._keys.clear()
+
+    def _load(self, name: str, source: str) -> PrivateKey:
+        with self._lock:
+            key = self._keys.get(name)
+            if key is not None and key.source == source:
+                return key
+
+            private_jwk = jwk.JWK.from_json(source)
+            self.validate(name, private_jwk)
+            kid = private_jwk.thumbprint()
+            if self.KEY_USES[name] == "sig":
+                protected_header = {"typ": "JWT", "alg": "ES256", "kid": kid}
+                op_key = private_jwk.get_op_key("sign")
+            else:
+                protected_header = {"alg": private_jwk.get("alg", "ECDH-ES+A256KW"), "kid": kid}
+                op_key = None
+            key = PrivateKey(
+                source,
+                private_jwk,
+                kid,
+                protected_header,
+                encode_json_segment(protected_header),
+                op_key,
+            )
+            self._keys[name] = key
+            log.info("Loaded %s with kid %s", name, kid)
+            return key
+
+    def validate(self, name: str, private_jwk: JWK) -> None:
+        use = self.KEY_USES[name]
+        if private_jwk.get("kty") != "EC" or private_jwk.get("crv") != "P-256":
+            raise ValueError(f"{name} must be an EC P-256 key")
+        if not private_jwk.has_private:
+            raise ValueError(f"{name} must contain the private key")
+        if private_jwk.get("use", use) != use:
+            raise ValueError(f"{name} must be a '{use}' key")
+
+
+private_keys = PrivateKeyRegistry()
+
+
 def generate_client_assertion(url: str, jkt_thumbprint: str) -> str:
     """See https://api.singpass.gov.sg/library/myinfo/developers/clientassertion"""
     now = int(time.time())
     payload = {
         "sub": myinfo_settings.MYINFO_CLIENT_ID,
         # generate unique randomstring on every client_assertion for jti
-        "jti": get_random_string(40),
+        "jti": generate_jti(),
         "aud": url,
         "iss": myinfo_settings.MYINFO_CLIENT_ID,
         "iat": now,
@@ -47,13 +274,42 @@ def generate_client_assertion(url: str, jkt_thumbprint: str) -> str:
             "jkt": jkt_thumbprint,  # jkt thumbprint should match DPoP JWK used in the same request
         },
     }
-    jws_key = jwk.JWK.from_json(myinfo_settings.MYINFO_PRIVATE_KEY_SIG)
-    jws_token = jws.JWS(json.dumps(payload))
-    jws_token.add_signature(
-        jws_key, alg=None, protected={"typ": "JWT", "alg": "ES256", "kid": jws_key.thumbprint()}
-    )
-    sig = json.loads(jws_token.serialize())
-    return f'{sig["protected"]}.{sig["payload"]}.{sig["signature"]}'
+    signing_key = private_keys.signing_key
+    return sign_es256_compact(signing_key.op_key, signing_key.encoded_header, payload)
+
+
+class DPoPSigner(object):
+    """
+    Signs DPoP proofs with one session ephemeral keypair.
+
+    The thumbprint and the protected header (which embeds the public JWK) are computed once per
+    keypair, so every proof of the flow only costs a payload encoding and one ECDSA signature.
+    """
+
+    def __init__(self, session_ephemeral_keypair: JWK):
+        self.keypair = session_ephemeral_keypair
+        self.thumbprint = session_ephemeral_keypair.thumbprint()
+
+        jwk_public = session_ephemeral_keypair.export_public(as_dict=True)
+        jwk_public.update({"use": "sig", "alg": "ES256", "kid": self.thumbprint})
+        self._encoded_header = encode_json_segment(
+            {"typ": "dpop+jwt", "alg": "ES256", "jwk": jwk_public}
+        )
+        self._private_key = session_ephemeral_keypair.get_op_key("sign")
+
+    def sign(self, url: str, method="POST", ath=None) -> str:
+        now = int(time.time())
+        payload = {
+            "htu": url,
+            "htm": method,
+            # generate unique randomstring on every DPoP proof for jti
+            "jti": generate_jti(),
+            "iat": now,
+            "exp": now + 120,  # expiry of DPoP proof set to 2mins max
+        }
+        if ath:
+            payload["ath"] = ath  # add ath if passed in (required for /person call)
+        return sign_es256_compact(self._private_key, self._encoded_header, payload)
 
 
 def generate_dpop_header(url: str, session_ephemeral_keypair, method="POST", ath=None) -> str:
@@ -62,64 +318,533 @@ def generate_dpop_header(url: str, session_ephemeral_keypair, method="POST", ath
     prove legit possession of the access_token issued.
     See: https://api.singpass.gov.sg/library/myinfo/developers/dpop
     """
-    now = int(time.time())
-    payload = {
-        "htu": url,
-        "htm": method,
-        # generate unique randomstring on every client_assertion for jti
-        "jti": get_random_string(40),
-        "iat": now,
-        "exp": now + 120,  # expiry of client_assertion set to 2mins max
-    }
-    if ath:
-        payload["ath"] = ath  # add ath if passed in (required for /person call)
-
-    ephemeral_private_key = session_ephemeral_keypair.export_private()
-    jwk_public = session_ephemeral_keypair.export_public(as_dict=True)
-    jwk_public.update(
-        {
-            "use": "sig",
-            "alg": "ES256",
-            "kid": session_ephemeral_keypair.thumbprint(),
-        }
-    )
+    return DPoPSigner(session_ephemeral_keypair).sign(url, method=method, ath=ath)
 
-    jws_key = jwk.JWK.from_json(ephemeral_private_key)
-    jws_token = jws.JWS(json.dumps(payload))
-    jws_token.add_signature(
-        jws_key, alg=None, protected={"typ": "dpop+jwt", "alg": "ES256", "jwk": jwk_public}
-    )
-    sig = json.loads(jws_token.serialize())
-    return f'{sig["protected"]}.{sig["payload"]}.{sig["signature"]}'
 
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key into one execution per process.
+
+    The first caller (the leader) runs the function; the others wait for its result, or its
+    exception, instead of repeating the call. Threads use `do` and `submit`, coroutines use `ado`,
+    and they all share the same in-flight calls.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def in_flight(self, key: str) -> bool:
+        return key in self._calls
+
+    def do(self, key: str, fn, *args):
+        """
+        Returns the result of `fn(*args)`, or of the call already in flight for `key`.
+        """
+        future, leader = self._begin(key)
+        if not leader:
+            return future.result()
+        self._run(key, future, fn, args)
+        return future.result()
+
+    def submit(self, key: str, fn, *args) -> Future:
+        """
+        Starts `fn(*args)` in a background thread, unless a call for `key` is already in flight,
+        and returns the future of the call in flight.
+        """
+        future, leader = self._begin(key)
+        if leader:
+            threading.Thread(
+                target=self._run,
+                args=(key, future, fn, args),
+                name=f"{self.name}-single-flight",
+                daemon=True,
+            ).start()
+        return future
+
+    async def ado(self, key: str, fn, *args):
+        """
+        Coroutine version of `do`. The leader runs the blocking `fn` on the loop's default
+        executor, so the event loop keeps serving other requests meanwhile.
+        """
+        future, leader = self._begin(key)
+        if leader:
+            loop = asyncio.get_running_loop()
+            loop.run_in_executor(None, self._run, key, future, fn, args)
+        return await asyncio.wrap_future(future)
 
-def get_jwkset(key_url: str) -> JWKSet:
+    def _begin(self, key: str):
+        self._check_fork()
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                metrics.CACHE_REQUESTS.inc(cache=self.name, result="coalesced")
+                return future, False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def _run(self, key: str, future: Future, fn, args) -> None:
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                if self._calls.get(key) is future:
+                    del self._calls[key]
+
+    def _check_fork(self) -> None:
+        # the leaders of calls in flight in the parent process don't exist in a forked child
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._calls.clear()
+                    self._pid = os.getpid()
+
+
+class _JWKSEntry(NamedTuple):
+    jwkset: JWKSet
+    keys: Dict[str, JWK]
+    fetched_at: float
+    expires_at: float
+    stale_until: float
+
+
+class JWKSStore(object):
+    """
+    Process-wide cache of parsed Myinfo JWKS, indexed by `kid`.
+
+    Parsed sets are kept in memory for `ttl` seconds. The raw documents are also shared through the
+    "jwks" namespace of myinfo.cache so that other workers can skip the upstream call.
+    Only one fetch per URL is in flight per process; concurrent lookups wait for it. Fetches go
+    through the retries and the "jwks" circuit breaker of myinfo.resilience.
+    For `stale_ttl` seconds after expiry, the previous set keeps being served while one background
+    refresh runs, so that expiries never block a callback.
+    A lookup for an unknown `kid` forces one refresh from upstream, at most once every
+    `refresh_interval` seconds per URL, to pick up key rotations without hammering Myinfo. A kid
+    still unknown after a refresh is cached as such, so that other workers don't refresh for it.
+    With a `snapshot` (MYINFO_JWKS_SNAPSHOT_PATH), the processes of the host pick up each other's
+    documents from it, see myinfo.snapshot.
+    """
+
+    # seconds to wait for the snapshot lock, held only for a check and a write
+    snapshot_lock_timeout = 1.0
+
+    def __init__(
+        self,
+        ttl: Optional[int] = None,
+        refresh_interval: Optional[int] = None,
+        stale_ttl: Optional[int] = None,
+        snapshot: Optional[JWKSSnapshot] = None,
+    ):
+        self.ttl = myinfo_settings.MYINFO_JWKS_CACHE_TTL if ttl is None else ttl
+        self.refresh_interval = (
+            myinfo_settings.MYINFO_JWKS_REFRESH_INTERVAL
+            if refresh_interval is None
+            else refresh_interval
+        )
+        self.stale_ttl = myinfo_settings.MYINFO_JWKS_STALE_TTL if stale_ttl is None else stale_ttl
+        self.snapshot = get_jwks_snapshot() if snapshot is None else snapshot
+        self._entries: Dict[str, _JWKSEntry] = {}
+        self._flight = SingleFlight("jwks")
+
+    def get(
+        self,
+        key_url: str,
+        kid: Optional[str] = None,
+        deadline: Optional[resilience.Deadline] = None,
+    ) -> JWKSet:
+        """
+        Returns the JWKSet for `key_url`, refreshing it if `kid` is given but not in the set.
+
+        With a `deadline`, the wait for a fetch is capped at its remaining budget. The fetch itself
+        carries on with its own timeouts, and fills the store for the next lookups.
+
+        Raises:
+            myinfo.resilience.DeadlineExceeded: when the set isn't loaded within `deadline`.
+        """
+        entry = self._get_entry(key_url)
+        if entry is None:
+            entry = self._wait(deadline, key_url, self._load, key_url)
+
+        if kid is not None and kid not in entry.keys:
+            entry = self._wait(deadline, key_url, self._refresh_for_kid, key_url, kid)
+        return entry.jwkset
+
+    async def aget(self, key_url: str, kid: Optional[str] = None) -> JWKSet:
+        """
+        Coroutine version of `get`. Fetches run on the default executor and are shared with the
+        threads looking up the same URL.
+        """
+        entry = self._get_entry(key_url)
+        if entry is None:
+            entry = await self._flight.ado(key_url, self._load, key_url)
+
+        if kid is not None and kid not in entry.keys:
+            entry = await self._flight.ado(key_url, self._refresh_for_kid, key_url, kid)
+        return entry.jwkset
+
+    def get_key(
+        self, key_url: str, kid: str, deadline: Optional[resilience.Deadline] = None
+    ) -> Optional[JWK]:
+        self.get(key_url, kid=kid, deadline=deadline)
+        return self._entries[key_url].keys.get(kid)
+
+    def is_fresh(self, key_url: str) -> bool:
+        """
+        Returns whether `key_url` is loaded and unexpired, without counting a lookup.
+        """
+        if self.snapshot is not None:
+            self._sync_snapshot()
+        entry = self._entries.get(key_url)
+        return entry is not None and entry.expires_at > time.monotonic()
+
+    def revalidate(self, key_url: str) -> Future:
+        """
+        Refreshes `key_url` in the background, unless a fetch is already in flight.
+        """
+        future = self._flight.submit(key_url, self._revalidate, key_url)
+        future.add_done_callback(self._log_revalidate_error)
+        return future
+
+    @staticmethod
+    def _log_revalidate_error(future: Future) -> None:
+        if future.exception() is not None:
+            log.warning("Background JWKS refresh failed", exc_info=future.exception())
+
+    def clear(self) -> None:
+        self._entries.clear()
+        get_cache("jwks").clear_local()
+
+    def _wait(self, deadline: Optional[resilience.Deadline], key_url: str, fn, *args) -> _JWKSEntry:
+        if deadline is None:
+            return self._flight.do(key_url, fn, *args)
+        deadline.check("jwks")
+        future = self._flight.submit(key_url, fn, *args)
+        if not wait([future], timeout=deadline.remaining()).done:
+            metrics.DEADLINE_EXCEEDED.inc(stage="jwks")
+            raise resilience.DeadlineExceeded("jwks")
+        return future.result()
+
+    def _get_entry(self, key_url: str) -> Optional[_JWKSEntry]:
+        """
+        Returns the usable entry of `key_url`, or None when it must be loaded before use.
+        """
+        if self.snapshot is not None:
+            self._sync_snapshot()
+        now = time.monotonic()
+        entry = self._entries.get(key_url)
+        if entry is None or entry.stale_until <= now:
+            return None
+        if entry.expires_at <= now:
+            metrics.CACHE_REQUESTS.inc(cache="jwks", result="stale")
+            if not self._flight.in_flight(key_url):
+                self.revalidate(key_url)
+        else:
+            metrics.CACHE_REQUESTS.inc(cache="jwks", result="hit")
+        return entry
+
+    def _load(self, key_url: str) -> _JWKSEntry:
+        entry = self._entries.get(key_url)
+        if entry is not None and entry.expires_at > time.monotonic():
+            # loaded by a call that completed while this one was starting
+            return entry
+        return self._revalidate(key_url)
+
+    def _revalidate(self, key_url: str) -> _JWKSEntry:
+        entry = self._get_snapshot_entry(key_url)
+        if entry is not None:
+            return entry
+        shared = self._get_shared(key_url)
+        if shared is not None:
+            fetched_at, keys_data = shared
+            age = max(time.time() - fetched_at, 0)
+            if age < self.ttl:
+                metrics.CACHE_REQUESTS.inc(cache="jwks", result="shared")
+                return self._store(key_url, keys_data, ttl=self.ttl - age)
+        metrics.CACHE_REQUESTS.inc(cache="jwks", result="miss")
+        return self._fetch(key_url)
+
+    def _refresh_for_kid(self, key_url: str, kid: str) -> _JWKSEntry:
+        entry = self._entries.get(key_url)
+        if entry is None:
+            return self._load(key_url)
+        if kid in entry.keys or time.monotonic() - entry.fetched_at < self.refresh_interval:
+            return entry
+        # another worker already refreshed without finding this kid
+        unknown_kid_key = f"{key_url}#{kid}"
+        if get_cache("jwks").get(unknown_kid_key) is NEGATIVE:
+            return entry
+
+        log.info("Unknown kid %s for %s, refreshing JWKS", kid, key_url)
+        metrics.CACHE_REQUESTS.inc(cache="jwks", result="refresh")
+        entry = self._fetch(key_url)
+        if kid not in entry.keys:
+            get_cache("jwks").set_negative(unknown_kid_key)
+        return entry
+
+    def _fetch(self, key_url: str) -> _JWKSEntry:
+        requested_at = time.time()
+        keys_data = resilience.retry_policy.call("jwks", self._request, key_url)
+        if self.snapshot is not None:
+            # only the check and the write hold the lock, so that fetches never wait for it
+            with self.snapshot.locked(self.snapshot_lock_timeout) as locked:
+                if locked:
+                    # fetched by another process meanwhile: use the document they all see
+                    entry = self._get_snapshot_entry(key_url, fetched_after=requested_at)
+                    if entry is not None:
+                        return entry
+                    self.snapshot.write(key_url, time.time(), keys_data)
+        entry = self._store(key_url, keys_data, ttl=self.ttl)
+        self._set_shared(key_url, keys_data)
+        return entry
+
+    @staticmethod
+    def _request(key_url: str) -> str:
+        breaker = resilience.get_breaker("jwks")
+        with resilience.get_bulkhead("jwks"):
+            breaker.before_call()
+            with metrics.STAGE_DURATION.time(stage="jwks_fetch"):
+                try:
+                    response = transport.get_session().get(
+                        key_url, timeout=transport.get_timeout()
+                    )
+                except Exception:
+                    metrics.UPSTREAM_RESPONSES.inc(endpoint="jwks", status="error")
+                    breaker.record_failure()
+                    raise
+        metrics.UPSTREAM_RESPONSES.inc(endpoint="jwks", status=response.status_code)
+        breaker.record_status(response.status_code)
+        response.raise_for_status()
+        return response.text
+
+    def _store(self, key_url: str, keys_data: str, ttl: float) -> _JWKSEntry:
+        jwkset = JWKSet.from_json(keys_data)
+        keys = {key["kid"]: key for key in jwkset["keys"] if "kid" in key}
+        now = time.monotonic()
+        entry = _JWKSEntry(jwkset, keys, now, now + ttl, now + ttl + self.stale_ttl)
+        self._entries[key_url] = entry
+        return entry
+
+    def _sync_snapshot(self) -> None:
+        """
+        Loads the documents written to the snapshot by other processes since the last check.
+        """
+        documents = self.snapshot.read_if_changed()
+        for key_url, (fetched_at, keys_data) in (documents or {}).items():
+            age = max(time.time() - fetched_at, 0)
+            if age < self.ttl:
+                metrics.CACHE_REQUESTS.inc(cache="jwks", result="snapshot")
+                self._store(key_url, keys_data, ttl=self.ttl - age)
+
+    def _get_snapshot_entry(self, key_url: str, fetched_after: float = 0) -> Optional[_JWKSEntry]:
+        if self.snapshot is None:
+            return None
+        result = self.snapshot.read()
+        document = result[1].get(key_url) if result is not None else None
+        if document is None:
+            return None
+        fetched_at, keys_data = document
+        age = max(time.time() - fetched_at, 0)
+        if age >= self.ttl or fetched_at < fetched_after:
+            return None
+        metrics.CACHE_REQUESTS.inc(cache="jwks", result="snapshot")
+        return self._store(key_url, keys_data, ttl=self.ttl - age)
+
+    def _get_shared(self, key_url: str):
+        shared = get_cache("jwks").get(key_url)
+        return shared if shared is not NEGATIVE else None
+
+    def _set_shared(self, key_url: str, keys_data: str) -> None:
+        get_cache("jwks").set(key_url, (time.time(), keys_data), self.ttl)
+
+
+jwks_store = JWKSStore()
+
+
+def get_jwkset(
+    key_url: str, kid: Optional[str] = None, deadline: Optional[resilience.Deadline] = None
+) -> JWKSet:
     """
     Retrieval of Myinfo JWKS should be cached for at least one hour and not retrieved for every JWT validation
     Reference: https://api.singpass.gov.sg/library/myinfo/developers/implementation-technical-requirements
     """
-    # TODO: configure CACHES backend in Django
-    # cache_key = f"myinfo::jwkset::{key_url}"
-    # keys_data = cache.get(cache_key)
-    # if keys_data is None:
-    #     keys_data = requests.get(key_url).text
-    #     cache.set(cache_key, keys_data, 3600)
+    return jwks_store.get(key_url, kid=kid, deadline=deadline)
 
-    keys_data = requests.get(key_url).text
-    return JWKSet.from_json(keys_data)
+
+def get_jws_kid(raw_data: str) -> Optional[str]:
+    """
+    Returns the `kid` from the protected header of a compact JWS, without verifying it.
+    """
+    try:
+        header = json.loads(base64url_decode(raw_data.split(".", 1)[0]))
+    except ValueError:
+        return None
+    return header.get("kid") if isinstance(header, dict) else None
 
 
 def verify_jws(raw_data: str, jwkset: JWKSet) -> dict:
+    return json.loads(verify_jws_payload(raw_data, jwkset))
+
+
+def verify_jws_payload(raw_data: str, jwkset: JWKSet) -> str:
+    """
+    Returns the verified payload of `raw_data`, as sent.
+    """
     token = jws.JWS.from_jose_token(raw_data)
     token.verify(jwkset)
-    return json.loads(token.payload.decode())
+    return token.payload.decode()
+
+
+def verify_jws_from_url(
+    raw_data: str, key_url: str, deadline: Optional[resilience.Deadline] = None
+) -> dict:
+    """
+    Verifies `raw_data` against the cached JWKS of `key_url`, waiting for it until `deadline`.
+    """
+    return verify_jws(raw_data, get_jwkset(key_url, kid=get_jws_kid(raw_data), deadline=deadline))
+
+
+def decrypt_jwe(encrypted_data: str, deadline: Optional[resilience.Deadline] = None) -> dict:
+    return json.loads(decrypt_jwe_payload(encrypted_data, deadline))
 
 
-def decrypt_jwe(encrypted_data: str) -> dict:
-    jwe_key = jwk.JWK.from_json(myinfo_settings.MYINFO_PRIVATE_KEY_ENC)
-    jwetoken = jwe.JWE()
-    jwetoken.deserialize(encrypted_data, key=jwe_key)
+def decrypt_jwe_payload(
+    encrypted_data: str, deadline: Optional[resilience.Deadline] = None
+) -> str:
+    """
+    Returns the verified JSON payload of the person JWE, unparsed. The verification keys are
+    waited for until `deadline`.
+    """
+    with metrics.STAGE_DURATION.time(stage="jwe_decrypt"):
+        jwetoken = jwe.JWE()
+        jwetoken.deserialize(encrypted_data, key=private_keys.encryption_key.jwk)
 
     # verify the signature of the decrypted JWS
-    jwkset = get_jwkset(myinfo_settings.MYINFO_JWKS_DATA_VERIFICATION_URL)
-    return verify_jws(jwetoken.payload.decode(), jwkset)
+    with metrics.STAGE_DURATION.time(stage="payload_verify"):
+        raw_data = jwetoken.payload.decode()
+        key_url = myinfo_settings.MYINFO_JWKS_DATA_VERIFICATION_URL
+        jwkset = get_jwkset(key_url, kid=get_jws_kid(raw_data), deadline=deadline)
+        return verify_jws_payload(raw_data, jwkset)
+
+
+class CryptoExecutor(object):
+    """
+    Runs the CPU-bound JWE decryption and JWS verification of the flow.
+
+    `mode` is one of:
+    - "inline": in the calling thread (async callers use the loop's default executor)
+    - "thread": on a thread pool, which keeps crypto off the event loop
+    - "process": on a process pool, which keeps crypto from holding the GIL of the web workers.
+      Each worker process has its own key registry and JWKS store, so tasks only carry the tokens
+      and must be picklable (module level functions).
+
+    Queue depth and latency (from submission to completion) are exposed by `stats()`.
+    """
+
+    MODES = ("inline", "thread", "process")
+
+    def __init__(self, mode: Optional[str] = None, max_workers: Optional[int] = None):
+        self.mode = mode or myinfo_settings.MYINFO_CRYPTO_EXECUTOR
+        if self.mode not in self.MODES:
+            raise ValueError(f"Unknown crypto executor mode {self.mode!r}")
+        self.max_workers = max_workers or myinfo_settings.MYINFO_CRYPTO_WORKERS
+        self.pending = 0
+        self.completed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+
+    def get_pool(self):
+        if self._pool is None or self._pool_pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pool_pid != os.getpid():
+                    if self.mode == "process":
+                        self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+                    else:
+                        self._pool = ThreadPoolExecutor(
+                            max_workers=self.max_workers, thread_name_prefix="myinfo-crypto"
+                        )
+                    self._pool_pid = os.getpid()
+        return self._pool
+
+    def submit(self, fn, *args) -> Future:
+        started_at = time.perf_counter()
+        with self._lock:
+            self.pending += 1
+
+        if self.mode == "inline":
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                self._record(started_at)
+            return future
+
+        future = self.get_pool().submit(fn, *args)
+        future.add_done_callback(lambda _: self._record(started_at))
+        return future
+
+    def run(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+    async def run_async(self, fn, *args):
+        if self.mode == "inline":
+            loop = asyncio.get_running_loop()
+            started_at = time.perf_counter()
+            with self._lock:
+                self.pending += 1
+            try:
+                return await loop.run_in_executor(None, fn, *args)
+            finally:
+                self._record(started_at)
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def decrypt_many(self, encrypted_data: Iterable[str]) -> List[dict]:
+        futures = [self.submit(decrypt_jwe, data) for data in encrypted_data]
+        return [future.result() for future in futures]
+
+    def verify_many(self, raw_data: Iterable[str], key_url: str) -> List[dict]:
+        futures = [self.submit(verify_jws_from_url, data, key_url) for data in raw_data]
+        return [future.result() for future in futures]
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "queue_depth": self.pending,
+            "completed": self.completed,
+            "avg_latency": self.total_latency / self.completed if self.completed else 0.0,
+            "max_latency": self.max_latency,
+        }
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.shutdown()
+            self._pool = None
+
+    def _record(self, started_at: float) -> None:
+        latency = time.perf_counter() - started_at
+        metrics.CRYPTO_TASK_DURATION.observe(latency)
+        with self._lock:
+            self.pending -= 1
+            self.completed += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+
+crypto_executor = CryptoExecutor()
+
+metrics.registry.register(
+    metrics.Gauge(
+        "myinfo_crypto_queue_depth",
+        "Tasks submitted to the crypto executor and not completed yet.",
+        callback=lambda: crypto_executor.pending,
+    )
+)
@@ -2,7 +2,47 @@ import os
 
 CERT_VERIFY = False
 
-MYINFO_DOMAIN = "https://test.api.myinfo.gov.sg"
+# =============== HTTP transport ===============
+# Connections kept alive per host, and number of hosts with a connection pool
+MYINFO_HTTP_POOL_MAXSIZE = int(os.environ.get("MYINFO_HTTP_POOL_MAXSIZE", 32))
+MYINFO_HTTP_POOL_CONNECTIONS = int(os.environ.get("MYINFO_HTTP_POOL_CONNECTIONS", 4))
+# Share one pooled session per process; disable to open a new session per client
+MYINFO_HTTP_POOLED = os.environ.get("MYINFO_HTTP_POOLED", "true").lower() == "true"
+MYINFO_CONNECT_TIMEOUT = float(os.environ.get("MYINFO_CONNECT_TIMEOUT", 5))
+MYINFO_READ_TIMEOUT = float(os.environ.get("MYINFO_READ_TIMEOUT", 30))
+# Calls in total to idempotent endpoints (JWKS, person) on transient failures (1 for no retries),
+# and the base and maximum seconds of the jittered exponential backoff between them
+MYINFO_RETRY_ATTEMPTS = int(os.environ.get("MYINFO_RETRY_ATTEMPTS", 3))
+MYINFO_RETRY_BACKOFF = float(os.environ.get("MYINFO_RETRY_BACKOFF", 0.2))
+MYINFO_RETRY_BACKOFF_MAX = float(os.environ.get("MYINFO_RETRY_BACKOFF_MAX", 2))
+# End-to-end seconds of a callback, shared by its upstream calls (the frontend gives up after ~15s),
+# and the least remaining seconds worth starting an upstream call with
+MYINFO_CALLBACK_BUDGET = float(os.environ.get("MYINFO_CALLBACK_BUDGET", 15))
+MYINFO_MIN_CALL_BUDGET = float(os.environ.get("MYINFO_MIN_CALL_BUDGET", 0.5))
+# Concurrent calls allowed per upstream endpoint ("token=16,person=16,jwks=4"; 0 for no limit), the
+# limit of the endpoints not listed, and seconds a call waits for a slot before failing fast
+MYINFO_BULKHEAD_LIMITS = {
+    endpoint.strip(): int(limit)
+    for endpoint, limit in (
+        item.split("=")
+        for item in os.environ.get("MYINFO_BULKHEAD_LIMITS", "token=16,person=16,jwks=4").split(",")
+        if item.strip()
+    )
+}
+MYINFO_BULKHEAD_DEFAULT_LIMIT = int(os.environ.get("MYINFO_BULKHEAD_DEFAULT_LIMIT", 16))
+MYINFO_BULKHEAD_MAX_WAIT = float(os.environ.get("MYINFO_BULKHEAD_MAX_WAIT", 1))
+# Load shedding of the callback views: past this many callbacks in flight in the process, or after
+# waiting this many seconds in the proxy/server queue (X-Request-Start), they get a fast 503 with a
+# Retry-After of MYINFO_SHED_RETRY_AFTER seconds. 0 disables either check.
+MYINFO_SHED_MAX_IN_FLIGHT = int(os.environ.get("MYINFO_SHED_MAX_IN_FLIGHT", 64))
+MYINFO_SHED_MAX_QUEUE_WAIT = float(os.environ.get("MYINFO_SHED_MAX_QUEUE_WAIT", 5))
+MYINFO_SHED_RETRY_AFTER = int(os.environ.get("MYINFO_SHED_RETRY_AFTER", 1))
+# Consecutive transient failures opening the circuit breaker of an endpoint, and seconds it stays
+# open before letting a probe call through
+MYINFO_BREAKER_FAILURE_THRESHOLD = int(os.environ.get("MYINFO_BREAKER_FAILURE_THRESHOLD", 5))
+MYINFO_BREAKER_RECOVERY_TIMEOUT = float(os.environ.get("MYINFO_BREAKER_RECOVERY_TIMEOUT", 30))
+
+MYINFO_DOMAIN = os.environ.get("MYINFO_DOMAIN", "https://test.api.myinfo.gov.sg")
 MYINFO_CLIENT_ID = "STG-202327956K-ABNK-BNPLAPPLN"
 
 # https://public.cloud.myinfo.gov.sg/myinfo/api/myinfo-kyc-v4.0.html#section/Authentication/OAuth2
@@ -23,9 +63,61 @@ MYINFO_SCOPE = (
     "marital"
 )
 
+# Named subsets of MYINFO_SCOPE, selected per login flow so that flows needing less than the whole
+# credit profile get smaller, faster person responses
+MYINFO_SCOPE_PROFILES = {
+    "identity": (
+        "uinfin name sex race dob residentialstatus nationality birthcountry "
+        "passtype passstatus passexpirydate mobileno email regadd"
+    ),
+    "credit": MYINFO_SCOPE,
+}
+MYINFO_DEFAULT_SCOPE_PROFILE = os.environ.get("MYINFO_DEFAULT_SCOPE_PROFILE", "credit")
+
 # =============== MYINFO API v4 ===============
-MYINFO_JWKS_TOKEN_VERIFICATION_URL = "https://test.authorise.singpass.gov.sg/.well-known/keys.json"
-MYINFO_JWKS_DATA_VERIFICATION_URL = "https://test.myinfo.singpass.gov.sg/.well-known/keys.json"
+MYINFO_JWKS_TOKEN_VERIFICATION_URL = os.environ.get(
+    "MYINFO_JWKS_TOKEN_VERIFICATION_URL", "https://test.authorise.singpass.gov.sg/.well-known/keys.json"
+)
+MYINFO_JWKS_DATA_VERIFICATION_URL = os.environ.get(
+    "MYINFO_JWKS_DATA_VERIFICATION_URL", "https://test.myinfo.singpass.gov.sg/.well-known/keys.json"
+)
+# Retrieval of Myinfo JWKS should be cached for at least one hour
+MYINFO_JWKS_CACHE_TTL = int(os.environ.get("MYINFO_JWKS_CACHE_TTL", 3600))
+# Minimum seconds between forced JWKS refreshes triggered by an unknown `kid`
+MYINFO_JWKS_REFRESH_INTERVAL = int(os.environ.get("MYINFO_JWKS_REFRESH_INTERVAL", 60))
+# Seconds an expired JWKS keeps being served while it is refreshed in the background
+MYINFO_JWKS_STALE_TTL = int(os.environ.get("MYINFO_JWKS_STALE_TTL", 600))
+# Memory-mapped file (e.g. /dev/shm/myinfo-jwks) through which the processes of a host share the
+# JWKS documents, so that only one of them fetches each one. Empty to fetch in each process
+MYINFO_JWKS_SNAPSHOT_PATH = os.environ.get("MYINFO_JWKS_SNAPSHOT_PATH", "")
+MYINFO_JWKS_SNAPSHOT_SIZE = int(os.environ.get("MYINFO_JWKS_SNAPSHOT_SIZE", 65536))
+# Seconds an in-flight login flow (state and session keypair) is kept between /auth and /callback
+MYINFO_FLOW_STATE_TTL = int(os.environ.get("MYINFO_FLOW_STATE_TTL", 600))
+# Seconds the result of a callback is kept to answer duplicate deliveries of the same auth code
+MYINFO_IDEMPOTENCY_TTL = int(os.environ.get("MYINFO_IDEMPOTENCY_TTL", 300))
+# Seconds a duplicate callback waits for the first one with the same auth code to complete, at most
+# MYINFO_CALLBACK_BUDGET: past it, the frontend has given up on the duplicate too
+MYINFO_IDEMPOTENCY_WAIT = float(
+    os.environ.get("MYINFO_IDEMPOTENCY_WAIT", MYINFO_CALLBACK_BUDGET)
+)
+# Entries of the in-process (L1) cache in front of the Django cache, per namespace
+MYINFO_L1_CACHE_MAXSIZE = int(os.environ.get("MYINFO_L1_CACHE_MAXSIZE", 1024))
+# Pre-generated session ephemeral keypairs, refilled in the background below the low watermark.
+# Set the size to 0 to generate every keypair inline.
+MYINFO_KEYPAIR_POOL_SIZE = int(os.environ.get("MYINFO_KEYPAIR_POOL_SIZE", 32))
+MYINFO_KEYPAIR_POOL_LOW_WATERMARK = int(os.environ.get("MYINFO_KEYPAIR_POOL_LOW_WATERMARK", 8))
+# Prefetch both JWKS documents in the background while the token exchange is in flight
+MYINFO_CONCURRENT_RETRIEVE = (
+    os.environ.get("MYINFO_CONCURRENT_RETRIEVE", "true").lower() == "true"
+)
+MYINFO_PREFETCH_WORKERS = int(os.environ.get("MYINFO_PREFETCH_WORKERS", 4))
+# Where JWE decryption and JWS verification run: "inline", "thread" or "process"
+MYINFO_CRYPTO_EXECUTOR = os.environ.get("MYINFO_CRYPTO_EXECUTOR", "inline")
+MYINFO_CRYPTO_WORKERS = int(os.environ.get("MYINFO_CRYPTO_WORKERS", os.cpu_count() or 1))
+# Warm-up of each process before its first login (see myinfo.warmup): "true" runs all of it when
+# Django starts, "preload" only the steps that survive a fork (for gunicorn --preload, whose workers
+# run the rest from the post_fork hook in gunicorn.conf.py). Anything else disables it.
+MYINFO_WARMUP = os.environ.get("MYINFO_WARMUP", "false").lower()
 MYINFO_PURPOSE_ID = os.environ.get("MYINFO_PURPOSE_ID", "7ed6f2ce")
 # ansible vault somehow replaces double quotes with single quotes.
 # so we need to revert to double quotes.
@@ -0,0 +1,218 @@
+"""
+Snapshot of the Myinfo JWKS documents shared by the worker processes of a host, in a memory-mapped
+file (MYINFO_JWKS_SNAPSHOT_PATH, e.g. under /dev/shm).
+
+The process that fetches a document writes it to the snapshot, and the other processes load it from
+there instead of calling Myinfo, so that the upstream JWKS traffic doesn't grow with the number of
+workers. Writes hold an exclusive lock on the file, but fetches don't: a process that finds a
+document written since its fetch started uses it instead of its own, so that the processes serve
+the same one.
+
+Reads take no lock. The header carries a sequence number that is odd while a write is in progress
+and bumped by 2 by every write (a seqlock): readers retry while it is odd or when it changed during
+their read, and detect new documents by comparing it with the last one they saw, which costs a
+24-byte read.
+
+Without fcntl (Windows) or when the file can't be used, JWKSStore falls back to fetching in each
+process.
+"""
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+from contextlib import contextmanager
+from struct import Struct
+from typing import Dict, Optional, Tuple
+
+from myinfo import settings as myinfo_settings
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+# magic, format version, sequence, payload length
+_HEADER = Struct("=4sB3xQI")
+_MAGIC = b"MJWK"
+_VERSION = 1
+
+# key URL -> (fetched_at, raw document)
+Documents = Dict[str, Tuple[float, str]]
+
+
+class JWKSSnapshot(object):
+    """
+    Reader and writer of the snapshot file at `path`, mapped in `size` bytes.
+    """
+
+    poll_interval = 0.01
+    read_attempts = 100
+
+    def __init__(self, path: str, size: Optional[int] = None):
+        self.path = path
+        self.size = myinfo_settings.MYINFO_JWKS_SNAPSHOT_SIZE if size is None else size
+        self.seen_seq = 0
+        self._fd = None
+        self._mmap = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+
+    def read(self) -> Optional[Tuple[int, Documents]]:
+        """
+        Returns the sequence number and the documents of the snapshot, or None when it is empty,
+        unreadable or being written for too long.
+        """
+        mm = self._open()
+        if mm is None:
+            return None
+        for _ in range(self.read_attempts):
+            magic, version, seq, length = _HEADER.unpack_from(mm, 0)
+            if magic != _MAGIC or version != _VERSION:
+                return None
+            if seq % 2:
+                time.sleep(0)
+                continue
+            data = mm[_HEADER.size:_HEADER.size + length]
+            if _HEADER.unpack_from(mm, 0)[2] != seq:
+                continue
+            try:
+                documents = json.loads(data) if data else {}
+            except ValueError:
+                return None
+            return seq, {url: tuple(document) for url, document in documents.items()}
+        return None
+
+    def read_if_changed(self) -> Optional[Documents]:
+        """
+        Returns the documents if the snapshot was written since the last read of this process.
+        """
+        mm = self._open()
+        if mm is None or _HEADER.unpack_from(mm, 0)[2] == self.seen_seq:
+            return None
+        result = self.read()
+        if result is None:
+            return None
+        self.seen_seq, documents = result
+        return documents
+
+    @contextmanager
+    def locked(self, timeout: float):
+        """
+        Holds the write lock, for the threads of this process and across processes. Yields whether
+        it was acquired within `timeout` seconds.
+        """
+        if self._open() is None or not self._lock.acquire(timeout=timeout):
+            yield False
+            return
+        if not self._flock(timeout):
+            self._lock.release()
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._lock.release()
+
+    def write(self, key_url: str, fetched_at: float, keys_data: str) -> bool:
+        """
+        Adds or replaces the document of `key_url`. The caller must hold `locked()`.
+        """
+        mm = self._open()
+        if mm is None:
+            return False
+        result = self.read()
+        seq = _HEADER.unpack_from(mm, 0)[2]
+        # an odd sequence left by a writer that died mid-write is rounded up
+        seq += seq % 2
+        documents = result[1] if result is not None else {}
+        documents[key_url] = (fetched_at, keys_data)
+        data = json.dumps(documents, separators=(",", ":")).encode()
+        if _HEADER.size + len(data) > len(mm):
+            log.warning(
+                "JWKS snapshot needs %d bytes, more than the %d of %s",
+                _HEADER.size + len(data),
+                len(mm),
+                self.path,
+            )
+            return False
+
+        _HEADER.pack_into(mm, 0, _MAGIC, _VERSION, seq + 1, 0)
+        mm[_HEADER.size:_HEADER.size + len(data)] = data
+        _HEADER.pack_into(mm, 0, _MAGIC, _VERSION, seq + 2, len(data))
+        # this process already has what it wrote
+        self.seen_seq = seq + 2
+        return True
+
+    def _flock(self, timeout: float) -> bool:
+        give_up_at = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.monotonic() >= give_up_at:
+                    return False
+                time.sleep(self.poll_interval)
+            except OSError:
+                log.warning("Failed to lock the JWKS snapshot %s", self.path, exc_info=True)
+                return False
+
+    def close(self) -> None:
+        with self._open_lock:
+            self._close()
+
+    def _open(self) -> Optional[mmap.mmap]:
+        """
+        Maps the file once per process: an inherited descriptor would share its lock with the
+        parent process.
+        """
+        if self._pid == os.getpid():
+            return self._mmap
+        with self._open_lock:
+            if self._pid != os.getpid():
+                self._close()
+                self._lock = threading.Lock()
+                self._pid = os.getpid()
+                try:
+                    self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                    file_size = os.fstat(self._fd).st_size
+                    if file_size < self.size:
+                        os.ftruncate(self._fd, self.size)
+                    self._mmap = mmap.mmap(self._fd, max(file_size, self.size))
+                except OSError:
+                    log.warning(
+                        "JWKS snapshot %s unavailable, fetching JWKS per process",
+                        self.path,
+                        exc_info=True,
+                    )
+                    self._close()
+        return self._mmap
+
+    def _close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+        if self._fd is not None:
+            os.close(self._fd)
+        self._mmap = None
+        self._fd = None
+
+
+_snapshot: Optional[JWKSSnapshot] = None
+
+
+def get_jwks_snapshot() -> Optional[JWKSSnapshot]:
+    """
+    Returns the snapshot at MYINFO_JWKS_SNAPSHOT_PATH, or None when it isn't configured.
+    """
+    global _snapshot
+    if not myinfo_settings.MYINFO_JWKS_SNAPSHOT_PATH or fcntl is None:
+        return None
+    if _snapshot is None or _snapshot.path != myinfo_settings.MYINFO_JWKS_SNAPSHOT_PATH:
+        _snapshot = JWKSSnapshot(myinfo_settings.MYINFO_JWKS_SNAPSHOT_PATH)
+    return _snapshot
@@ -0,0 +1,33 @@
+import unittest
+
+from myinfo import benchmarks
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_run(self):
+        results = benchmarks.run(["code_challenge", "decrypt_jwe[default]"], repeat=2, min_time=0)
+
+        self.assertEqual(list(results), ["code_challenge", "decrypt_jwe[default]"])
+        self.assertEqual(results["decrypt_jwe[default]"]["rounds"], 2)
+        self.assertGreater(results["decrypt_jwe[default]"]["payload_bytes"], 0)
+        self.assertLessEqual(
+            results["code_challenge"]["min"], results["code_challenge"]["median"]
+        )
+
+    def test_compare(self):
+        baseline = {
+            "benchmarks": {
+                "verify_jws": {"median": 0.001},
+                "decrypt_jwe[default]": {"median": 0.001},
+            }
+        }
+        results = {
+            "verify_jws": {"median": 0.00115},
+            "decrypt_jwe[default]": {"median": 0.0013},
+            "dpop_proof": {"median": 0.5},
+        }
+
+        regressions = benchmarks.compare(results, baseline, threshold=0.2)
+
+        self.assertEqual([r.name for r in regressions], ["decrypt_jwe[default]"])
+        self.assertAlmostEqual(regressions[0].ratio, 1.3)
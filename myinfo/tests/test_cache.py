@@ -0,0 +1,122 @@
+import unittest
+from unittest.mock import Mock, patch
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.redis import RedisCache
+from redis.exceptions import ResponseError
+
+from myinfo.cache import NEGATIVE, LocalCache, TieredCache
+
+
+class TestLocalCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LocalCache(maxsize=2)
+        cache.set("a", 1, ttl=60)
+        cache.set("b", 2, ttl=60)
+        cache.get("a")
+        cache.set("c", 3, ttl=60)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_expires(self):
+        cache = LocalCache()
+        cache.set("a", 1, ttl=0)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+
+class TestTieredCache(unittest.TestCase):
+    def setUp(self):
+        self.shared = LocMemCache("test-tiered-cache", {})
+        self.shared.clear()
+        patcher = patch.object(TieredCache, "shared", self.shared)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_l2_hit_fills_l1(self):
+        writer = TieredCache("jwks", ttl=60)
+        reader = TieredCache("jwks", ttl=60)
+        writer.set("url", (1.0, "{}"))
+
+        self.assertEqual(reader.get("url"), (1.0, "{}"))
+        self.shared.clear()
+        self.assertEqual(reader.get("url"), (1.0, "{}"))
+        self.assertEqual(reader.stats()["l2_hits"], 1)
+        self.assertEqual(reader.stats()["l1_hits"], 1)
+        self.assertEqual(reader.stats()["hit_ratio"], 1.0)
+
+    def test_shared_only_namespace_skips_l1(self):
+        cache = TieredCache("flow", ttl=60, local=False)
+        cache.set("state", b"record")
+        self.shared.clear()
+
+        self.assertIsNone(cache.get("state"))
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_negative_caching(self):
+        writer = TieredCache("jwks", ttl=60)
+        reader = TieredCache("jwks", ttl=60)
+        writer.set_negative("url#unknown-kid")
+
+        self.assertIs(writer.get("url#unknown-kid"), NEGATIVE)
+        self.assertIs(reader.get("url#unknown-kid"), NEGATIVE)
+        self.assertEqual(reader.stats()["negative_hits"], 1)
+
+    def test_pop_once(self):
+        first = TieredCache("flow", ttl=60, local=False)
+        second = TieredCache("flow", ttl=60, local=False)
+        first.set("state", b"record")
+
+        self.assertEqual(second.pop("state"), b"record")
+        self.assertIsNone(first.pop("state"))
+
+
+class TestTieredCacheRedis(unittest.TestCase):
+    def setUp(self):
+        self.shared = RedisCache("redis://localhost:6379/0", {})
+        self.client = Mock()
+        patchers = (
+            patch.object(TieredCache, "shared", self.shared),
+            patch.object(self.shared._cache, "get_client", return_value=self.client),
+        )
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.cache = TieredCache("flow", ttl=60, local=False)
+        self.key = self.shared.make_and_validate_key("myinfo:flow:state")
+
+    def test_django_redis_internals(self):
+        # the private attributes `_redis_pop` relies on, which a Django upgrade may rename
+        shared = RedisCache("redis://localhost:6379/0", {})
+
+        self.assertTrue(callable(shared._cache.get_client))
+        self.assertTrue(callable(shared._cache._serializer.loads))
+
+    def test_pop_without_redis_internals(self):
+        self.client.get.return_value = self.shared._cache._serializer.dumps(b"record")
+        self.client.delete.return_value = 1
+
+        with patch("myinfo.cache._has_redis_internals", return_value=False):
+            self.assertEqual(self.cache.pop("state"), b"record")
+        self.client.getdel.assert_not_called()
+        self.client.delete.assert_called_once_with(self.key)
+
+    def test_pop_is_a_getdel(self):
+        self.client.getdel.side_effect = [self.shared._cache._serializer.dumps(b"record"), None]
+
+        self.assertEqual(self.cache.pop("state"), b"record")
+        self.assertIsNone(self.cache.pop("state"))
+        self.client.getdel.assert_called_with(self.key)
+
+    def test_pop_before_redis_6_2(self):
+        self.client.getdel.side_effect = ResponseError("unknown command 'GETDEL'")
+        pipeline = self.client.pipeline.return_value
+        pipeline.execute.return_value = [self.shared._cache._serializer.dumps(b"record"), 1]
+
+        self.assertEqual(self.cache.pop("state"), b"record")
+        self.client.pipeline.assert_called_once_with(transaction=True)
+        pipeline.get.assert_called_once_with(self.key)
+        pipeline.delete.assert_called_once_with(self.key)
@@ -1,6 +1,17 @@
 import unittest
+from unittest.mock import ANY, patch
 
-from myinfo.client import MyInfoPersonalClientV4
+import httpx
+import responses
+from myinfo import metrics
+from myinfo import settings as myinfo_settings
+from myinfo.client import AsyncMyInfoPersonalClientV4, MyInfoPersonalClientV4
+from myinfo.person import Person
+from myinfo.security import DPoPSigner, generate_ephemeral_session_keypair, jwks_store
+from myinfo.tests.test_security import (
+    SAMPLE_MYINFO_JWKS_DATA_VERIFICATION_DATA,
+    SAMPLE_MYINFO_JWKS_TOKEN_VERIFICATION_DATA,
+)
 
 
 class TestMyInfoPersonalClientV4(unittest.TestCase):
@@ -14,3 +25,162 @@ class TestMyInfoPersonalClientV4(unittest.TestCase):
             authorise_url,
             "https://test.api.myinfo.gov.sg/com/v4/authorize?client_id=STG-202327956K-ABNK-BNPLAPPLN&scope=uinfin%20name%20sex%20race%20dob%20residentialstatus%20nationality%20birthcountry%20passtype%20passstatus%20passexpirydate%20employmentsector%20mobileno%20email%20regadd%20housingtype%20hdbtype%20cpfcontributions%20noahistory%20ownerprivate%20employment%20occupation%20cpfemployers%20marital&purpose_id=7ed6f2ce&response_type=code&code_challenge=bKE9UspwyIPg8LsQHkJaiehiTeUdstI5JZOvaoQRgJA&code_challenge_method=S256&redirect_uri=https://backend.local.abnk.ai/myinfo/callback",  # noqa: E501
         )
+
+    def test_scope_profiles(self):
+        client = MyInfoPersonalClientV4()
+
+        self.assertEqual(client.get_scope(), myinfo_settings.MYINFO_SCOPE)
+        self.assertNotIn("cpfcontributions", client.get_scope("identity"))
+        with self.assertRaises(ValueError):
+            client.get_scope("everything")
+
+        _, _, params = client.build_person_request(
+            "token", {"sub": "abc"}, DPoPSigner(generate_ephemeral_session_keypair()), "identity"
+        )
+        self.assertEqual(params["scope"], myinfo_settings.MYINFO_SCOPE_PROFILES["identity"])
+
+
+class TestRetrieveResource(unittest.TestCase):
+    def setUp(self):
+        jwks_store.clear()
+        patcher = patch("myinfo.security.JWKSStore._get_shared", return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_responses(self):
+        responses.add(
+            responses.GET,
+            myinfo_settings.MYINFO_JWKS_TOKEN_VERIFICATION_URL,
+            body=SAMPLE_MYINFO_JWKS_TOKEN_VERIFICATION_DATA,
+            status=200,
+        )
+        responses.add(
+            responses.GET,
+            myinfo_settings.MYINFO_JWKS_DATA_VERIFICATION_URL,
+            body=SAMPLE_MYINFO_JWKS_DATA_VERIFICATION_DATA,
+            status=200,
+        )
+        responses.add(
+            responses.POST,
+            "https://test.api.myinfo.gov.sg/com/v4/token",
+            json={"access_token": "token"},
+            status=200,
+        )
+        responses.add(
+            responses.GET,
+            "https://test.api.myinfo.gov.sg/com/v4/person/abc/",
+            body="encrypted",
+            status=200,
+        )
+
+    @responses.activate
+    @patch("myinfo.client.decrypt_jwe", return_value={"uinfin": {"value": "S1234567D"}})
+    @patch("myinfo.client.MyInfoPersonalClientV4.verify_access_token", return_value={"sub": "abc"})
+    def test_concurrent_prefetches_jwks(self, mock_verify_access_token, mock_decrypt_jwe):
+        self.add_responses()
+        client = MyInfoPersonalClientV4()
+        futures = []
+        prefetch_jwks = client.prefetch_jwks
+
+        with patch.object(client, "prefetch_jwks", lambda: futures.extend(prefetch_jwks())):
+            person_data = client.retrieve_resource(
+                "auth-code", "abc123", "https://backend.local.abnk.ai/myinfo/callback", concurrent=True
+            )
+        for future in futures:
+            future.result()
+
+        self.assertEqual(person_data, {"uinfin": {"value": "S1234567D"}})
+        mock_decrypt_jwe.assert_called_once_with("encrypted", ANY)
+        called_urls = {call.request.url.split("?")[0] for call in responses.calls}
+        self.assertIn(myinfo_settings.MYINFO_JWKS_TOKEN_VERIFICATION_URL, called_urls)
+        self.assertIn(myinfo_settings.MYINFO_JWKS_DATA_VERIFICATION_URL, called_urls)
+
+    @responses.activate
+    def test_prefetch_skips_fresh_jwks(self):
+        self.add_responses()
+        client = MyInfoPersonalClientV4()
+        for future in client.prefetch_jwks():
+            future.result()
+        hits = metrics.CACHE_REQUESTS.get(cache="jwks", result="hit")
+
+        self.assertEqual(client.prefetch_jwks(), [])
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(metrics.CACHE_REQUESTS.get(cache="jwks", result="hit"), hits)
+
+    @responses.activate
+    @patch("myinfo.client.decrypt_jwe", return_value={"uinfin": {"value": "S1234567D"}})
+    @patch("myinfo.client.MyInfoPersonalClientV4.verify_access_token", return_value={"sub": "abc"})
+    def test_sequential(self, mock_verify_access_token, mock_decrypt_jwe):
+        self.add_responses()
+        client = MyInfoPersonalClientV4()
+
+        person_data = client.retrieve_resource(
+            "auth-code", "abc123", "https://backend.local.abnk.ai/myinfo/callback", concurrent=False
+        )
+
+        self.assertEqual(person_data, {"uinfin": {"value": "S1234567D"}})
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    @patch(
+        "myinfo.client.decrypt_person",
+        return_value=Person.from_json('{"uinfin":{"value":"S1234567D"}}'),
+    )
+    @patch("myinfo.client.MyInfoPersonalClientV4.verify_access_token", return_value={"sub": "abc"})
+    def test_as_person(self, mock_verify_access_token, mock_decrypt_person):
+        self.add_responses()
+        client = MyInfoPersonalClientV4()
+
+        person = client.retrieve_resource(
+            "auth-code", "abc123", "https://backend.local.abnk.ai/myinfo/callback", as_person=True
+        )
+
+        self.assertEqual(person.uinfin.value, "S1234567D")
+        mock_decrypt_person.assert_called_once_with("encrypted", ANY)
+
+
+class TestAsyncMyInfoPersonalClientV4(unittest.IsolatedAsyncioTestCase):
+    def get_client(self, handler):
+        http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        return AsyncMyInfoPersonalClientV4(http=http)
+
+    async def test_request(self):
+        def handler(request):
+            if request.url.path == "/json":
+                return httpx.Response(200, json={"ok": True})
+            if request.url.path == "/text":
+                return httpx.Response(200, text="encrypted")
+            return httpx.Response(401, text="unauthorized")
+
+        client = self.get_client(handler)
+
+        self.assertEqual(await client.request("https://myinfo.local/json"), {"ok": True})
+        self.assertEqual(await client.request("https://myinfo.local/text"), "encrypted")
+        with self.assertRaises(httpx.HTTPStatusError):
+            await client.request("https://myinfo.local/error")
+
+    @patch("myinfo.client.decrypt_jwe", return_value={"uinfin": {"value": "S1234567D"}})
+    @patch("myinfo.client.MyInfoPersonalClientV4.verify_access_token", return_value={"sub": "abc"})
+    async def test_retrieve_resource(self, mock_verify_access_token, mock_decrypt_jwe):
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            if request.url.path == "/com/v4/token":
+                return httpx.Response(200, json={"access_token": "token"})
+            return httpx.Response(200, text="encrypted")
+
+        client = self.get_client(handler)
+        person_data = await client.retrieve_resource(
+            "auth-code", "abc123", "https://backend.local.abnk.ai/myinfo/callback", concurrent=False
+        )
+
+        self.assertEqual(person_data, {"uinfin": {"value": "S1234567D"}})
+        mock_verify_access_token.assert_called_once_with("token", ANY)
+        mock_decrypt_jwe.assert_called_once_with("encrypted", ANY)
+        token_request, person_request = requests
+        self.assertEqual(token_request.method, "POST")
+        self.assertIn("DPoP", token_request.headers)
+        self.assertEqual(person_request.url.path, "/com/v4/person/abc/")
+        self.assertEqual(person_request.headers["Authorization"], "DPoP token")
+        self.assertIn("dpop", person_request.headers)
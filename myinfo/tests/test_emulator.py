@@ -0,0 +1,71 @@
+import unittest
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from myinfo.client import MyInfoPersonalClientV4
+from myinfo.emulator import build_persona, get_client_environ, start_emulator
+from myinfo.security import jwks_store
+
+CALLBACK_URL = "http://localhost:3001/callback"
+
+
+class TestMyInfoEmulator(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = start_emulator()
+        cls.settings_patcher = patch.multiple(
+            "myinfo.settings", **get_client_environ(cls.server.base_url)
+        )
+        cls.settings_patcher.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings_patcher.stop()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        jwks_store.clear()
+        patcher = patch("myinfo.security.JWKSStore._get_shared", return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def authorize(self, state: str) -> str:
+        authorise_url = MyInfoPersonalClientV4.get_authorise_url(state, CALLBACK_URL)
+        response = requests.get(authorise_url, allow_redirects=False)
+        self.assertEqual(response.status_code, 302)
+        location = response.headers["Location"]
+        self.assertTrue(location.startswith(CALLBACK_URL))
+        return parse_qs(urlparse(location).query)["code"][0]
+
+    def test_retrieve_resource(self):
+        code = self.authorize("abc123")
+
+        person_data = MyInfoPersonalClientV4().retrieve_resource(code, "abc123", CALLBACK_URL)
+
+        self.assertEqual(person_data, build_persona())
+
+    def test_auth_code_is_single_use(self):
+        code = self.authorize("abc123")
+        MyInfoPersonalClientV4().retrieve_resource(code, "abc123", CALLBACK_URL)
+
+        with self.assertRaises(requests.HTTPError) as cm:
+            MyInfoPersonalClientV4().retrieve_resource(code, "abc123", CALLBACK_URL)
+        self.assertEqual(cm.exception.response.json()["error"], "invalid_grant")
+
+    def test_code_verifier_is_checked(self):
+        code = self.authorize("abc123")
+
+        with self.assertRaises(requests.HTTPError) as cm:
+            MyInfoPersonalClientV4().retrieve_resource(code, "wrong-verifier", CALLBACK_URL)
+        self.assertEqual(cm.exception.response.json()["error"], "invalid_grant")
+
+    def test_error_injection(self):
+        self.server.emulator.error_rate = 1.0
+        self.addCleanup(setattr, self.server.emulator, "error_rate", 0.0)
+
+        authorise_url = MyInfoPersonalClientV4.get_authorise_url("abc123", CALLBACK_URL)
+        response = requests.get(authorise_url, allow_redirects=False)
+
+        self.assertEqual(response.status_code, 503)
@@ -0,0 +1,116 @@
+import json
+import math
+import unittest
+
+import numpy as np
+from myinfo.emulator import build_persona
+from myinfo.histories import (
+    Employers,
+    contribution_gaps,
+    employer_changes,
+    extract_histories,
+    monthly_income,
+    noa_delta,
+    parse_month,
+    rolling_income,
+)
+from myinfo.person import Person
+
+
+class TestHistories(unittest.TestCase):
+    def setUp(self):
+        self.persona = build_persona(history_months=15, noa_years=2)
+
+    def test_extract_single_profile(self):
+        histories = extract_histories(self.persona)
+
+        self.assertEqual(histories.size, 1)
+        self.assertEqual(len(histories.contributions.month), 15)
+        self.assertEqual(histories.contributions.month[0], parse_month("2022-10"))
+        self.assertEqual(histories.contributions.amount[1], 2045)
+        self.assertEqual(histories.employer_names, ["DBS BANK LTD", "OCBC BANK"])
+        self.assertEqual(len(histories.employers.month), 15)
+        self.assertEqual(histories.noas.year.tolist(), [2023, 2022])
+        self.assertEqual(histories.noas.amount.tolist(), [100000, 105000])
+
+    def test_extract_batch(self):
+        short = build_persona(history_months=3, noa_years=0)
+        del short["cpfemployers"]
+
+        histories = extract_histories(
+            [self.persona, Person.from_json(json.dumps(short)), {"uinfin": {"value": "S1"}}]
+        )
+
+        self.assertEqual(histories.size, 3)
+        self.assertEqual(np.bincount(histories.contributions.profile).tolist(), [15, 3])
+        self.assertEqual(np.bincount(histories.employers.profile).tolist(), [15])
+
+    def test_invalid_rows(self):
+        history = self.persona["cpfcontributions"]["history"]
+        history[0]["month"]["value"] = None
+        history[1]["amount"]["value"] = "n/a"
+
+        contributions = extract_histories(self.persona).contributions
+
+        self.assertEqual(len(contributions.month), 14)
+        self.assertTrue(math.isnan(contributions.amount[0]))
+
+    def test_monthly_and_rolling_income(self):
+        histories = extract_histories([self.persona, build_persona(history_months=2)])
+
+        income = monthly_income(histories.contributions, histories.size, months=4)
+
+        self.assertEqual(income.shape, (2, 4))
+        self.assertEqual(income[0].tolist(), [2065, 2035, 2045, 2055])
+        self.assertEqual(income[1].tolist(), [0, 0, 2035, 2045])
+        self.assertEqual(rolling_income(income, window=3).tolist(), [[6145, 6135], [2035, 4080]])
+        self.assertEqual(rolling_income(income, window=1).tolist(), income.tolist())
+        self.assertEqual(rolling_income(income, window=5).shape, (2, 0))
+        for window in (0, -1):
+            with self.assertRaises(ValueError):
+                rolling_income(income, window=window)
+
+        # aligned on a common month
+        income = monthly_income(
+            histories.contributions, histories.size, months=2, end_month=parse_month("2024-01")
+        )
+        self.assertEqual(income[:, -1].tolist(), [0, 0])
+
+    def test_contribution_gaps(self):
+        history = self.persona["cpfcontributions"]["history"]
+        del history[10:12]
+        histories = extract_histories([self.persona, {}])
+
+        income = monthly_income(histories.contributions, histories.size, months=15)
+
+        self.assertEqual(contribution_gaps(income).tolist(), [2, 15])
+
+    def test_employer_changes(self):
+        histories = extract_histories([self.persona, build_persona(history_months=6), {}])
+
+        changes = employer_changes(histories.employers, histories.size)
+
+        self.assertEqual(changes.tolist(), [2, 0, 0])
+
+    def test_concurrent_employers_are_not_changes(self):
+        # profile 0 paid by A and B for 3 months; profile 1 by A and B, then A, then A and C
+        employers = Employers(
+            np.array([0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1], dtype=np.int32),
+            np.array([1, 1, 2, 2, 3, 3, 1, 1, 2, 3, 3], dtype=np.int32),
+            np.array([1, 0, 0, 1, 1, 0, 0, 1, 0, 0, 2], dtype=np.int32),
+        )
+
+        changes = employer_changes(employers, 3)
+
+        self.assertEqual(changes.tolist(), [0, 2, 0])
+
+    def test_noa_delta(self):
+        histories = extract_histories(
+            [self.persona, build_persona(noa_years=1), build_persona(noa_years=3)]
+        )
+
+        delta = noa_delta(histories.noas, histories.size)
+
+        self.assertEqual(delta[0], -5000)
+        self.assertTrue(math.isnan(delta[1]))
+        self.assertEqual(delta[2], -5000)
@@ -0,0 +1,53 @@
+import unittest
+
+from myinfo.metrics import Counter, Gauge, Histogram, Registry
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self):
+        counter = Counter("myinfo_test_total", "Test counter.", ["endpoint", "status"])
+
+        counter.inc(endpoint="token", status=200)
+        counter.inc(endpoint="token", status=200)
+        counter.inc(endpoint="person", status=500)
+
+        self.assertEqual(counter.get(endpoint="token", status=200), 2)
+        self.assertEqual(
+            counter.render(),
+            "# HELP myinfo_test_total Test counter.\n"
+            "# TYPE myinfo_test_total counter\n"
+            'myinfo_test_total{endpoint="person",status="500"} 1\n'
+            'myinfo_test_total{endpoint="token",status="200"} 2',
+        )
+
+    def test_histogram(self):
+        histogram = Histogram("myinfo_test_seconds", "Test histogram.", ["stage"], buckets=(0.1, 1))
+
+        histogram.observe(0.05, stage="token_post")
+        histogram.observe(0.5, stage="token_post")
+        histogram.observe(5, stage="token_post")
+        with histogram.time(stage="keypair"):
+            pass
+
+        self.assertEqual(histogram.get_count(stage="token_post"), 3)
+        self.assertEqual(histogram.get_count(stage="keypair"), 1)
+        rendered = histogram.render()
+        self.assertIn('myinfo_test_seconds_bucket{stage="token_post",le="0.1"} 1', rendered)
+        self.assertIn('myinfo_test_seconds_bucket{stage="token_post",le="1.0"} 2', rendered)
+        self.assertIn('myinfo_test_seconds_bucket{stage="token_post",le="+Inf"} 3', rendered)
+        self.assertIn('myinfo_test_seconds_sum{stage="token_post"} 5.55', rendered)
+        self.assertIn('myinfo_test_seconds_count{stage="token_post"} 3', rendered)
+
+    def test_registry(self):
+        registry = Registry()
+        registry.register(Gauge("myinfo_test_size", "Test gauge.", callback=lambda: 3))
+        registry.register(Counter("myinfo_test_total", "Test counter."))
+
+        self.assertEqual(
+            registry.render(),
+            "# HELP myinfo_test_size Test gauge.\n"
+            "# TYPE myinfo_test_size gauge\n"
+            "myinfo_test_size 3\n"
+            "# HELP myinfo_test_total Test counter.\n"
+            "# TYPE myinfo_test_total counter\n",
+        )
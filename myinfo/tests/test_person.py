@@ -0,0 +1,97 @@
+import json
+import pickle
+import unittest
+
+import responses
+from myinfo import settings as myinfo_settings
+from myinfo.emulator import build_persona
+from myinfo.person import Attribute, CPFContribution, Person, decrypt_person
+from myinfo.tests.test_security import (
+    EXPECTED_PERSON_DECRYPTED,
+    SAMPLE_MYINFO_JWKS_DATA_VERIFICATION_DATA,
+    SAMPLE_PERSON_ENCRYPTED,
+)
+
+
+class TestPerson(unittest.TestCase):
+    def setUp(self):
+        self.data = build_persona(history_months=15, noa_years=2)
+        self.raw = json.dumps(self.data)
+
+    def test_attributes(self):
+        person = Person.from_json(self.raw)
+
+        self.assertEqual(person.uinfin.value, "S9812381D")
+        self.assertEqual(person.sex.code, "F")
+        self.assertEqual(person.sex.desc, "FEMALE")
+        self.assertEqual(person.dob.source, "1")
+        self.assertEqual(person.email.classification, "C")
+        self.assertEqual(person.mobileno.nbr, "97399245")
+        self.assertEqual(person.regadd.postal, "460102")
+        self.assertEqual(person.regadd.country.code, "SG")
+        self.assertIs(person.ownerprivate.value, False)
+        self.assertIsInstance(person.name, Attribute)
+
+    def test_missing_attribute(self):
+        person = Person({"uinfin": self.data["uinfin"]})
+
+        self.assertIsNone(person.cpfcontributions)
+        self.assertNotIn("cpfcontributions", person)
+
+    def test_histories(self):
+        person = Person(self.data)
+
+        history = person.cpfcontributions.history
+        self.assertEqual(len(history), 15)
+        self.assertIsInstance(history[0], CPFContribution)
+        self.assertEqual(history[0].month, "2022-10")
+        self.assertEqual(history[-1].amount, 2035 + 10 * (14 % 4))
+        self.assertEqual([entry.month for entry in history[-2:]], ["2023-11", "2023-12"])
+        self.assertEqual(person.cpfemployers.history[0].employer, "DBS BANK LTD")
+        self.assertEqual([noa.yearofassessment for noa in person.noahistory.noas], ["2023", "2022"])
+        # entries wrap the payload in place
+        self.assertIs(history[0].to_dict(), self.data["cpfcontributions"]["history"][0])
+
+    def test_json_is_parsed_on_first_access_only(self):
+        person = Person.from_json(self.raw.encode())
+
+        self.assertIsNone(person._parsed)
+        self.assertIs(person.to_json(), person.to_json())
+        self.assertEqual(person.to_json(), self.raw)
+        self.assertIsNone(person._parsed)
+
+        self.assertEqual(person["name"], self.data["name"])
+        self.assertEqual(person.to_dict(), self.data)
+
+    def test_to_json_from_dict(self):
+        person = Person(self.data)
+
+        self.assertEqual(json.loads(person.to_json()), self.data)
+
+    def test_pickle_carries_the_json(self):
+        person = Person(self.data)
+
+        restored = pickle.loads(pickle.dumps(person))
+
+        self.assertIsNone(restored._parsed)
+        self.assertEqual(restored, person)
+
+    def test_wrappers_are_slotted(self):
+        person = Person.from_json(self.raw)
+
+        for value in (person, person.name, person.cpfcontributions.history[0]):
+            self.assertFalse(hasattr(value, "__dict__"))
+
+    @responses.activate
+    def test_decrypt_person(self):
+        responses.add(
+            responses.GET,
+            myinfo_settings.MYINFO_JWKS_DATA_VERIFICATION_URL,
+            body=SAMPLE_MYINFO_JWKS_DATA_VERIFICATION_DATA,
+            status=200,
+        )
+
+        person = decrypt_person(SAMPLE_PERSON_ENCRYPTED)
+
+        self.assertEqual(person.to_dict(), EXPECTED_PERSON_DECRYPTED)
+        self.assertEqual(person.uinfin.value, EXPECTED_PERSON_DECRYPTED["uinfin"]["value"])
@@ -0,0 +1,422 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+import httpx
+import requests
+import responses
+from myinfo import metrics, resilience
+from myinfo import settings as myinfo_settings
+from myinfo.client import AsyncMyInfoPersonalClientV4, MyInfoPersonalClientV4
+from myinfo.resilience import (
+    Bulkhead,
+    BulkheadFullError,
+    CircuitBreaker,
+    CircuitOpenError,
+    Deadline,
+    DeadlineExceeded,
+    RetryPolicy,
+    is_retryable,
+)
+from myinfo.security import JWKSStore, generate_ephemeral_session_keypair
+from myinfo.tests.test_security import SAMPLE_MYINFO_JWKS_DATA_VERIFICATION_DATA
+
+PERSON_URL = "https://test.api.myinfo.gov.sg/com/v4/person/abc/"
+
+
+def http_error(status_code):
+    return requests.HTTPError(response=Mock(status_code=status_code))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker("person", failure_threshold=3, recovery_timeout=30)
+
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_status(200)
+        breaker.record_failure()
+        breaker.record_status(503)
+        breaker.before_call()
+        self.assertEqual(breaker.state, resilience.CLOSED)
+
+        breaker.record_failure()
+        self.assertEqual(breaker.state, resilience.OPEN)
+        with self.assertRaises(CircuitOpenError) as cm:
+            breaker.before_call()
+        self.assertGreater(cm.exception.retry_after, 29)
+
+    def test_client_errors_count_as_successes(self):
+        breaker = CircuitBreaker("token", failure_threshold=1)
+
+        breaker.record_status(400)
+        breaker.record_status(401)
+
+        self.assertEqual(breaker.state, resilience.CLOSED)
+
+    def test_half_open_lets_one_probe_through(self):
+        breaker = CircuitBreaker("person", failure_threshold=1, recovery_timeout=0.01)
+        breaker.record_failure()
+        time.sleep(0.02)
+        self.assertEqual(breaker.state, resilience.HALF_OPEN)
+
+        breaker.before_call()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+
+        breaker.record_status(200)
+        self.assertEqual(breaker.state, resilience.CLOSED)
+        breaker.before_call()
+
+    def test_failed_probe_opens_again(self):
+        breaker = CircuitBreaker("person", failure_threshold=5, recovery_timeout=0.01)
+        for _ in range(5):
+            breaker.record_failure()
+        time.sleep(0.02)
+
+        breaker.before_call()
+        breaker.record_failure()
+
+        self.assertEqual(breaker._state, resilience.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+
+    def test_released_probe_lets_the_next_call_probe(self):
+        breaker = CircuitBreaker("person", failure_threshold=1, recovery_timeout=0.01)
+        breaker.record_failure()
+        time.sleep(0.02)
+
+        self.assertTrue(breaker.before_call())
+        breaker.release_probe()
+
+        self.assertEqual(breaker.state, resilience.HALF_OPEN)
+        self.assertTrue(breaker.before_call())
+        self.assertEqual(breaker.failures, 1)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_is_retryable(self):
+        self.assertTrue(is_retryable(requests.ConnectionError()))
+        self.assertTrue(is_retryable(requests.Timeout()))
+        self.assertTrue(is_retryable(httpx.ConnectTimeout("timeout")))
+        self.assertTrue(is_retryable(http_error(503)))
+        self.assertFalse(is_retryable(http_error(400)))
+        self.assertFalse(is_retryable(CircuitOpenError("person", 1)))
+        self.assertFalse(is_retryable(ValueError()))
+
+    def test_delay_is_jittered_and_capped(self):
+        policy = RetryPolicy(attempts=3, backoff=1, backoff_max=3)
+
+        delays = [policy.get_delay(5) for _ in range(100)]
+
+        self.assertTrue(all(0 <= delay <= 3 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+    def test_retries_transient_failures(self):
+        policy = RetryPolicy(attempts=3, backoff=0)
+        fn = Mock(side_effect=[requests.ConnectionError(), http_error(503), "ok"])
+        retries = metrics.RETRIES.get(endpoint="test")
+
+        self.assertEqual(policy.call("test", fn, "arg"), "ok")
+
+        self.assertEqual(fn.call_count, 3)
+        fn.assert_called_with("arg")
+        self.assertEqual(metrics.RETRIES.get(endpoint="test"), retries + 2)
+
+    def test_gives_up(self):
+        policy = RetryPolicy(attempts=2, backoff=0)
+        fn = Mock(side_effect=http_error(503))
+
+        with self.assertRaises(requests.HTTPError):
+            policy.call("test", fn)
+        self.assertEqual(fn.call_count, 2)
+
+    def test_calls_at_least_once(self):
+        for attempts in (0, -1):
+            policy = RetryPolicy(attempts=attempts, backoff=0)
+            fn = Mock(side_effect=[requests.ConnectionError(), "ok"])
+
+            with self.assertRaises(requests.ConnectionError):
+                policy.call("test", fn)
+            self.assertEqual(policy.attempts, 1)
+            self.assertEqual(fn.call_count, 1)
+
+    def test_does_not_retry_permanent_failures(self):
+        policy = RetryPolicy(attempts=3, backoff=0)
+        fn = Mock(side_effect=http_error(400))
+
+        with self.assertRaises(requests.HTTPError):
+            policy.call("test", fn)
+        self.assertEqual(fn.call_count, 1)
+
+
+class TestDeadline(unittest.TestCase):
+    def test_timeouts_are_capped_at_the_remaining_budget(self):
+        deadline = Deadline(2, min_call=0.5)
+
+        connect_timeout, read_timeout = deadline.get_timeout(5, 30)
+
+        self.assertLessEqual(connect_timeout, 2)
+        self.assertLessEqual(read_timeout, 2)
+        self.assertGreater(read_timeout, 1.9)
+        self.assertEqual(Deadline(60).get_timeout(5, 30), (5, 30))
+
+    def test_check(self):
+        Deadline(1, min_call=0.5).check("token")
+
+        with self.assertRaises(DeadlineExceeded) as cm:
+            Deadline(0.4, min_call=0.5).check("token")
+        self.assertEqual(cm.exception.stage, "token")
+
+    def test_retries_stop_at_the_deadline(self):
+        policy = RetryPolicy(attempts=5, backoff=10, backoff_max=10)
+        fn = Mock(side_effect=requests.ConnectionError())
+
+        with patch.object(policy, "get_delay", return_value=2):
+            with self.assertRaises(requests.ConnectionError):
+                policy.call("test", fn, deadline=Deadline(1, min_call=0.5))
+        self.assertEqual(fn.call_count, 1)
+
+
+class TestBulkhead(unittest.TestCase):
+    def test_limits_concurrent_calls(self):
+        bulkhead = Bulkhead("person", max_concurrent=2, max_wait=0.01)
+
+        bulkhead.acquire()
+        bulkhead.acquire()
+        with self.assertRaises(BulkheadFullError):
+            bulkhead.acquire()
+        self.assertEqual(bulkhead.in_flight, 2)
+
+        bulkhead.release()
+        with bulkhead:
+            self.assertEqual(bulkhead.in_flight, 2)
+        self.assertEqual(bulkhead.in_flight, 1)
+
+    def test_waits_for_a_slot(self):
+        bulkhead = Bulkhead("person", max_concurrent=1, max_wait=5)
+        bulkhead.acquire()
+        timer = threading.Timer(0.05, bulkhead.release)
+        timer.start()
+
+        bulkhead.acquire()
+
+        self.assertEqual(bulkhead.in_flight, 1)
+
+    def test_wait_is_capped_at_the_deadline(self):
+        bulkhead = Bulkhead("person", max_concurrent=1, max_wait=5)
+        bulkhead.acquire()
+        started_at = time.monotonic()
+
+        with self.assertRaises(BulkheadFullError):
+            bulkhead.acquire(Deadline(0.05))
+        self.assertLess(time.monotonic() - started_at, 1)
+
+    def test_no_limit(self):
+        bulkhead = Bulkhead("person", max_concurrent=0)
+
+        for _ in range(100):
+            bulkhead.acquire()
+
+        self.assertEqual(bulkhead.in_flight, 100)
+
+
+class TestAsyncBulkhead(unittest.IsolatedAsyncioTestCase):
+    async def test_limits_concurrent_calls(self):
+        bulkhead = Bulkhead("person", max_concurrent=1, max_wait=0.02)
+
+        await bulkhead.aacquire()
+        with self.assertRaises(BulkheadFullError):
+            await bulkhead.aacquire()
+        bulkhead.release()
+        await bulkhead.aacquire()
+
+
+class TestClientResilience(unittest.TestCase):
+    def setUp(self):
+        resilience.reset_breakers()
+        self.addCleanup(resilience.reset_breakers)
+        patcher = patch.object(resilience.retry_policy, "backoff", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @responses.activate
+    @patch("myinfo.client.MyInfoPersonalClientV4.verify_access_token", return_value={"sub": "abc"})
+    def test_person_request_is_retried_with_a_fresh_dpop_proof(self, mock_verify_access_token):
+        responses.add(responses.GET, PERSON_URL, status=503)
+        responses.add(responses.GET, PERSON_URL, body="encrypted", status=200)
+
+        person_data = MyInfoPersonalClientV4().get_person_data(
+            "token", generate_ephemeral_session_keypair()
+        )
+
+        self.assertEqual(person_data, "encrypted")
+        first, second = [call.request.headers["dpop"] for call in responses.calls]
+        self.assertNotEqual(first, second)
+
+    @responses.activate
+    def test_token_request_is_not_retried(self):
+        responses.add(responses.POST, "https://test.api.myinfo.gov.sg/com/v4/token", status=503)
+
+        with self.assertRaises(requests.HTTPError):
+            MyInfoPersonalClientV4().get_access_token(
+                "auth-code",
+                "abc123",
+                "https://backend.local.abnk.ai/myinfo/callback",
+                generate_ephemeral_session_keypair(),
+            )
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_open_breaker_fails_fast(self):
+        responses.add(responses.GET, "https://myinfo.local/person", status=503)
+        breaker = resilience.get_breaker("person")
+
+        for _ in range(breaker.failure_threshold):
+            with self.assertRaises(requests.HTTPError):
+                MyInfoPersonalClientV4().request("https://myinfo.local/person", endpoint="person")
+        with self.assertRaises(CircuitOpenError):
+            MyInfoPersonalClientV4().request("https://myinfo.local/person", endpoint="person")
+
+        self.assertEqual(len(responses.calls), breaker.failure_threshold)
+        self.assertIn(
+            'myinfo_circuit_breaker_state{endpoint="person"} 2', metrics.registry.render()
+        )
+
+    @responses.activate
+    def test_exhausted_deadline_skips_the_call(self):
+        responses.add(responses.POST, "https://test.api.myinfo.gov.sg/com/v4/token", status=200)
+
+        with self.assertRaises(DeadlineExceeded):
+            MyInfoPersonalClientV4().retrieve_resource(
+                "auth-code",
+                "abc123",
+                "https://backend.local.abnk.ai/myinfo/callback",
+                concurrent=False,
+                session_ephemeral_keypair=generate_ephemeral_session_keypair(),
+                deadline=Deadline(0),
+            )
+        self.assertEqual(len(responses.calls), 0)
+
+    @responses.activate
+    def test_timeout_past_the_deadline(self):
+        responses.add(
+            responses.GET, "https://myinfo.local/person", body=requests.ReadTimeout()
+        )
+        deadline = Deadline(0.6, min_call=0.5)
+
+        with patch.object(deadline, "remaining", return_value=0.6), patch.object(
+            Deadline, "expired", True
+        ):
+            with self.assertRaises(DeadlineExceeded):
+                MyInfoPersonalClientV4().request(
+                    "https://myinfo.local/person", endpoint="person", deadline=deadline
+                )
+        self.assertEqual(resilience.get_breaker("person").failures, 0)
+
+    @responses.activate
+    def test_probe_past_the_deadline_lets_the_next_call_probe(self):
+        responses.add(
+            responses.GET, "https://myinfo.local/person", body=requests.ReadTimeout()
+        )
+        responses.add(responses.GET, "https://myinfo.local/person", status=200)
+        breaker = resilience.get_breaker("person")
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        breaker.opened_at -= breaker.recovery_timeout
+        deadline = Deadline(0.6, min_call=0.5)
+
+        with patch.object(deadline, "remaining", return_value=0.6), patch.object(
+            Deadline, "expired", True
+        ):
+            with self.assertRaises(DeadlineExceeded):
+                MyInfoPersonalClientV4().request(
+                    "https://myinfo.local/person", endpoint="person", deadline=deadline
+                )
+        MyInfoPersonalClientV4().request("https://myinfo.local/person", endpoint="person")
+
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(breaker.state, resilience.CLOSED)
+
+    @responses.activate
+    def test_full_bulkhead_fails_fast(self):
+        responses.add(responses.GET, "https://myinfo.local/person", status=200)
+        bulkhead = Bulkhead("person", max_concurrent=1, max_wait=0.01)
+        bulkhead.acquire()
+
+        with patch.object(resilience, "get_bulkhead", return_value=bulkhead):
+            with self.assertRaises(BulkheadFullError):
+                MyInfoPersonalClientV4().request("https://myinfo.local/person", endpoint="person")
+            bulkhead.release()
+            MyInfoPersonalClientV4().request("https://myinfo.local/person", endpoint="person")
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(bulkhead.in_flight, 0)
+
+    @responses.activate
+    def test_jwks_fetch_is_retried(self):
+        key_url = myinfo_settings.MYINFO_JWKS_DATA_VERIFICATION_URL
+        responses.add(responses.GET, key_url, body=requests.ConnectionError())
+        responses.add(responses.GET, key_url, body=SAMPLE_MYINFO_JWKS_DATA_VERIFICATION_DATA)
+        store = JWKSStore(ttl=3600)
+
+        with patch.object(JWKSStore, "_get_shared", return_value=None), patch.object(
+            JWKSStore, "_set_shared"
+        ):
+            jwkset = store.get(key_url)
+
+        self.assertTrue(jwkset["keys"])
+        self.assertEqual(len(responses.calls), 2)
+
+
+class TestAsyncClientResilience(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        resilience.reset_breakers()
+        self.addCleanup(resilience.reset_breakers)
+        patcher = patch.object(resilience.retry_policy, "backoff", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch("myinfo.client.MyInfoPersonalClientV4.verify_access_token", return_value={"sub": "abc"})
+    async def test_person_request_is_retried(self, mock_verify_access_token):
+        dpop_headers = []
+
+        def handler(request):
+            dpop_headers.append(request.headers["dpop"])
+            if len(dpop_headers) == 1:
+                raise httpx.ConnectError("connection refused")
+            return httpx.Response(200, text="encrypted")
+
+        http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        person_data = await AsyncMyInfoPersonalClientV4(http=http).get_person_data(
+            "token", generate_ephemeral_session_keypair()
+        )
+
+        self.assertEqual(person_data, "encrypted")
+        self.assertEqual(len(set(dpop_headers)), 2)
+
+    async def test_cancelled_probe_lets_the_next_call_probe(self):
+        started = asyncio.Event()
+
+        async def handler(request):
+            started.set()
+            await asyncio.sleep(10)
+
+        breaker = resilience.get_breaker("person")
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        breaker.opened_at -= breaker.recovery_timeout
+        http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        task = asyncio.create_task(
+            AsyncMyInfoPersonalClientV4(http=http).request(
+                "https://myinfo.local/person", endpoint="person"
+            )
+        )
+        await started.wait()
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+        self.assertTrue(breaker.before_call())
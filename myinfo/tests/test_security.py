@@ -1,15 +1,29 @@
+import asyncio
 import json
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
 
 import responses
 from myinfo import settings as myinfo_settings
+from myinfo.cache import TieredCache
+from myinfo.resilience import Deadline, DeadlineExceeded
 from jwcrypto import jwk, jws
 from myinfo.security import (
+    CryptoExecutor,
+    DPoPSigner,
+    EphemeralKeypairPool,
     decrypt_jwe,
     generate_client_assertion,
+    generate_code_challenge,
     generate_dpop_header,
     get_jwkset,
+    get_jws_kid,
+    jwks_store,
+    JWKSStore,
+    PrivateKeyRegistry,
     verify_jws,
 )
 
@@ -396,16 +410,19 @@ EXPECTED_PERSON_DECRYPTED = {
 class TestJWT(unittest.TestCase):
     maxDiff = None
 
-    @patch("myinfo.security.get_random_string")
+    def setUp(self):
+        jwks_store.clear()
+
+    @patch("myinfo.security.generate_jti")
     @patch("myinfo.security.time.time", return_value=1710202991.123456)
     @patch("myinfo.security.generate_ephemeral_session_keypair")
     def test_generate_client_assertion(
-        self, mock_generate_ephemeral_session_keypair, mock_time, mock_get_random_string
+        self, mock_generate_ephemeral_session_keypair, mock_time, mock_generate_jti
     ):
         mock_generate_ephemeral_session_keypair.return_value = jwk.JWK.from_json(
             SAMPLE_EPHEMERAL_SESSION_KEYPAIR_EXPORT
         )
-        mock_get_random_string.return_value = "OWcyc0bs4Sx0iXYqb57OhT5W793zWaOguThZVDBs"
+        mock_generate_jti.return_value = "OWcyc0bs4Sx0iXYqb57OhT5W793zWaOguThZVDBs"
 
         sig = generate_client_assertion(
             "https://test.api.myinfo.gov.sg/com/v4/token",
@@ -432,10 +449,10 @@ class TestJWT(unittest.TestCase):
             {"alg": "ES256", "kid": "k32UZD0KKsQpSsuquiXNinAh47vrJpP6Vp1hpjWufNM", "typ": "JWT"},
         )
 
-    @patch("myinfo.security.get_random_string")
+    @patch("myinfo.security.generate_jti")
     @patch("myinfo.security.time.time", return_value=1710202991.123456)
-    def test_generate_dpop_header(self, mock_time, mock_get_random_string):
-        mock_get_random_string.return_value = "DdDB3S5I10qHmwCGgciAosejxSquL6SA944r7yGH"
+    def test_generate_dpop_header(self, mock_time, mock_generate_jti):
+        mock_generate_jti.return_value = "DdDB3S5I10qHmwCGgciAosejxSquL6SA944r7yGH"
         session_ephemeral_keypair = jwk.JWK.from_json(SAMPLE_EPHEMERAL_SESSION_KEYPAIR_EXPORT)
 
         sig = generate_dpop_header(
@@ -472,6 +489,31 @@ class TestJWT(unittest.TestCase):
             },
         )
 
+    @patch("myinfo.security.time.time", return_value=1710202991.123456)
+    def test_dpop_signer_reuses_key_material(self, mock_time):
+        session_ephemeral_keypair = jwk.JWK.from_json(SAMPLE_EPHEMERAL_SESSION_KEYPAIR_EXPORT)
+        signer = DPoPSigner(session_ephemeral_keypair)
+
+        with patch.object(session_ephemeral_keypair, "thumbprint") as mock_thumbprint:
+            token_proof = signer.sign("https://test.api.myinfo.gov.sg/com/v4/token")
+            person_proof = signer.sign(
+                "https://test.api.myinfo.gov.sg/com/v4/person/abc/", method="GET", ath="xyz"
+            )
+        mock_thumbprint.assert_not_called()
+
+        self.assertEqual(signer.thumbprint, "ghatI5LS0CkrMHHj_MbSdHAP-18TDD6iEPOmjXO5zZE")
+        self.assertEqual(token_proof.split(".")[0], person_proof.split(".")[0])
+        payloads = []
+        for proof in (token_proof, person_proof):
+            jwstoken = jws.JWS()
+            jwstoken.deserialize(proof)
+            jwstoken.verify(session_ephemeral_keypair)
+            payloads.append(json.loads(jwstoken.payload.decode()))
+        self.assertEqual(payloads[1]["htm"], "GET")
+        self.assertEqual(payloads[1]["ath"], "xyz")
+        self.assertNotEqual(payloads[0]["jti"], payloads[1]["jti"])
+        self.assertEqual(len(payloads[0]["jti"]), 40)
+
     @responses.activate
     def test_verify_jws(self):
         responses.add(
@@ -496,3 +538,324 @@ class TestJWT(unittest.TestCase):
 
         result = decrypt_jwe(SAMPLE_PERSON_ENCRYPTED)
         self.assertEqual(result, EXPECTED_PERSON_DECRYPTED)
+
+
+class TestJWKSStore(unittest.TestCase):
+    key_url = myinfo_settings.MYINFO_JWKS_TOKEN_VERIFICATION_URL
+
+    def setUp(self):
+        # keep the store under test from reading documents shared by other tests
+        patcher = patch("myinfo.security.JWKSStore._get_shared", return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # and from kids found unknown by other tests
+        patcher = patch("myinfo.security.get_cache", return_value=TieredCache("jwks", ttl=3600))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(TieredCache, "shared", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_jwks_response(self):
+        responses.add(
+            responses.GET,
+            self.key_url,
+            body=SAMPLE_MYINFO_JWKS_TOKEN_VERIFICATION_DATA,
+            status=200,
+        )
+
+    @responses.activate
+    def test_get_caches_jwkset(self):
+        self.add_jwks_response()
+        store = JWKSStore(ttl=3600, refresh_interval=60)
+
+        first = store.get(self.key_url)
+        second = store.get(self.key_url, kid="AFMnnKRWTaBYEhNfEB6iQ5ErC1yqGVyZchH8A7nl_yM")
+
+        self.assertIs(first, second)
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_get_refetches_after_ttl(self):
+        self.add_jwks_response()
+        store = JWKSStore(ttl=0, refresh_interval=60, stale_ttl=0)
+
+        store.get(self.key_url)
+        store.get(self.key_url)
+
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_serves_stale_while_revalidating(self):
+        self.add_jwks_response()
+        store = JWKSStore(ttl=0, refresh_interval=60, stale_ttl=60)
+        first = store.get(self.key_url)
+
+        revalidations = []
+        with patch.object(
+            store,
+            "revalidate",
+            side_effect=lambda key_url: revalidations.append(JWKSStore.revalidate(store, key_url)),
+        ):
+            second = store.get(self.key_url)
+        refreshed = revalidations[0].result()
+
+        self.assertIs(first, second)
+        self.assertEqual(len(revalidations), 1)
+        self.assertIsNot(refreshed.jwkset, first)
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_concurrent_loads_are_coalesced(self):
+        self.add_jwks_response()
+        store = JWKSStore(ttl=3600, refresh_interval=60)
+        started = threading.Event()
+        release = threading.Event()
+        fetch = store._fetch
+
+        def slow_fetch(key_url):
+            started.set()
+            release.wait(5)
+            return fetch(key_url)
+
+        with patch.object(store, "_fetch", side_effect=slow_fetch):
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                futures = [executor.submit(store.get, self.key_url)]
+                started.wait(5)
+                futures += [executor.submit(store.get, self.key_url) for _ in range(3)]
+                time.sleep(0.05)
+                release.set()
+                jwksets = [future.result() for future in futures]
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertTrue(all(jwkset is jwksets[0] for jwkset in jwksets))
+
+    @responses.activate
+    def test_wait_for_a_fetch_is_capped_by_the_deadline(self):
+        self.add_jwks_response()
+        store = JWKSStore(ttl=3600, refresh_interval=60)
+        release = threading.Event()
+        fetch = store._fetch
+
+        def slow_fetch(key_url):
+            release.wait(5)
+            return fetch(key_url)
+
+        with patch.object(store, "_fetch", side_effect=slow_fetch):
+            with self.assertRaises(DeadlineExceeded):
+                store.get(self.key_url, deadline=Deadline(0.05, min_call=0))
+            with self.assertRaises(DeadlineExceeded):
+                store.get(self.key_url, deadline=Deadline(0))
+            release.set()
+            # the fetch carried on and fills the store for the next lookups
+            jwkset = store.get(self.key_url, deadline=Deadline(5, min_call=0))
+
+        self.assertTrue(jwkset["keys"])
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_aget_shares_the_fetch_with_threads(self):
+        self.add_jwks_response()
+        store = JWKSStore(ttl=3600, refresh_interval=60)
+
+        async def main():
+            return await asyncio.gather(*(store.aget(self.key_url) for _ in range(3)))
+
+        jwksets = asyncio.run(main())
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertIs(store.get(self.key_url), jwksets[0])
+
+    @responses.activate
+    def test_unknown_kid_refreshes_once(self):
+        self.add_jwks_response()
+        store = JWKSStore(ttl=3600, refresh_interval=0)
+
+        store.get(self.key_url)
+        store.get(self.key_url, kid="rotated-kid")
+
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        self.add_jwks_response()
+        store = JWKSStore(ttl=3600, refresh_interval=60)
+
+        store.get(self.key_url)
+        store.get(self.key_url, kid="rotated-kid")
+        store.get(self.key_url, kid="rotated-kid")
+
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_unknown_kid_is_cached_across_stores(self):
+        self.add_jwks_response()
+        store = JWKSStore(ttl=3600, refresh_interval=0)
+        other_store = JWKSStore(ttl=3600, refresh_interval=0)
+
+        store.get(self.key_url)
+        store.get(self.key_url, kid="rotated-kid")
+        other_store.get(self.key_url)
+        other_store.get(self.key_url, kid="rotated-kid")
+
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_get_key_by_kid(self):
+        self.add_jwks_response()
+        store = JWKSStore(ttl=3600, refresh_interval=60)
+
+        key = store.get_key(self.key_url, "AFMnnKRWTaBYEhNfEB6iQ5ErC1yqGVyZchH8A7nl_yM")
+
+        self.assertEqual(key["crv"], "P-256")
+        self.assertIsNone(store.get_key(self.key_url, "unknown"))
+
+    def test_get_jws_kid(self):
+        self.assertEqual(
+            get_jws_kid(SAMPLE_TOKEN_RESP["access_token"]),
+            "AFMnnKRWTaBYEhNfEB6iQ5ErC1yqGVyZchH8A7nl_yM",
+        )
+        self.assertIsNone(get_jws_kid("not-a-jws"))
+
+
+class TestPrivateKeyRegistry(unittest.TestCase):
+    def test_keys_are_parsed_once(self):
+        registry = PrivateKeyRegistry()
+
+        with patch("myinfo.security.jwk.JWK.from_json", wraps=jwk.JWK.from_json) as mock_from_json:
+            first = registry.signing_key
+            second = registry.signing_key
+
+        self.assertIs(first, second)
+        self.assertEqual(mock_from_json.call_count, 1)
+        self.assertEqual(first.kid, "k32UZD0KKsQpSsuquiXNinAh47vrJpP6Vp1hpjWufNM")
+        self.assertEqual(
+            first.protected_header,
+            {"typ": "JWT", "alg": "ES256", "kid": "k32UZD0KKsQpSsuquiXNinAh47vrJpP6Vp1hpjWufNM"},
+        )
+
+    def test_key_is_reloaded_when_environment_changes(self):
+        registry = PrivateKeyRegistry()
+        first = registry.signing_key
+
+        rotated = SAMPLE_EPHEMERAL_SESSION_KEYPAIR_EXPORT.replace('"', "'")
+        with patch.dict("os.environ", {"MYINFO_PRIVATE_KEY_SIG": rotated}):
+            second = registry.signing_key
+
+        self.assertIsNot(first, second)
+        self.assertEqual(second.kid, "ghatI5LS0CkrMHHj_MbSdHAP-18TDD6iEPOmjXO5zZE")
+
+    def test_public_key_is_rejected(self):
+        registry = PrivateKeyRegistry()
+        public_key = jwk.JWK.from_json(SAMPLE_EPHEMERAL_SESSION_KEYPAIR_EXPORT).export_public()
+
+        with patch.dict("os.environ", {"MYINFO_PRIVATE_KEY_SIG": public_key}):
+            with self.assertRaises(ValueError):
+                registry.signing_key
+
+    def test_key_use_is_validated(self):
+        registry = PrivateKeyRegistry()
+
+        with patch.dict(
+            "os.environ", {"MYINFO_PRIVATE_KEY_ENC": myinfo_settings.MYINFO_PRIVATE_KEY_SIG}
+        ):
+            with self.assertRaises(ValueError):
+                registry.encryption_key
+
+
+class TestEphemeralKeypairPool(unittest.TestCase):
+    def test_take_from_filled_pool(self):
+        pool = EphemeralKeypairPool(size=2, low_watermark=0)
+        pool.fill()
+
+        keypairs = [pool.take(), pool.take(), pool.take()]
+
+        self.assertEqual(pool.stats(), {"size": 0, "hits": 2, "misses": 1})
+        self.assertEqual(len({keypair.thumbprint() for keypair in keypairs}), 3)
+
+    def test_refills_in_background_below_low_watermark(self):
+        pool = EphemeralKeypairPool(size=2, low_watermark=1)
+
+        pool.take()
+        for _ in range(100):
+            if pool.stats()["size"] == 2:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(pool.stats()["size"], 2)
+        self.assertEqual(pool.stats()["misses"], 1)
+
+    def test_pool_is_emptied_after_fork(self):
+        pool = EphemeralKeypairPool(size=1, low_watermark=0)
+        pool.fill()
+
+        with patch("myinfo.security.os.getpid", return_value=-1):
+            pool.take()
+
+        self.assertEqual(pool.stats(), {"size": 0, "hits": 0, "misses": 1})
+
+
+class TestCryptoExecutor(unittest.TestCase):
+    def setUp(self):
+        jwks_store.clear()
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            CryptoExecutor(mode="gpu")
+
+    def test_inline(self):
+        executor = CryptoExecutor(mode="inline")
+
+        self.assertEqual(
+            executor.run(generate_code_challenge, "abc123"), generate_code_challenge("abc123")
+        )
+        with self.assertRaises(ValueError):
+            executor.run(json.loads, "not json")
+        self.assertEqual(executor.stats()["completed"], 2)
+        self.assertEqual(executor.stats()["queue_depth"], 0)
+
+    @responses.activate
+    def test_thread_decrypt_many(self):
+        responses.add(
+            responses.GET,
+            myinfo_settings.MYINFO_JWKS_DATA_VERIFICATION_URL,
+            body=SAMPLE_MYINFO_JWKS_DATA_VERIFICATION_DATA,
+            status=200,
+        )
+        executor = CryptoExecutor(mode="thread", max_workers=2)
+        self.addCleanup(executor.shutdown)
+
+        results = executor.decrypt_many([SAMPLE_PERSON_ENCRYPTED] * 3)
+
+        self.assertEqual(results, [EXPECTED_PERSON_DECRYPTED] * 3)
+        stats = executor.stats()
+        self.assertEqual(stats["completed"], 3)
+        self.assertEqual(stats["queue_depth"], 0)
+        self.assertGreater(stats["max_latency"], 0)
+
+    @responses.activate
+    def test_thread_verify_many(self):
+        responses.add(
+            responses.GET,
+            myinfo_settings.MYINFO_JWKS_TOKEN_VERIFICATION_URL,
+            body=SAMPLE_MYINFO_JWKS_TOKEN_VERIFICATION_DATA,
+            status=200,
+        )
+        executor = CryptoExecutor(mode="thread", max_workers=2)
+        self.addCleanup(executor.shutdown)
+
+        results = executor.verify_many(
+            [SAMPLE_TOKEN_RESP["access_token"]] * 2,
+            myinfo_settings.MYINFO_JWKS_TOKEN_VERIFICATION_URL,
+        )
+
+        self.assertEqual(results, [EXPECTED_DECODED_ACCESS_TOKEN] * 2)
+
+    def test_process(self):
+        executor = CryptoExecutor(mode="process", max_workers=1)
+        self.addCleanup(executor.shutdown)
+
+        self.assertEqual(
+            executor.run(generate_code_challenge, "abc123"), generate_code_challenge("abc123")
+        )
+        self.assertEqual(executor.stats()["completed"], 1)
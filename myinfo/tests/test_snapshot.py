@@ -0,0 +1,214 @@
+import fcntl
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import responses
+from myinfo import settings as myinfo_settings
+from myinfo.cache import TieredCache
+from myinfo.security import JWKSStore
+from myinfo.snapshot import _HEADER, _MAGIC, _VERSION, JWKSSnapshot
+from myinfo.tests.test_security import (
+    SAMPLE_MYINFO_JWKS_DATA_VERIFICATION_DATA,
+    SAMPLE_MYINFO_JWKS_TOKEN_VERIFICATION_DATA,
+)
+
+TOKEN_URL = myinfo_settings.MYINFO_JWKS_TOKEN_VERIFICATION_URL
+DATA_URL = myinfo_settings.MYINFO_JWKS_DATA_VERIFICATION_URL
+
+
+def write_from_another_process(path):
+    snapshot = JWKSSnapshot(path)
+    with snapshot.locked(1) as locked:
+        assert locked
+        snapshot.write(DATA_URL, time.time(), SAMPLE_MYINFO_JWKS_DATA_VERIFICATION_DATA)
+
+
+class TestJWKSSnapshot(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "jwks")
+        self.snapshot = JWKSSnapshot(self.path, size=16384)
+        self.addCleanup(self.snapshot.close)
+
+    def write(self, snapshot, key_url, keys_data, fetched_at=None):
+        with snapshot.locked(1) as locked:
+            self.assertTrue(locked)
+            return snapshot.write(key_url, fetched_at or time.time(), keys_data)
+
+    def test_write_and_read(self):
+        self.assertIsNone(self.snapshot.read())
+
+        self.assertTrue(self.write(self.snapshot, TOKEN_URL, "token"))
+        self.assertTrue(self.write(self.snapshot, DATA_URL, "data"))
+
+        seq, documents = self.snapshot.read()
+        self.assertEqual(seq, 4)
+        self.assertEqual(documents[TOKEN_URL][1], "token")
+        self.assertEqual(documents[DATA_URL][1], "data")
+
+    def test_read_if_changed(self):
+        reader = JWKSSnapshot(self.path, size=16384)
+        self.addCleanup(reader.close)
+
+        self.write(self.snapshot, TOKEN_URL, "token")
+
+        self.assertEqual(reader.read_if_changed()[TOKEN_URL][1], "token")
+        self.assertIsNone(reader.read_if_changed())
+        # the writer already has what it wrote
+        self.assertIsNone(self.snapshot.read_if_changed())
+
+    def test_write_in_progress_is_not_read(self):
+        self.write(self.snapshot, TOKEN_URL, "token")
+        mm = self.snapshot._open()
+        _HEADER.pack_into(mm, 0, _MAGIC, _VERSION, 3, 0)
+
+        with patch.object(self.snapshot, "read_attempts", 3):
+            self.assertIsNone(self.snapshot.read())
+
+        # the next writer recovers from a writer that died mid-write
+        self.write(self.snapshot, DATA_URL, "data")
+        seq, documents = self.snapshot.read()
+        self.assertEqual(seq, 6)
+        self.assertEqual(list(documents), [DATA_URL])
+
+    def test_document_too_large(self):
+        self.assertFalse(self.write(self.snapshot, TOKEN_URL, "x" * 16384))
+        self.assertIsNone(self.snapshot.read())
+
+    def test_lock_held_by_another_process(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        self.addCleanup(os.close, fd)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+        with self.snapshot.locked(0.05) as locked:
+            self.assertFalse(locked)
+
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        with self.snapshot.locked(0.05) as locked:
+            self.assertTrue(locked)
+
+    def test_unusable_path(self):
+        snapshot = JWKSSnapshot(os.path.join(self.path, "missing", "jwks"))
+
+        self.assertIsNone(snapshot.read())
+        self.assertIsNone(snapshot.read_if_changed())
+        with snapshot.locked(0.05) as locked:
+            self.assertFalse(locked)
+        self.assertFalse(snapshot.write(TOKEN_URL, time.time(), "token"))
+
+    def test_shared_with_forked_process(self):
+        self.snapshot.read()
+
+        process = multiprocessing.get_context("fork").Process(
+            target=write_from_another_process, args=(self.path,)
+        )
+        process.start()
+        process.join(10)
+
+        self.assertEqual(process.exitcode, 0)
+        documents = self.snapshot.read_if_changed()
+        self.assertEqual(documents[DATA_URL][1], SAMPLE_MYINFO_JWKS_DATA_VERIFICATION_DATA)
+
+
+class TestJWKSStoreSnapshot(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "jwks")
+        for patcher in (
+            patch("myinfo.security.JWKSStore._get_shared", return_value=None),
+            patch("myinfo.security.get_cache", return_value=TieredCache("jwks", ttl=3600)),
+            patch.object(TieredCache, "shared", None),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        responses.add(responses.GET, TOKEN_URL, body=SAMPLE_MYINFO_JWKS_TOKEN_VERIFICATION_DATA)
+
+    def get_store(self):
+        # a store and snapshot per simulated worker process
+        snapshot = JWKSSnapshot(self.path, size=16384)
+        self.addCleanup(snapshot.close)
+        return JWKSStore(ttl=3600, refresh_interval=0, snapshot=snapshot)
+
+    @responses.activate
+    def test_other_processes_load_from_the_snapshot(self):
+        first, second = self.get_store(), self.get_store()
+
+        first.get(TOKEN_URL)
+        second.get(TOKEN_URL)
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertIn(
+            "AFMnnKRWTaBYEhNfEB6iQ5ErC1yqGVyZchH8A7nl_yM", second._entries[TOKEN_URL].keys
+        )
+
+    @responses.activate
+    def test_refresh_is_picked_up_by_other_processes(self):
+        first, second = self.get_store(), self.get_store()
+        first.get(TOKEN_URL)
+        second.get(TOKEN_URL)
+        old_entry = second._entries[TOKEN_URL]
+
+        first.get(TOKEN_URL, kid="rotated")
+        second.get(TOKEN_URL)
+
+        self.assertEqual(len(responses.calls), 2)
+        self.assertIsNot(second._entries[TOKEN_URL], old_entry)
+
+    @responses.activate
+    def test_fetch_done_by_another_process_meanwhile_is_used(self):
+        first, second = self.get_store(), self.get_store()
+
+        def fetched_by_the_first_process_meanwhile(request):
+            with first.snapshot.locked(1):
+                first.snapshot.write(TOKEN_URL, time.time(), '{"keys":[]}')
+            return 200, {}, SAMPLE_MYINFO_JWKS_TOKEN_VERIFICATION_DATA
+
+        responses.remove(responses.GET, TOKEN_URL)
+        responses.add_callback(responses.GET, TOKEN_URL, fetched_by_the_first_process_meanwhile)
+        second.get(TOKEN_URL)
+
+        # the processes serve the same document
+        self.assertEqual(second._entries[TOKEN_URL].keys, {})
+        self.assertEqual(second.snapshot.read()[1][TOKEN_URL][1], '{"keys":[]}')
+
+    @responses.activate
+    def test_fetch_does_not_wait_for_the_lock(self):
+        store = self.get_store()
+        fetched_under_lock = []
+
+        def check_lock(request):
+            fd = os.open(self.path, os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fetched_under_lock.append(False)
+            except BlockingIOError:
+                fetched_under_lock.append(True)
+            finally:
+                os.close(fd)
+            return 200, {}, SAMPLE_MYINFO_JWKS_TOKEN_VERIFICATION_DATA
+
+        responses.remove(responses.GET, TOKEN_URL)
+        responses.add_callback(responses.GET, TOKEN_URL, check_lock)
+        store.get(TOKEN_URL)
+
+        self.assertEqual(fetched_under_lock, [False])
+        self.assertIn(TOKEN_URL, store.snapshot.read()[1])
+
+    @responses.activate
+    def test_falls_back_to_fetching_without_the_lock(self):
+        store = self.get_store()
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        self.addCleanup(os.close, fd)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+        with patch.object(store, "snapshot_lock_timeout", 0.05):
+            store.get(TOKEN_URL)
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertIsNone(store.snapshot.read())
@@ -0,0 +1,61 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from myinfo import transport
+from myinfo.client import AsyncMyInfoPersonalClientV4, MyInfoPersonalClientV4
+
+
+class TestTransport(unittest.TestCase):
+    def tearDown(self):
+        transport.close_session()
+
+    def test_session_is_shared(self):
+        self.assertIs(transport.get_session(), transport.get_session())
+        self.assertIs(MyInfoPersonalClientV4().session, MyInfoPersonalClientV4().session)
+
+    def test_session_is_recreated_after_fork(self):
+        session = transport.get_session()
+
+        with patch("myinfo.transport.os.getpid", return_value=-1):
+            self.assertIsNot(transport.get_session(), session)
+
+    def test_create_session_pool_size(self):
+        session = transport.create_session(pool_connections=2, pool_maxsize=8)
+
+        adapter = session.get_adapter("https://test.api.myinfo.gov.sg")
+        self.assertEqual(adapter._pool_connections, 2)
+        self.assertEqual(adapter._pool_maxsize, 8)
+
+    @patch("myinfo.settings.MYINFO_HTTP_POOLED", False)
+    def test_unpooled_client(self):
+        self.assertIsNot(MyInfoPersonalClientV4().session, transport.get_session())
+
+    def test_async_client_shares_the_session(self):
+        self.assertIs(AsyncMyInfoPersonalClientV4().session, transport.get_session())
+
+    def test_async_client_is_closed_on_lifespan_shutdown(self):
+        application = AsyncMock()
+        app = transport.close_on_shutdown(application)
+        messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        async def serve():
+            client = transport.get_async_client()
+            await app({"type": "http"}, receive, send)
+            await app({"type": "lifespan"}, receive, send)
+            return client
+
+        client = asyncio.run(serve())
+
+        application.assert_awaited_once_with({"type": "http"}, receive, send)
+        self.assertEqual(
+            sent, [{"type": "lifespan.startup.complete"}, {"type": "lifespan.shutdown.complete"}]
+        )
+        self.assertTrue(client.is_closed)
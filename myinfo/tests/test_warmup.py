@@ -0,0 +1,94 @@
+import os
+import unittest
+from unittest.mock import patch
+
+import requests
+import responses
+from myinfo import resilience, warmup
+from myinfo import settings as myinfo_settings
+from myinfo.security import JWKSStore, jwks_store, keypair_pool, private_keys
+from myinfo.tests.test_security import (
+    SAMPLE_MYINFO_JWKS_DATA_VERIFICATION_DATA,
+    SAMPLE_MYINFO_JWKS_TOKEN_VERIFICATION_DATA,
+)
+
+
+class TestWarmup(unittest.TestCase):
+    def setUp(self):
+        jwks_store.clear()
+        private_keys.clear()
+        self.addCleanup(jwks_store.clear)
+        self.addCleanup(private_keys.clear)
+        self.addCleanup(resilience.reset_breakers)
+        for patcher in (
+            patch.object(JWKSStore, "_get_shared", return_value=None),
+            patch.object(JWKSStore, "_set_shared"),
+            patch.object(resilience.retry_policy, "attempts", 1),
+            patch.object(warmup, "_process_warmed_up_pid", None),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def add_responses(self):
+        responses.add(
+            responses.GET,
+            myinfo_settings.MYINFO_JWKS_TOKEN_VERIFICATION_URL,
+            body=SAMPLE_MYINFO_JWKS_TOKEN_VERIFICATION_DATA,
+        )
+        responses.add(
+            responses.GET,
+            myinfo_settings.MYINFO_JWKS_DATA_VERIFICATION_URL,
+            body=SAMPLE_MYINFO_JWKS_DATA_VERIFICATION_DATA,
+        )
+        for origin in warmup.get_origins():
+            responses.add(responses.HEAD, origin, status=404)
+
+    @responses.activate
+    def test_warm_up(self):
+        self.add_responses()
+
+        steps = warmup.warm_up()
+
+        self.assertEqual(
+            [step.name for step in steps],
+            ["private_keys", "crypto", "jwks", "keypair_pool", "connections", "crypto_executor"],
+        )
+        self.assertTrue(all(step.error is None for step in steps))
+        self.assertEqual(len(keypair_pool._keypairs), keypair_pool.size)
+        self.assertIn(myinfo_settings.MYINFO_JWKS_DATA_VERIFICATION_URL, jwks_store._entries)
+        self.assertEqual(len(responses.calls), 2 + len(warmup.get_origins()))
+
+        # the per-process steps run once per process
+        self.assertEqual(warmup.warm_up_process(), [])
+
+    @responses.activate
+    def test_preload_skips_the_per_process_steps(self):
+        self.add_responses()
+
+        steps = warmup.warm_up(process=False)
+
+        self.assertEqual([step.name for step in steps], ["private_keys", "crypto", "jwks"])
+        self.assertEqual(warmup._process_warmed_up_pid, None)
+
+    @responses.activate
+    def test_upstream_failures_are_not_fatal(self):
+        for url in (
+            myinfo_settings.MYINFO_JWKS_TOKEN_VERIFICATION_URL,
+            myinfo_settings.MYINFO_JWKS_DATA_VERIFICATION_URL,
+            *warmup.get_origins(),
+        ):
+            responses.add(responses.GET, url, body=requests.ConnectionError())
+            responses.add(responses.HEAD, url, body=requests.ConnectionError())
+
+        steps = {step.name: step for step in warmup.warm_up()}
+
+        self.assertIsNotNone(steps["jwks"].error)
+        self.assertIsNotNone(steps["connections"].error)
+        self.assertIsNone(steps["private_keys"].error)
+
+    def test_invalid_private_key(self):
+        public_only = '{"kty":"EC","crv":"P-256","use":"sig","x":"k-K2AGmjySAjxPhHLA_vCv8aa-oIoACSWhyZEQmRewc","y":"WMro28Kf4Y5Y5fiwOL-WRAo9AYFBhv8GNbtr-xnz4a0"}'  # noqa: E501
+
+        with patch.dict(os.environ, {"MYINFO_PRIVATE_KEY_SIG": public_only}):
+            with self.assertRaises(ValueError):
+                warmup.warm_up_shared()
@@ -0,0 +1,127 @@
+"""
+Process-wide HTTP transport shared by the Myinfo clients and the JWKS fetches.
+
+A single `requests.Session` per process (and a single `httpx.AsyncClient` per event loop) keeps TLS
+connections to Myinfo alive between requests, instead of paying a new TCP+TLS handshake for every
+upstream call.
+"""
+import asyncio
+import os
+import threading
+import weakref
+
+import httpx
+import requests
+from myinfo import settings
+from requests.adapters import HTTPAdapter
+
+_session = None
+_session_pid = None
+_lock = threading.Lock()
+# httpx connections are bound to the event loop that opened them, so async clients are kept per
+# loop and dropped together with it.
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_timeout() -> tuple:
+    """
+    Returns the (connect, read) timeout used for upstream calls.
+    """
+    return settings.MYINFO_CONNECT_TIMEOUT, settings.MYINFO_READ_TIMEOUT
+
+
+def create_session(pool_connections: int = None, pool_maxsize: int = None) -> requests.Session:
+    """
+    Returns a new session keeping up to `pool_maxsize` connections alive for each of
+    `pool_connections` hosts.
+    """
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections or settings.MYINFO_HTTP_POOL_CONNECTIONS,
+        pool_maxsize=pool_maxsize or settings.MYINFO_HTTP_POOL_MAXSIZE,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the session shared by every thread of the current process.
+
+    Connections must not be shared with a forked child, so a new session is created whenever the
+    process id changes (e.g. gunicorn workers forked from a preloaded master).
+    """
+    global _session, _session_pid
+
+    if _session is None or _session_pid != os.getpid():
+        with _lock:
+            if _session is None or _session_pid != os.getpid():
+                _session = create_session()
+                _session_pid = os.getpid()
+    return _session
+
+
+def close_session() -> None:
+    global _session, _session_pid
+
+    with _lock:
+        if _session is not None and _session_pid == os.getpid():
+            _session.close()
+        _session = None
+        _session_pid = None
+
+
+def create_async_client() -> httpx.AsyncClient:
+    max_connections = settings.MYINFO_HTTP_POOL_MAXSIZE * settings.MYINFO_HTTP_POOL_CONNECTIONS
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        ),
+        timeout=httpx.Timeout(
+            settings.MYINFO_READ_TIMEOUT, connect=settings.MYINFO_CONNECT_TIMEOUT
+        ),
+        verify=settings.CERT_VERIFY,
+    )
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Returns the async client shared by every coroutine of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = _async_clients[loop] = create_async_client()
+    return client
+
+
+async def close_async_client() -> None:
+    """
+    Closes the async client of the running event loop, e.g. before the loop itself is closed.
+    """
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def close_on_shutdown(application):
+    """
+    Wraps the ASGI `application` to close the async client of the server's event loop on lifespan
+    shutdown. Django doesn't handle lifespan events, so the wrapper answers them itself.
+    """
+
+    async def app(scope, receive, send):
+        if scope["type"] != "lifespan":
+            return await application(scope, receive, send)
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await close_async_client()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    return app
@@ -0,0 +1,176 @@
+"""
+Warm-up of a process before it serves its first Myinfo login.
+
+Without it, the first callback of every worker pays for parsing the private keys, fetching both
+JWKS documents, opening the TLS connections to Myinfo and generating a session keypair.
+
+The steps come in two groups, so that they can run on both sides of a fork (gunicorn `--preload`):
+- `warm_up_shared`: private keys, crypto code paths and JWKS documents. These are plain data that
+  forked workers inherit (copy-on-write), so a preloading master does them once for all workers.
+- `warm_up_process`: everything bound to the process and dropped after a fork: the session keypair
+  pool, the pooled connections and the crypto executor's pool. Each worker runs them once, e.g.
+  from the gunicorn `post_fork` hook (see gunicorn.conf.py).
+
+Invalid private keys raise, so that a misconfigured worker fails to boot instead of failing every
+login. Upstream failures (JWKS, connections) are only logged: the first callback retries them.
+"""
+import logging
+import os
+import time
+from typing import Callable, List, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+from myinfo import metrics
+from myinfo import settings as myinfo_settings
+from myinfo import transport
+from myinfo.security import (
+    DPoPSigner,
+    crypto_executor,
+    generate_client_assertion,
+    generate_ephemeral_session_keypair,
+    jwks_store,
+    keypair_pool,
+    private_keys,
+)
+
+log = logging.getLogger(__name__)
+
+_process_warmed_up_pid: Optional[int] = None
+
+
+class WarmupStep(NamedTuple):
+    name: str
+    duration: float
+    error: Optional[str] = None
+
+
+def run_step(steps: List[WarmupStep], name: str, fn: Callable, required: bool = False) -> None:
+    started_at = time.perf_counter()
+    error = None
+    try:
+        fn()
+    except Exception as e:
+        if required:
+            raise
+        error = repr(e)
+        log.warning("Myinfo warm-up step %s failed: %r", name, e)
+    duration = time.perf_counter() - started_at
+    metrics.STAGE_DURATION.observe(duration, stage=f"warmup_{name}")
+    steps.append(WarmupStep(name, duration, error))
+
+
+def load_private_keys() -> None:
+    """
+    Parses and validates both private keys.
+
+    Raises:
+        ValueError: when a key is not a valid EC P-256 private key for its use.
+    """
+    private_keys.signing_key
+    private_keys.encryption_key
+
+
+def warm_up_crypto() -> None:
+    # loads the OpenSSL EC and hash code paths used by every callback
+    signer = DPoPSigner(generate_ephemeral_session_keypair())
+    signer.sign(f"{myinfo_settings.MYINFO_DOMAIN}/com/v4/token")
+    generate_client_assertion(f"{myinfo_settings.MYINFO_DOMAIN}/com/v4/token", signer.thumbprint)
+
+
+def fetch_jwks() -> None:
+    for key_url in (
+        myinfo_settings.MYINFO_JWKS_TOKEN_VERIFICATION_URL,
+        myinfo_settings.MYINFO_JWKS_DATA_VERIFICATION_URL,
+    ):
+        jwks_store.get(key_url)
+
+
+def get_origins() -> List[str]:
+    origins = []
+    for url in (
+        myinfo_settings.MYINFO_DOMAIN,
+        myinfo_settings.MYINFO_JWKS_TOKEN_VERIFICATION_URL,
+        myinfo_settings.MYINFO_JWKS_DATA_VERIFICATION_URL,
+    ):
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}/"
+        if origin not in origins:
+            origins.append(origin)
+    return origins
+
+
+def open_connections() -> None:
+    """
+    Leaves one TLS connection per Myinfo host in the process' connection pool.
+    """
+    session = transport.get_session()
+    for origin in get_origins():
+        session.head(
+            origin,
+            timeout=transport.get_timeout(),
+            verify=myinfo_settings.CERT_VERIFY,
+            allow_redirects=False,
+        )
+
+
+def start_crypto_executor() -> None:
+    if crypto_executor.mode == "inline":
+        return
+    # the keys are parsed in each process of a process pool too
+    futures = [
+        crypto_executor.submit(load_private_keys) for _ in range(crypto_executor.max_workers)
+    ]
+    for future in futures:
+        future.result()
+
+
+def warm_up_shared() -> List[WarmupStep]:
+    steps: List[WarmupStep] = []
+    run_step(steps, "private_keys", load_private_keys, required=True)
+    run_step(steps, "crypto", warm_up_crypto, required=True)
+    run_step(steps, "jwks", fetch_jwks)
+    return steps
+
+
+def warm_up_process() -> List[WarmupStep]:
+    """
+    Runs the per-process steps, once per process.
+    """
+    global _process_warmed_up_pid
+
+    if _process_warmed_up_pid == os.getpid():
+        return []
+    steps: List[WarmupStep] = []
+    run_step(steps, "keypair_pool", keypair_pool.fill)
+    run_step(steps, "connections", open_connections)
+    run_step(steps, "crypto_executor", start_crypto_executor, required=True)
+    _process_warmed_up_pid = os.getpid()
+    report(steps, "per-process")
+    return steps
+
+
+def warm_up(process: bool = True) -> List[WarmupStep]:
+    """
+    Runs the shared steps, and the per-process ones unless `process` is False (e.g. in a
+    preloading master, whose workers run them after the fork).
+    """
+    steps = warm_up_shared()
+    report(steps, "shared")
+    if process:
+        steps += warm_up_process()
+    return steps
+
+
+def report(steps: List[WarmupStep], kind: str) -> None:
+    if not steps:
+        return
+    log.info(
+        "Myinfo %s warm-up of process %d done in %.1fms (%s)",
+        kind,
+        os.getpid(),
+        sum(step.duration for step in steps) * 1000,
+        ", ".join(
+            f"{step.name} {step.duration * 1000:.1f}ms{' failed' if step.error else ''}"
+            for step in steps
+        ),
+    )
@@ -0,0 +1,103 @@
+"""
+Admission control of the Myinfo callbacks.
+
+When upstream slows down, callbacks pile up on the workers and everyone ends up timing out. Past a
+number of callbacks in flight in the process, or when a request already waited too long in the
+proxy or server queue, the callback is rejected right away with a 503 and a Retry-After instead.
+
+The queue wait is read from the X-Request-Start header set by the proxy (nginx
+`proxy_set_header X-Request-Start "t=${msec}";`, Heroku, ...), in seconds, milliseconds or
+microseconds since the epoch.
+"""
+import threading
+import time
+from typing import Optional
+
+from myinfo import metrics
+from myinfo import settings as myinfo_settings
+
+OVERLOADED_ERROR = "Too many Myinfo logins in progress, try again shortly"
+
+
+def get_queue_wait(meta: dict) -> Optional[float]:
+    """
+    Returns the seconds the request spent queued before reaching Django, if the proxy says.
+    """
+    value = meta.get("HTTP_X_REQUEST_START", "")
+    if value.startswith("t="):
+        value = value[2:]
+    try:
+        started_at = float(value)
+    except ValueError:
+        return None
+    if started_at > 1e14:
+        started_at /= 1e6
+    elif started_at > 1e11:
+        started_at /= 1e3
+    return max(time.time() - started_at, 0.0)
+
+
+class AdmissionController(object):
+    """
+    Counts the callbacks in flight in the process and sheds the ones over the limits.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: Optional[int] = None,
+        max_queue_wait: Optional[float] = None,
+        retry_after: Optional[int] = None,
+    ):
+        self.max_in_flight = (
+            myinfo_settings.MYINFO_SHED_MAX_IN_FLIGHT if max_in_flight is None else max_in_flight
+        )
+        self.max_queue_wait = (
+            myinfo_settings.MYINFO_SHED_MAX_QUEUE_WAIT
+            if max_queue_wait is None
+            else max_queue_wait
+        )
+        self.retry_after = (
+            myinfo_settings.MYINFO_SHED_RETRY_AFTER if retry_after is None else retry_after
+        )
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def admit(self, meta: dict) -> bool:
+        """
+        Returns whether the request with the WSGI/ASGI `meta` may proceed. Admitted requests must
+        call `release` when done.
+        """
+        if self.max_queue_wait:
+            queue_wait = get_queue_wait(meta)
+            if queue_wait is not None and queue_wait > self.max_queue_wait:
+                metrics.REJECTED_REQUESTS.inc(limiter="callback_queue_wait")
+                return False
+        with self._lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                metrics.REJECTED_REQUESTS.inc(limiter="callback_in_flight")
+                return False
+            self.in_flight += 1
+        return True
+
+    def release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+
+_admission_controller: Optional[AdmissionController] = None
+
+
+def get_admission_controller() -> AdmissionController:
+    global _admission_controller
+    if _admission_controller is None:
+        _admission_controller = AdmissionController()
+    return _admission_controller
+
+
+metrics.registry.register(
+    metrics.Gauge(
+        "myinfo_callbacks_in_flight",
+        "Myinfo callbacks being served by this process.",
+        callback=lambda: _admission_controller.in_flight if _admission_controller else 0,
+    )
+)
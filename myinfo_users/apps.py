@@ -1,6 +1,25 @@
 from django.apps import AppConfig
+from django.core.exceptions import ImproperlyConfigured
 
 
 class MyinfoUsersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'myinfo_users'
+
+    def ready(self):
+        from myinfo import settings as myinfo_settings
+        from myinfo.warmup import warm_up
+        from myinfo_users.flow_state import check_scope_profiles
+
+        try:
+            check_scope_profiles(myinfo_settings.MYINFO_SCOPE_PROFILES)
+        except ValueError as e:
+            raise ImproperlyConfigured(str(e)) from e
+
+        if myinfo_settings.MYINFO_WARMUP not in ("true", "preload"):
+            return
+        try:
+            warm_up(process=myinfo_settings.MYINFO_WARMUP != "preload")
+        except Exception as e:
+            # refuse to serve logins that would all fail, e.g. with an invalid private key
+            raise ImproperlyConfigured(f"Myinfo warm-up failed: {e}") from e
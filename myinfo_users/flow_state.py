@@ -0,0 +1,199 @@
+"""
+Storage of the in-flight Myinfo login flows, one record per OAuth state.
+
+A record holds everything the callback needs (the session ephemeral keypair and the scope profile
+the flow was authorised with), so that starting a flow is one write and finishing it is one atomic
+consume: the record is read and deleted in a single operation, which also makes a replayed callback
+fail.
+"""
+import struct
+import threading
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from cryptography.hazmat.primitives.asymmetric import ec
+from django.conf import settings
+from jwcrypto.jwk import JWK
+
+from myinfo import settings as myinfo_settings
+from myinfo.cache import TieredCache, get_cache
+
+FLOW_STATE_TTL = myinfo_settings.MYINFO_FLOW_STATE_TTL
+INVALID_STATE_ERROR = "Invalid state parameter"
+# Myinfo failed fast before the code was spent, and the flow was kept: the callback can be retried
+UPSTREAM_UNAVAILABLE_ERROR = "Myinfo is unavailable, try again later"
+
+# version, flags, created_at
+_HEADER = struct.Struct(">BBd")
+_VERSION = 1
+_HAS_KEYPAIR = 0x01
+_HAS_SCOPE_PROFILE = 0x02
+_P256_SCALAR_SIZE = 32
+# the scope profile name is prefixed with its length in one byte
+MAX_SCOPE_PROFILE_SIZE = 255
+
+
+class FlowState(NamedTuple):
+    state: str
+    keypair: Optional[JWK] = None
+    created_at: float = 0.0
+    scope_profile: Optional[str] = None
+
+
+def serialize_flow_state(flow_state: FlowState) -> bytes:
+    """
+    Packs the record in a few dozen bytes: a header, the raw P-256 private scalar instead of the
+    JSON export of the whole JWK, and the length-prefixed scope profile name.
+    """
+    flags = 0
+    body = b""
+    if flow_state.keypair is not None:
+        flags |= _HAS_KEYPAIR
+        private_value = flow_state.keypair.get_op_key("sign").private_numbers().private_value
+        body = private_value.to_bytes(_P256_SCALAR_SIZE, "big")
+    if flow_state.scope_profile is not None:
+        flags |= _HAS_SCOPE_PROFILE
+        scope_profile = flow_state.scope_profile.encode()
+        body += bytes([len(scope_profile)]) + scope_profile
+    return _HEADER.pack(_VERSION, flags, flow_state.created_at) + body
+
+
+def deserialize_flow_state(state: str, data: bytes) -> FlowState:
+    version, flags, created_at = _HEADER.unpack_from(data)
+    if version != _VERSION:
+        raise ValueError(f"Unsupported flow state version {version}")
+
+    keypair = None
+    offset = _HEADER.size
+    if flags & _HAS_KEYPAIR:
+        scalar = data[offset:offset + _P256_SCALAR_SIZE]
+        private_key = ec.derive_private_key(int.from_bytes(scalar, "big"), ec.SECP256R1())
+        keypair = JWK.from_pyca(private_key)
+        offset += _P256_SCALAR_SIZE
+    scope_profile = None
+    if flags & _HAS_SCOPE_PROFILE:
+        size = data[offset]
+        scope_profile = data[offset + 1:offset + 1 + size].decode()
+    return FlowState(state, keypair, created_at, scope_profile)
+
+
+def check_scope_profiles(scope_profiles: Dict[str, str]) -> None:
+    """
+    Raises ValueError when the name of a profile of MYINFO_SCOPE_PROFILES doesn't fit in a record,
+    so that it is reported at startup rather than by the logins that would use it.
+    """
+    for name in scope_profiles:
+        if len(name.encode()) > MAX_SCOPE_PROFILE_SIZE:
+            raise ValueError(
+                f"Myinfo scope profile names must be at most {MAX_SCOPE_PROFILE_SIZE} bytes, "
+                f"got {name[:20]!r}..."
+            )
+
+
+class FlowStateStore(object):
+    def create(
+        self,
+        state: str,
+        keypair: Optional[JWK] = None,
+        ttl: Optional[int] = None,
+        scope_profile: Optional[str] = None,
+    ):
+        raise NotImplementedError
+
+    def get(self, state: str) -> Optional[FlowState]:
+        """
+        Returns the record of `state` without consuming it.
+        """
+        raise NotImplementedError
+
+    def consume(self, state: str) -> Optional[FlowState]:
+        """
+        Returns and deletes the record of `state`. Of concurrent callers, only one gets it.
+        """
+        raise NotImplementedError
+
+    def delete(self, state: str) -> None:
+        raise NotImplementedError
+
+
+class CacheFlowStateStore(FlowStateStore):
+    """
+    Stores the records in the "flow" namespace of myinfo.cache, which always goes to the shared
+    Django cache so that any worker can complete any flow. `consume` is a single GETDEL on Redis.
+    """
+
+    def __init__(self, tiered_cache: Optional[TieredCache] = None):
+        self.cache = tiered_cache or get_cache("flow")
+
+    def create(self, state, keypair=None, ttl=None, scope_profile=None):
+        flow_state = FlowState(state, keypair, time.time(), scope_profile)
+        self.cache.set(state, serialize_flow_state(flow_state), ttl)
+        return flow_state
+
+    def get(self, state):
+        data = self.cache.get(state)
+        return None if not data else deserialize_flow_state(state, data)
+
+    def consume(self, state):
+        data = self.cache.pop(state)
+        return None if data is None else deserialize_flow_state(state, data)
+
+    def delete(self, state):
+        self.cache.delete(state)
+
+
+class InMemoryFlowStateStore(FlowStateStore):
+    """
+    Per-process store, for tests and single-process development servers.
+    """
+
+    def __init__(self):
+        self._records: Dict[str, Tuple[float, FlowState]] = {}
+        self._lock = threading.Lock()
+
+    def create(self, state, keypair=None, ttl=None, scope_profile=None):
+        now = time.time()
+        flow_state = FlowState(state, keypair, now, scope_profile)
+        with self._lock:
+            self._records[state] = (now + (FLOW_STATE_TTL if ttl is None else ttl), flow_state)
+        return flow_state
+
+    def get(self, state):
+        record = self._records.get(state)
+        if record is None or record[0] <= time.time():
+            return None
+        return record[1]
+
+    def consume(self, state):
+        with self._lock:
+            record = self._records.pop(state, None)
+        if record is None or record[0] <= time.time():
+            return None
+        return record[1]
+
+    def delete(self, state):
+        with self._lock:
+            self._records.pop(state, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._records.clear()
+
+
+FLOW_STATE_STORES = {
+    "cache": CacheFlowStateStore,
+    "memory": InMemoryFlowStateStore,
+}
+
+_flow_state_store: Optional[FlowStateStore] = None
+
+
+def get_flow_state_store() -> FlowStateStore:
+    """
+    Returns the store selected by the MYINFO_FLOW_STATE_STORE setting ("cache" by default).
+    """
+    global _flow_state_store
+    if _flow_state_store is None:
+        name = getattr(settings, "MYINFO_FLOW_STATE_STORE", "cache")
+        _flow_state_store = FLOW_STATE_STORES[name]()
+    return _flow_state_store
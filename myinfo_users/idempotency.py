@@ -0,0 +1,176 @@
+"""
+Idempotent handling of Myinfo callbacks, keyed by the authorization code.
+
+The first callback for a code takes a lock in the shared cache and runs the flow. Duplicates
+(browser refresh, double redirect) wait for it and get the same result instead of repeating the
+token exchange, which would fail upstream anyway since codes are single-use.
+
+Results are kept in the "idempotency" namespace of myinfo.cache, under a hash of the code and
+encrypted with AES-GCM under a key derived from the code and the OAuth state. Neither the cache
+nor a caller holding only the code can read them.
+"""
+import asyncio
+import json
+import os
+import time
+from hashlib import sha256
+from typing import Dict, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from myinfo import metrics
+from myinfo import settings as myinfo_settings
+from myinfo.cache import TieredCache, get_cache
+from myinfo_users.flow_state import INVALID_STATE_ERROR, UPSTREAM_UNAVAILABLE_ERROR
+
+IN_PROGRESS_ERROR = "Callback already in progress"
+# Errors of callbacks that didn't spend the code, which aren't kept for the next ones: a leaked code
+# sent first with a made-up state must not lock out the browser whose flow it is, and a callback
+# that failed fast on an open breaker must be retryable
+UNCACHED_ERRORS = {INVALID_STATE_ERROR, UPSTREAM_UNAVAILABLE_ERROR}
+
+_NONCE_SIZE = 12
+_KEY_INFO = b"myinfo_users.idempotency"
+
+Result = Tuple[Dict, bool]
+
+
+def get_idempotency_key(auth_code: str) -> str:
+    return sha256(auth_code.encode()).hexdigest()
+
+
+def derive_result_key(auth_code: str, state: str) -> bytes:
+    return HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=state.encode(), info=_KEY_INFO
+    ).derive(auth_code.encode())
+
+
+def encrypt_result(key: bytes, idempotency_key: str, result: Result) -> bytes:
+    nonce = os.urandom(_NONCE_SIZE)
+    plaintext = json.dumps(result, separators=(",", ":")).encode()
+    return nonce + AESGCM(key).encrypt(nonce, plaintext, idempotency_key.encode())
+
+
+def decrypt_result(key: bytes, idempotency_key: str, data: bytes) -> Result:
+    """
+    Raises:
+        cryptography.exceptions.InvalidTag: when `key` was derived from another state.
+    """
+    nonce, ciphertext = data[:_NONCE_SIZE], data[_NONCE_SIZE:]
+    person_data, success = json.loads(
+        AESGCM(key).decrypt(nonce, ciphertext, idempotency_key.encode())
+    )
+    return person_data, success
+
+
+def is_final(result: Result) -> bool:
+    """
+    Returns whether `result` settles the code, and is replayed to the callbacks that follow.
+    """
+    data, success = result
+    return success or data.get("error") not in UNCACHED_ERRORS
+
+
+class IdempotentCallbacks(object):
+    """
+    Runs each callback at most once per auth code, across all the workers sharing the cache.
+    """
+
+    poll_interval = 0.05
+
+    def __init__(self, tiered_cache: Optional[TieredCache] = None, wait_timeout=None):
+        self.cache = tiered_cache or get_cache("idempotency")
+        wait_timeout = (
+            myinfo_settings.MYINFO_IDEMPOTENCY_WAIT if wait_timeout is None else wait_timeout
+        )
+        # a duplicate answers within its own callback budget
+        self.wait_timeout = min(wait_timeout, myinfo_settings.MYINFO_CALLBACK_BUDGET)
+        # the first callback holds the code for as long as its flow may run
+        self.lock_timeout = myinfo_settings.MYINFO_CALLBACK_BUDGET
+
+    def run(self, auth_code: str, state: str, fn, *args) -> Result:
+        """
+        Returns `fn(*args)`, or the result of the first call for `auth_code`, or IN_PROGRESS_ERROR
+        when the first call doesn't complete within `wait_timeout`.
+        """
+        idempotency_key = get_idempotency_key(auth_code)
+        key = derive_result_key(auth_code, state)
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            result = self.get_result(idempotency_key, key)
+            if result is not None:
+                return result
+            if self.cache.add(f"{idempotency_key}:lock", 1, self.lock_timeout):
+                try:
+                    result = fn(*args)
+                    if is_final(result):
+                        self.set_result(idempotency_key, key, result)
+                    return result
+                finally:
+                    self.cache.delete(f"{idempotency_key}:lock")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return {"error": IN_PROGRESS_ERROR}, False
+            metrics.CACHE_REQUESTS.inc(cache="idempotency", result="wait")
+            time.sleep(min(self.poll_interval, remaining))
+
+    async def arun(self, auth_code: str, state: str, fn, *args) -> Result:
+        """
+        Coroutine version of `run`, where `fn` is a coroutine function. The cache calls only do
+        I/O, so they run on the default executor instead of the single thread shared by
+        thread-sensitive code, where concurrent callbacks would queue behind each other.
+        """
+        get_result = sync_to_async(self.get_result, thread_sensitive=False)
+        set_result = sync_to_async(self.set_result, thread_sensitive=False)
+        add = sync_to_async(self.cache.add, thread_sensitive=False)
+        delete = sync_to_async(self.cache.delete, thread_sensitive=False)
+
+        idempotency_key = get_idempotency_key(auth_code)
+        key = derive_result_key(auth_code, state)
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            result = await get_result(idempotency_key, key)
+            if result is not None:
+                return result
+            if await add(f"{idempotency_key}:lock", 1, self.lock_timeout):
+                try:
+                    result = await fn(*args)
+                    if is_final(result):
+                        await set_result(idempotency_key, key, result)
+                    return result
+                finally:
+                    await delete(f"{idempotency_key}:lock")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return {"error": IN_PROGRESS_ERROR}, False
+            metrics.CACHE_REQUESTS.inc(cache="idempotency", result="wait")
+            await asyncio.sleep(min(self.poll_interval, remaining))
+
+    def get_result(self, idempotency_key: str, key: bytes) -> Optional[Result]:
+        data = self.cache.get(idempotency_key)
+        if not data:
+            return None
+        try:
+            result = decrypt_result(key, idempotency_key, data)
+        except InvalidTag:
+            # same code with another state: not the browser that started this flow
+            return {"error": INVALID_STATE_ERROR}, False
+        metrics.CACHE_REQUESTS.inc(cache="idempotency", result="replayed")
+        return result
+
+    def set_result(self, idempotency_key: str, key: bytes, result: Result) -> None:
+        self.cache.set(idempotency_key, encrypt_result(key, idempotency_key, result))
+
+
+_idempotent_callbacks: Optional[IdempotentCallbacks] = None
+
+
+def get_idempotent_callbacks() -> IdempotentCallbacks:
+    global _idempotent_callbacks
+    if _idempotent_callbacks is None:
+        _idempotent_callbacks = IdempotentCallbacks()
+    return _idempotent_callbacks
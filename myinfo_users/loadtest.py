@@ -0,0 +1,346 @@
+"""
+Concurrent end-to-end load generator for the /auth -> authorize -> /callback flow.
+
+Each simulated user drives the Django views in-process through `django.test.Client`, and
+authorizes against a Myinfo emulator (see myinfo.emulator), so the measured work is everything a
+worker does for a real login: views, token exchange, JWKS, DPoP, JWE/JWS.
+
+In async mode, the users are coroutines of a single event loop calling the ASGI application, as
+an ASGI server would, so they share the loop's HTTP client and connections to Myinfo.
+"""
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import httpx
+import requests
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.test import Client
+from django.urls import reverse
+
+from myinfo import metrics, transport
+from myinfo.security import crypto_executor
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# "queue" is the wait between an open-loop arrival and the start of its login
+STAGES = ("queue", "auth", "authorize", "callback", "total")
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """
+    Returns the `q` percentile (0-100) of `sorted_values`, by nearest rank.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(q / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+
+def snapshot_stage_durations() -> Dict[str, tuple]:
+    """
+    Returns (sum, count) of each stage recorded by myinfo.metrics in this process.
+    """
+    series = dict(metrics.STAGE_DURATION._values)
+    return {key[0]: (values[-2], values[-1]) for key, values in series.items()}
+
+
+class LoadTestResult(object):
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self.completed = 0
+        self._lock = threading.Lock()
+
+    def record(self, latencies: Dict[str, float]) -> None:
+        with self._lock:
+            for stage, seconds in latencies.items():
+                self.latencies[stage].append(seconds)
+            self.completed += 1
+
+    def record_error(self, stage: str, error: str) -> None:
+        with self._lock:
+            self.errors[f"{stage}: {error}"] += 1
+
+    def get_stage_summary(self, stage: str) -> dict:
+        values = sorted(self.latencies.get(stage, []))
+        return {
+            "count": len(values),
+            "mean": sum(values) / len(values) if values else 0.0,
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": values[-1] if values else 0.0,
+        }
+
+
+class LoadGenerator(object):
+    """
+    Runs `users` simulated logins with at most `concurrency` in flight.
+
+    Without `rate`, each worker starts the next login as soon as the previous one completes (closed
+    loop, measures capacity). With `rate`, logins arrive at `rate` per second regardless of how
+    fast they complete (open loop, measures latency under a given traffic), and their latency is
+    measured from their scheduled arrival, so that a saturated generator doesn't hide the wait.
+    """
+
+    def __init__(
+        self,
+        users: int = 100,
+        concurrency: int = 10,
+        rate: Optional[float] = None,
+        use_async: bool = False,
+    ):
+        self.users = users
+        self.concurrency = concurrency
+        self.rate = rate
+        self.use_async = use_async
+        self.result = LoadTestResult()
+        self._local = threading.local()
+
+    def get_urls(self):
+        if self.use_async:
+            return reverse("myinfo-auth-async"), reverse("myinfo-callback-async")
+        return reverse("myinfo-auth"), reverse("myinfo-callback")
+
+    @staticmethod
+    def get_host() -> str:
+        # an empty ALLOWED_HOSTS only accepts localhost, and only with DEBUG on
+        allowed_hosts = [host for host in settings.ALLOWED_HOSTS if host != "*"]
+        return allowed_hosts[0].lstrip(".") if allowed_hosts else "localhost"
+
+    def get_client(self) -> Client:
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = Client(HTTP_HOST=self.get_host())
+        return client
+
+    def get_session(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    @staticmethod
+    def start_user(scheduled_at: Optional[float]) -> tuple:
+        """
+        Returns the latencies of a login starting now and the time its total is measured from.
+        """
+        started_at = time.perf_counter()
+        if scheduled_at is None:
+            return {}, started_at
+        return {"queue": max(started_at - scheduled_at, 0.0)}, scheduled_at
+
+    def run_user(self, scheduled_at: Optional[float] = None) -> None:
+        auth_path, callback_path = self.get_urls()
+        client = self.get_client()
+        latencies, started_at = self.start_user(scheduled_at)
+
+        stage = "auth"
+        try:
+            stage_started_at = time.perf_counter()
+            response = client.get(auth_path)
+            latencies[stage] = time.perf_counter() - stage_started_at
+            if response.status_code != 200:
+                return self.result.record_error(stage, str(response.status_code))
+            authorise_url = response.json()
+
+            stage = "authorize"
+            stage_started_at = time.perf_counter()
+            response = self.get_session().get(authorise_url, allow_redirects=False)
+            latencies[stage] = time.perf_counter() - stage_started_at
+            if response.status_code != 302:
+                return self.result.record_error(stage, str(response.status_code))
+            code = parse_qs(urlparse(response.headers["Location"]).query)["code"][0]
+
+            stage = "callback"
+            stage_started_at = time.perf_counter()
+            response = client.get(callback_path, {"code": code})
+            latencies[stage] = time.perf_counter() - stage_started_at
+            if response.status_code != 200:
+                return self.result.record_error(stage, str(response.status_code))
+        except Exception as e:
+            logger.debug("Simulated login failed at %s", stage, exc_info=True)
+            return self.result.record_error(stage, type(e).__name__)
+
+        latencies["total"] = time.perf_counter() - started_at
+        self.result.record(latencies)
+
+    async def arun_user(
+        self,
+        client: httpx.AsyncClient,
+        emulator: httpx.AsyncClient,
+        scheduled_at: Optional[float] = None,
+    ) -> None:
+        auth_path, callback_path = self.get_urls()
+        latencies, started_at = self.start_user(scheduled_at)
+
+        stage = "auth"
+        try:
+            stage_started_at = time.perf_counter()
+            response = await client.get(auth_path)
+            latencies[stage] = time.perf_counter() - stage_started_at
+            if response.status_code != 200:
+                return self.result.record_error(stage, str(response.status_code))
+            authorise_url = response.json()
+
+            stage = "authorize"
+            stage_started_at = time.perf_counter()
+            response = await emulator.get(authorise_url)
+            latencies[stage] = time.perf_counter() - stage_started_at
+            if response.status_code != 302:
+                return self.result.record_error(stage, str(response.status_code))
+            code = parse_qs(urlparse(response.headers["Location"]).query)["code"][0]
+
+            stage = "callback"
+            stage_started_at = time.perf_counter()
+            response = await client.get(callback_path, params={"code": code})
+            latencies[stage] = time.perf_counter() - stage_started_at
+            if response.status_code != 200:
+                return self.result.record_error(stage, str(response.status_code))
+        except Exception as e:
+            logger.debug("Simulated login failed at %s", stage, exc_info=True)
+            return self.result.record_error(stage, type(e).__name__)
+
+        latencies["total"] = time.perf_counter() - started_at
+        self.result.record(latencies)
+
+    def run_users(self, started_at: float) -> None:
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for i in range(self.users):
+                scheduled_at = None
+                if self.rate:
+                    # open loop: hold each arrival until its scheduled time
+                    scheduled_at = started_at + i / self.rate
+                    delay = scheduled_at - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                executor.submit(self.run_user, scheduled_at)
+
+    async def arun_users(self, started_at: float) -> None:
+        app = ASGIHandler()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_user(scheduled_at):
+            async with semaphore:
+                # a client per user for its own session cookie, over the same application
+                async with httpx.AsyncClient(
+                    transport=httpx.ASGITransport(app=app), base_url=f"http://{self.get_host()}"
+                ) as client:
+                    await self.arun_user(client, emulator, scheduled_at)
+
+        async with httpx.AsyncClient() as emulator:
+            try:
+                tasks = []
+                for i in range(self.users):
+                    scheduled_at = None
+                    if self.rate:
+                        scheduled_at = started_at + i / self.rate
+                        delay = scheduled_at - time.perf_counter()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    tasks.append(asyncio.create_task(run_user(scheduled_at)))
+                await asyncio.gather(*tasks)
+            finally:
+                await transport.close_async_client()
+
+    def run(self) -> dict:
+        stage_durations = snapshot_stage_durations()
+        cpu_started_at = time.process_time()
+        max_rss = get_max_rss()
+        started_at = time.perf_counter()
+
+        if self.use_async:
+            asyncio.run(self.arun_users(started_at))
+        else:
+            self.run_users(started_at)
+
+        elapsed = time.perf_counter() - started_at
+        cpu_seconds = time.process_time() - cpu_started_at
+        if max_rss is not None:
+            max_rss = max(max_rss, get_max_rss())
+
+        upstream_stages = {}
+        for stage, (total, count) in snapshot_stage_durations().items():
+            previous_total, previous_count = stage_durations.get(stage, (0.0, 0))
+            if count > previous_count:
+                upstream_stages[stage] = (total - previous_total) / (count - previous_count)
+
+        return {
+            "users": self.users,
+            "concurrency": self.concurrency,
+            "rate": self.rate,
+            "async": self.use_async,
+            "crypto_executor": crypto_executor.mode,
+            "completed": self.result.completed,
+            "errors": dict(self.result.errors),
+            "elapsed": elapsed,
+            "throughput": self.result.completed / elapsed if elapsed else 0.0,
+            "cpu_seconds": cpu_seconds,
+            "cpu_utilization": cpu_seconds / elapsed if elapsed else 0.0,
+            "max_rss_kb": max_rss,
+            "stages": {stage: self.result.get_stage_summary(stage) for stage in STAGES},
+            "upstream_stages_mean": upstream_stages,
+        }
+
+
+def get_max_rss() -> Optional[int]:
+    """
+    Returns the peak RSS of this process in KB, or None where `resource` isn't available.
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def format_report(report: dict) -> str:
+    max_rss = report["max_rss_kb"]
+    lines = [
+        f"users={report['users']} concurrency={report['concurrency']} "
+        f"rate={report['rate'] or 'closed-loop'} async={report['async']}",
+        f"completed {report['completed']} logins in {report['elapsed']:.2f}s "
+        f"({report['throughput']:.1f} logins/s)",
+        f"worker CPU {report['cpu_seconds']:.2f}s ({report['cpu_utilization']:.0%} of one core), "
+        f"max RSS {f'{max_rss / 1024:.0f} MB' if max_rss is not None else 'n/a'}",
+    ]
+    if report["crypto_executor"] == "process":
+        lines.append("  (excluding the CPU and memory of the crypto executor processes)")
+    if "emulator_cpu_seconds" in report:
+        lines.append(
+            f"  (excluding the {report['emulator_cpu_seconds']:.2f}s CPU of the in-process "
+            "emulator, whose work still adds to the latencies: pass --emulator-url to run it apart)"
+        )
+    lines += [
+        "",
+        f"{'stage':<12}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}",
+    ]
+    for stage, summary in report["stages"].items():
+        if not summary["count"]:
+            continue
+        lines.append(
+            f"{stage:<12}{summary['count']:>8}"
+            + "".join(
+                f"{summary[key] * 1000:>8.1f}ms" for key in ("mean", "p50", "p95", "p99", "max")
+            )
+        )
+    if report["upstream_stages_mean"]:
+        lines += ["", "flow stages (mean, from myinfo.metrics)"]
+        for stage, seconds in sorted(report["upstream_stages_mean"].items()):
+            lines.append(f"  {stage:<22}{seconds * 1000:>8.1f}ms")
+    if report["errors"]:
+        lines += ["", "errors"]
+        for error, count in sorted(report["errors"].items(), key=lambda item: -item[1]):
+            lines.append(f"  {count:>6}  {error}")
+    return "\n".join(lines)
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from myinfo import benchmarks
+
+
+class Command(BaseCommand):
+    help = "Benchmark the myinfo.security primitives, and save or compare against a baseline."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "names", nargs="*", help="Only run the benchmarks whose name contains one of these."
+        )
+        parser.add_argument("--repeat", type=int, default=5, help="Timed rounds per benchmark.")
+        parser.add_argument(
+            "--min-time", type=float, default=0.2, help="Minimum seconds of each timed round."
+        )
+        parser.add_argument(
+            "--baseline", default=benchmarks.DEFAULT_BASELINE_PATH, help="Baseline JSON file."
+        )
+        parser.add_argument("--save", action="store_true", help="Save the results as baseline.")
+        parser.add_argument(
+            "--compare",
+            action="store_true",
+            help="Fail when a benchmark is slower than the baseline by more than --threshold.",
+        )
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=benchmarks.DEFAULT_THRESHOLD,
+            help="Allowed slowdown for --compare, 0.2 is 20%%.",
+        )
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["compare"]:
+            try:
+                baseline = benchmarks.load_baseline(options["baseline"])
+            except FileNotFoundError:
+                raise CommandError(f"No baseline at {options['baseline']}, run with --save first")
+
+        results = benchmarks.run(
+            options["names"], repeat=options["repeat"], min_time=options["min_time"]
+        )
+        self.stdout.write(benchmarks.format_results(results, baseline))
+
+        if options["save"]:
+            benchmarks.save_baseline(results, options["baseline"])
+            self.stdout.write(f"Saved baseline to {options['baseline']}")
+
+        if baseline is not None:
+            regressions = benchmarks.compare(results, baseline, threshold=options["threshold"])
+            if regressions:
+                raise CommandError(
+                    "Regressions beyond {:.0%}: {}".format(
+                        options["threshold"],
+                        ", ".join(f"{r.name} ({r.ratio - 1:+.1%})" for r in regressions),
+                    )
+                )
+            self.stdout.write(f"No regression beyond {options['threshold']:.0%}")
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+
+from myinfo.emulator import MyInfoEmulator, MyInfoEmulatorServer, build_persona, get_client_environ
+
+
+class Command(BaseCommand):
+    help = "Serve a local Myinfo v4 emulator issuing real signed and encrypted responses."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=5156)
+        parser.add_argument(
+            "--latency", type=float, default=0.0, help="Seconds added to every API response."
+        )
+        parser.add_argument(
+            "--latency-jitter",
+            type=float,
+            default=0.0,
+            help="Random extra latency, uniformly drawn between 0 and this many seconds.",
+        )
+        parser.add_argument(
+            "--error-rate",
+            type=float,
+            default=0.0,
+            help="Share of API calls answered with a 503, between 0 and 1.",
+        )
+        parser.add_argument(
+            "--history-months",
+            type=int,
+            default=15,
+            help="Months of cpfcontributions/cpfemployers history in the persona.",
+        )
+        parser.add_argument("--verbose", action="store_true", help="Log every request.")
+
+    def handle(self, *args, **options):
+        emulator = MyInfoEmulator(
+            persona=build_persona(history_months=options["history_months"]),
+            latency=options["latency"],
+            latency_jitter=options["latency_jitter"],
+            error_rate=options["error_rate"],
+        )
+        server = MyInfoEmulatorServer(
+            (options["host"], options["port"]), emulator, verbose=options["verbose"]
+        )
+
+        self.stdout.write(f"Myinfo emulator listening on {server.base_url}")
+        self.stdout.write("Point the app at it with:")
+        for name, value in get_client_environ(server.base_url).items():
+            self.stdout.write(f"  export {name}={value}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
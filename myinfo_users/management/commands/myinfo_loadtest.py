@@ -0,0 +1,114 @@
+import json
+from unittest.mock import patch
+
+from django.core.management.base import BaseCommand
+
+from myinfo import settings as myinfo_settings
+from myinfo.emulator import build_persona, get_client_environ, start_emulator
+from myinfo.security import crypto_executor, jwks_store
+from myinfo_users.loadtest import LoadGenerator, format_report
+
+
+class Command(BaseCommand):
+    help = "Drive concurrent simulated logins through /auth -> authorize -> /callback."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=100, help="Number of simulated logins.")
+        parser.add_argument(
+            "--concurrency", type=int, default=10, help="Maximum logins in flight at once."
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=None,
+            help="Arrivals per second (open loop). Without it, workers loop as fast as they can.",
+        )
+        parser.add_argument(
+            "--emulator-url",
+            default=None,
+            help="Use an emulator already running there (e.g. `manage.py myinfo_emulator`) "
+            "instead of starting one in this process, where it competes with the app for the GIL "
+            "and so inflates its latencies.",
+        )
+        parser.add_argument(
+            "--async",
+            dest="use_async",
+            action="store_true",
+            help="Drive the /async/ endpoints through the ASGI application, on one event loop.",
+        )
+        parser.add_argument(
+            "--no-pool", action="store_true", help="Open a new HTTP session for every client."
+        )
+        parser.add_argument(
+            "--sequential",
+            action="store_true",
+            help="Disable the JWKS prefetch during the token exchange.",
+        )
+        parser.add_argument(
+            "--crypto-executor",
+            choices=("inline", "thread", "process"),
+            default=None,
+            help="Override MYINFO_CRYPTO_EXECUTOR for the run.",
+        )
+        parser.add_argument("--latency", type=float, default=0.0)
+        parser.add_argument("--latency-jitter", type=float, default=0.0)
+        parser.add_argument("--error-rate", type=float, default=0.0)
+        parser.add_argument("--history-months", type=int, default=15)
+        parser.add_argument("--json", dest="json_path", help="Also write the report to this file.")
+
+    def handle(self, *args, **options):
+        server = None
+        emulator_url = options["emulator_url"]
+        if emulator_url is None:
+            server = start_emulator(
+                persona=build_persona(history_months=options["history_months"]),
+                latency=options["latency"],
+                latency_jitter=options["latency_jitter"],
+                error_rate=options["error_rate"],
+            )
+            emulator_url = server.base_url
+
+        overrides = dict(get_client_environ(emulator_url))
+        if options["no_pool"]:
+            overrides["MYINFO_HTTP_POOLED"] = False
+        if options["sequential"]:
+            overrides["MYINFO_CONCURRENT_RETRIEVE"] = False
+
+        crypto_mode = crypto_executor.mode
+        if options["crypto_executor"]:
+            crypto_executor.shutdown()
+            crypto_executor.mode = options["crypto_executor"]
+
+        generator = LoadGenerator(
+            users=options["users"],
+            concurrency=options["concurrency"],
+            rate=options["rate"],
+            use_async=options["use_async"],
+        )
+        self.stdout.write(f"Running {options['users']} logins against {emulator_url}")
+        try:
+            with patch.multiple(myinfo_settings, **overrides):
+                jwks_store.clear()
+                report = generator.run()
+        finally:
+            jwks_store.clear()
+            if options["crypto_executor"]:
+                crypto_executor.shutdown()
+                crypto_executor.mode = crypto_mode
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+
+        report["emulator_url"] = emulator_url
+        if server is not None:
+            # the emulator ran in this process: keep its CPU out of the worker's
+            emulator_cpu_seconds = min(server.cpu_seconds, report["cpu_seconds"])
+            report["emulator_cpu_seconds"] = emulator_cpu_seconds
+            report["cpu_seconds"] -= emulator_cpu_seconds
+            report["cpu_utilization"] = (
+                report["cpu_seconds"] / report["elapsed"] if report["elapsed"] else 0.0
+            )
+        self.stdout.write(format_report(report))
+        if options["json_path"]:
+            with open(options["json_path"], "w") as f:
+                json.dump(report, f, indent=2)
@@ -1,14 +1,30 @@
 import logging
+import time
 from typing import Dict, Optional, Tuple
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.core.cache import cache
 from django.utils.crypto import get_random_string
 
-from myinfo.client import MyInfoPersonalClientV4
+from myinfo import settings as myinfo_settings
+from myinfo.client import AsyncMyInfoPersonalClientV4, MyInfoPersonalClientV4
+from myinfo.resilience import BulkheadFullError, CircuitOpenError, Deadline, DeadlineExceeded
+from myinfo.security import keypair_pool
+from myinfo_users.flow_state import (
+    FLOW_STATE_TTL,
+    INVALID_STATE_ERROR,
+    UPSTREAM_UNAVAILABLE_ERROR,
+    FlowState,
+    FlowStateStore,
+    get_flow_state_store,
+)
+from myinfo_users.idempotency import get_idempotent_callbacks
 
 logger = logging.getLogger(__name__)
 
+DEADLINE_EXCEEDED_ERROR = "Myinfo did not respond in time"
+RESTART_FLOW_ERROR = "Myinfo is unavailable, start the login again"
+
 
 class MyInfoService:
     """
@@ -23,104 +39,189 @@ class MyInfoService:
         return get_random_string(length=16)
 
     @staticmethod
-    def get_authorize_url(state: str, callback_url: Optional[str] = None) -> str:
+    def get_authorize_url(
+        state: str, callback_url: Optional[str] = None, scope_profile: Optional[str] = None
+    ) -> str:
         """
         Get MyInfo authorize URL
         """
         callback = callback_url or settings.MYINFO_CALLBACK_URL
         client = MyInfoPersonalClientV4()
-        return client.get_authorise_url(state, callback)
+        return client.get_authorise_url(state, callback, scope_profile)
 
     @staticmethod
-    def store_state(state: str, ttl: int = 600) -> None:
-        """
-        Store state in cache with TTL (default 10 minutes)
-        """
-        cache_key = f'myinfo:state:{state}'
-        cache.set(cache_key, True, ttl)
+    def get_flow_state_store() -> FlowStateStore:
+        return get_flow_state_store()
 
-    @staticmethod
-    def verify_state(state: str) -> bool:
+    @classmethod
+    def verify_state(cls, state: str) -> bool:
         """
-        Verify if state exists in cache
+        Verify if state exists in cache, without consuming it
         """
-        cache_key = f'myinfo:state:{state}'
-        return cache.get(cache_key) is not None
+        return cls.get_flow_state_store().get(state) is not None
 
-    @staticmethod
-    def delete_state(state: str) -> None:
+    @classmethod
+    def delete_state(cls, state: str) -> None:
         """
         Delete state from cache
         """
-        cache_key = f'myinfo:state:{state}'
-        cache.delete(cache_key)
-
-    @staticmethod
-    def store_session_keys(state: str, keypair) -> None:
-        """
-        Store session ephemeral keypair with state
-        """
-        cache_key = f'myinfo:keys:{state}'
-        # Store private key as JSON string
-        cache.set(cache_key, keypair.export_private(), 600)  # 10 minutes TTL
+        cls.get_flow_state_store().delete(state)
 
-    @staticmethod
-    def get_session_keys(state: str):
+    @classmethod
+    def get_session_keys(cls, state: str):
         """
         Get session ephemeral keypair for state
         """
-        from jwcrypto import jwk
-        cache_key = f'myinfo:keys:{state}'
-        key_json = cache.get(cache_key)
-        if not key_json:
-            return None
-        return jwk.JWK.from_json(key_json)
+        flow_state = cls.get_flow_state_store().get(state)
+        return flow_state.keypair if flow_state else None
 
     @classmethod
     def retrieve_person_data(cls, auth_code: str, state: str, callback_url: Optional[str] = None) -> Tuple[Dict, bool]:
         """
-        Retrieve person data from MyInfo
+        Retrieve person data from MyInfo, once per auth code: duplicate callbacks get the result
+        of the first one
 
         Returns:
             Tuple[Dict, bool]: Person data and success flag
         """
+        return get_idempotent_callbacks().run(
+            auth_code, state, cls._retrieve_person_data, auth_code, state, callback_url
+        )
+
+    @classmethod
+    def _retrieve_person_data(cls, auth_code: str, state: str, callback_url: Optional[str] = None) -> Tuple[Dict, bool]:
+        # the whole callback draws from one budget, past which the frontend has given up
+        deadline = Deadline(myinfo_settings.MYINFO_CALLBACK_BUDGET)
         client = MyInfoPersonalClientV4()
         callback = callback_url or settings.MYINFO_CALLBACK_URL
 
-        # Verify state
-        if not cls.verify_state(state):
+        # Verify and consume state in one step, so that a replayed callback finds nothing
+        flow_state = cls.get_flow_state_store().consume(state)
+        if flow_state is None:
             logger.error(f"Invalid state: {state}")
-            return {"error": "Invalid state parameter"}, False
+            return {"error": INVALID_STATE_ERROR}, False
 
         try:
-            # Generate ephemeral keypair
-            person_data = client.retrieve_resource(auth_code, state, callback)
+            person_data = client.retrieve_resource(
+                auth_code,
+                state,
+                callback,
+                session_ephemeral_keypair=flow_state.keypair,
+                deadline=deadline,
+                scope_profile=flow_state.scope_profile,
+            )
             return person_data, True
+        except DeadlineExceeded as e:
+            logger.warning(f"Error retrieving person data: {e}")
+            return {"error": DEADLINE_EXCEEDED_ERROR}, False
+        except (CircuitOpenError, BulkheadFullError) as e:
+            return cls._fail_fast(flow_state, e)
         except Exception as e:
             logger.exception(f"Error retrieving person data: {e}")
             return {"error": str(e)}, False
-        finally:
-            # Clean up state
-            cls.delete_state(state)
 
     @classmethod
-    def initiate_myinfo_flow(cls, callback_url: Optional[str] = None) -> Dict:
+    def _fail_fast(cls, flow_state: FlowState, error: Exception) -> Tuple[Dict, bool]:
         """
-        Initiate MyInfo authentication flow
+        Result of a callback failed fast on an open circuit breaker or a full bulkhead. Before the
+        token exchange, the code is unspent: the flow is put back so that the callback can be
+        retried. Past it, the user has to start a new login.
+        """
+        logger.warning(f"Error retrieving person data: {error}")
+        ttl = int(FLOW_STATE_TTL - (time.time() - flow_state.created_at))
+        if error.endpoint != "token" or ttl <= 0:
+            return {"error": RESTART_FLOW_ERROR}, False
+        cls.get_flow_state_store().create(
+            flow_state.state, flow_state.keypair, ttl=ttl, scope_profile=flow_state.scope_profile
+        )
+        return {"error": UPSTREAM_UNAVAILABLE_ERROR}, False
+
+    @classmethod
+    def initiate_myinfo_flow(
+        cls, callback_url: Optional[str] = None, scope_profile: Optional[str] = None
+    ) -> Dict:
+        """
+        Initiate MyInfo authentication flow, for the attributes of `scope_profile`
+        (MYINFO_DEFAULT_SCOPE_PROFILE by default)
 
         Returns:
             Dict with state and authorize URL
+
+        Raises:
+            ValueError: when `scope_profile` is not in MYINFO_SCOPE_PROFILES
         """
+        scope_profile = scope_profile or myinfo_settings.MYINFO_DEFAULT_SCOPE_PROFILE
+        MyInfoPersonalClientV4.get_scope(scope_profile)
         state = cls.generate_state()
         callback = callback_url or settings.MYINFO_CALLBACK_URL
 
-        # Store state in cache
-        cls.store_state(state)
+        # Store state, session ephemeral keypair and scope profile in a single record, so that
+        # the callback requests the attributes the user consented to
+        cls.get_flow_state_store().create(
+            state, keypair_pool.take(), scope_profile=scope_profile
+        )
 
         # Get authorize URL
-        authorize_url = cls.get_authorize_url(state, callback)
+        authorize_url = cls.get_authorize_url(state, callback, scope_profile)
 
         return {
             "state": state,
             "authorize_url": authorize_url
         }
+
+    @classmethod
+    async def ainitiate_myinfo_flow(
+        cls, callback_url: Optional[str] = None, scope_profile: Optional[str] = None
+    ) -> Dict:
+        """
+        Async version of initiate_myinfo_flow
+        """
+        # no database access: off the single thread of thread-sensitive code
+        return await sync_to_async(cls.initiate_myinfo_flow, thread_sensitive=False)(
+            callback_url, scope_profile
+        )
+
+    @classmethod
+    async def aretrieve_person_data(
+        cls, auth_code: str, state: str, callback_url: Optional[str] = None
+    ) -> Tuple[Dict, bool]:
+        """
+        Async version of retrieve_person_data, on the asyncio Myinfo client
+        """
+        return await get_idempotent_callbacks().arun(
+            auth_code, state, cls._aretrieve_person_data, auth_code, state, callback_url
+        )
+
+    @classmethod
+    async def _aretrieve_person_data(
+        cls, auth_code: str, state: str, callback_url: Optional[str] = None
+    ) -> Tuple[Dict, bool]:
+        deadline = Deadline(myinfo_settings.MYINFO_CALLBACK_BUDGET)
+        client = AsyncMyInfoPersonalClientV4()
+        callback = callback_url or settings.MYINFO_CALLBACK_URL
+
+        flow_state = await sync_to_async(
+            cls.get_flow_state_store().consume, thread_sensitive=False
+        )(state)
+        if flow_state is None:
+            logger.error(f"Invalid state: {state}")
+            return {"error": INVALID_STATE_ERROR}, False
+
+        try:
+            person_data = await client.retrieve_resource(
+                auth_code,
+                state,
+                callback,
+                session_ephemeral_keypair=flow_state.keypair,
+                deadline=deadline,
+                scope_profile=flow_state.scope_profile,
+            )
+            return person_data, True
+        except DeadlineExceeded as e:
+            logger.warning(f"Error retrieving person data: {e}")
+            return {"error": DEADLINE_EXCEEDED_ERROR}, False
+        except (CircuitOpenError, BulkheadFullError) as e:
+            return await sync_to_async(cls._fail_fast, thread_sensitive=False)(flow_state, e)
+        except Exception as e:
+            logger.exception(f"Error retrieving person data: {e}")
+            return {"error": str(e)}, False
@@ -1,7 +1,36 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import SimpleTestCase
 from django.urls import reverse
 from rest_framework.test import APITestCase
 from rest_framework import status
-from unittest.mock import patch
+from unittest.mock import ANY, AsyncMock, patch
+
+from myinfo import settings as myinfo_settings
+from myinfo.resilience import BulkheadFullError, CircuitOpenError, DeadlineExceeded
+from myinfo.security import generate_ephemeral_session_keypair
+from myinfo_users.admission import AdmissionController, get_queue_wait
+from myinfo_users.flow_state import (
+    CacheFlowStateStore,
+    FlowState,
+    InMemoryFlowStateStore,
+    deserialize_flow_state,
+    serialize_flow_state,
+)
+from myinfo_users.idempotency import IdempotentCallbacks, get_idempotency_key
+from myinfo_users.services import MyInfoService
 
 
 class MyInfoAuthViewTest(APITestCase):
@@ -15,19 +44,126 @@ class MyInfoAuthViewTest(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data, "https://test.api.myinfo.gov.sg/auth")
+        self.assertTrue(response.cookies["myinfo_state"]["httponly"])
+        self.assertEqual(mock_get_authorise_url.call_args.args[2], "credit")
+
+    def test_unknown_scope_profile(self):
+        response = self.client.get(reverse("myinfo-auth"), {"scope_profile": "everything"})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
 
 class MyInfoCallbackViewTest(APITestCase):
 
+    def setUp(self):
+        cache.clear()
+
     @patch("myinfo.client.MyInfoPersonalClientV4.retrieve_resource")
     def test_get_person_data_success(self, mock_retrieve_resource):
         mock_retrieve_resource.return_value = {"uinfin": "S1234567D", "name": "John Doe"}
 
+        self.client.get(reverse("myinfo-auth"))
+        url = reverse("myinfo-callback")
+        response = self.client.get(url, {"code": "valid_auth_code"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"uinfin": "S1234567D", "name": "John Doe"})
+        self.assertEqual(mock_retrieve_resource.call_args.args[2], "http://localhost:3001/callback")
+
+    @patch("myinfo.client.MyInfoPersonalClientV4.retrieve_resource")
+    def test_get_person_data_replayed(self, mock_retrieve_resource):
+        mock_retrieve_resource.return_value = {"uinfin": "S1234567D", "name": "John Doe"}
+        auth_response = self.client.get(reverse("myinfo-auth"))
+        state_cookie = auth_response.cookies["myinfo_state"]
+
+        url = reverse("myinfo-callback")
+        self.client.get(url, {"code": "valid_auth_code"})
+        self.client.cookies["myinfo_state"] = state_cookie.value
+        response = self.client.get(url, {"code": "another_auth_code"})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data, {"error": "Invalid state parameter"})
+        mock_retrieve_resource.assert_called_once()
+
+    @patch("myinfo.client.MyInfoPersonalClientV4.retrieve_resource")
+    def test_get_person_data_duplicate(self, mock_retrieve_resource):
+        mock_retrieve_resource.return_value = {"uinfin": "S1234567D", "name": "John Doe"}
+        auth_response = self.client.get(reverse("myinfo-auth"))
+        state_cookie = auth_response.cookies["myinfo_state"]
+
         url = reverse("myinfo-callback")
+        self.client.get(url, {"code": "valid_auth_code"})
+        self.client.cookies["myinfo_state"] = state_cookie.value
         response = self.client.get(url, {"code": "valid_auth_code"})
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data, {"uinfin": "S1234567D", "name": "John Doe"})
+        mock_retrieve_resource.assert_called_once()
+
+    @patch("myinfo.client.MyInfoPersonalClientV4.retrieve_resource")
+    def test_get_person_data_duplicate_from_another_flow(self, mock_retrieve_resource):
+        mock_retrieve_resource.return_value = {"uinfin": "S1234567D", "name": "John Doe"}
+        url = reverse("myinfo-callback")
+        self.client.get(reverse("myinfo-auth"))
+        self.client.get(url, {"code": "valid_auth_code"})
+
+        self.client.get(reverse("myinfo-auth"))
+        response = self.client.get(url, {"code": "valid_auth_code"})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data, {"error": "Invalid state parameter"})
+        mock_retrieve_resource.assert_called_once()
+
+    @patch("myinfo.client.MyInfoPersonalClientV4.retrieve_resource")
+    def test_get_person_data_deadline_exceeded(self, mock_retrieve_resource):
+        mock_retrieve_resource.side_effect = DeadlineExceeded("person")
+
+        self.client.get(reverse("myinfo-auth"))
+        response = self.client.get(reverse("myinfo-callback"), {"code": "valid_auth_code"})
+
+        self.assertEqual(response.status_code, status.HTTP_504_GATEWAY_TIMEOUT)
+        self.assertEqual(response.data, {"error": "Myinfo did not respond in time"})
+
+    @patch("myinfo_users.views.get_admission_controller")
+    @patch("myinfo.client.MyInfoPersonalClientV4.retrieve_resource")
+    def test_get_person_data_shed(self, mock_retrieve_resource, mock_get_admission_controller):
+        mock_retrieve_resource.return_value = {"uinfin": "S1234567D"}
+        admission_controller = AdmissionController(max_in_flight=1, retry_after=2)
+        admission_controller.in_flight = 1
+        mock_get_admission_controller.return_value = admission_controller
+
+        self.client.get(reverse("myinfo-auth"))
+        response = self.client.get(reverse("myinfo-callback"), {"code": "valid_auth_code"})
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response["Retry-After"], "2")
+        mock_retrieve_resource.assert_not_called()
+
+        admission_controller.in_flight = 0
+        response = self.client.get(reverse("myinfo-callback"), {"code": "valid_auth_code"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(admission_controller.in_flight, 0)
+
+    @patch("myinfo.client.MyInfoPersonalClientV4.retrieve_resource")
+    def test_get_person_data_shed_after_queue_wait(self, mock_retrieve_resource):
+        self.client.get(reverse("myinfo-auth"))
+        response = self.client.get(
+            reverse("myinfo-callback"),
+            {"code": "valid_auth_code"},
+            HTTP_X_REQUEST_START=f"t={time.time() - 60:.3f}",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIn("Retry-After", response)
+        mock_retrieve_resource.assert_not_called()
+
+    def test_get_person_data_missing_state(self):
+        url = reverse("myinfo-callback")
+        response = self.client.get(url, {"code": "valid_auth_code"})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data, ["Missing 'state' parameter."])
 
     def test_get_person_data_missing_code(self):
         url = reverse("myinfo-callback")
@@ -35,3 +171,368 @@ class MyInfoCallbackViewTest(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertEqual(response.data, ["Missing 'code' parameter."])
+
+
+class AsyncMyInfoCallbackViewTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    @patch("myinfo.client.AsyncMyInfoPersonalClientV4.retrieve_resource", new_callable=AsyncMock)
+    def test_get_person_data_success(self, mock_retrieve_resource):
+        mock_retrieve_resource.return_value = {"uinfin": "S1234567D", "name": "John Doe"}
+
+        self.client.get(reverse("myinfo-auth-async"))
+        url = reverse("myinfo-callback-async")
+        response = self.client.get(url, {"code": "valid_auth_code"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {"uinfin": "S1234567D", "name": "John Doe"})
+
+    def test_get_person_data_missing_code(self):
+        url = reverse("myinfo-callback-async")
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), ["Missing 'code' parameter."])
+
+
+class MyInfoMetricsViewTest(APITestCase):
+
+    def test_get_metrics(self):
+        response = self.client.get(reverse("metrics"))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        self.assertIn(b"# TYPE myinfo_stage_duration_seconds histogram", response.content)
+
+
+class MyInfoLoadTestCommandTest(APITestCase):
+
+    @patch("myinfo.security.JWKSStore._get_shared", return_value=None)
+    def test_run_against_emulator(self, _):
+        path = os.path.join(tempfile.mkdtemp(), "report.json")
+
+        call_command(
+            "myinfo_loadtest", users=4, concurrency=2, history_months=2, json_path=path,
+            stdout=StringIO(),
+        )
+
+        with open(path) as f:
+            report = json.load(f)
+        self.assertEqual(report["completed"], 4)
+        self.assertEqual(report["errors"], {})
+        self.assertEqual(report["stages"]["callback"]["count"], 4)
+        self.assertIn("person_get", report["upstream_stages_mean"])
+        self.assertGreater(report["emulator_cpu_seconds"], 0)
+
+    @patch("myinfo.security.JWKSStore._get_shared", return_value=None)
+    def test_run_async_against_emulator(self, _):
+        path = os.path.join(tempfile.mkdtemp(), "report.json")
+
+        call_command(
+            "myinfo_loadtest", users=4, concurrency=2, history_months=2, json_path=path,
+            use_async=True, stdout=StringIO(),
+        )
+
+        with open(path) as f:
+            report = json.load(f)
+        self.assertTrue(report["async"])
+        self.assertEqual(report["errors"], {})
+        self.assertEqual(report["stages"]["callback"]["count"], 4)
+
+    @patch("myinfo.security.JWKSStore._get_shared", return_value=None)
+    def test_open_loop_latency_includes_the_queue(self, _):
+        path = os.path.join(tempfile.mkdtemp(), "report.json")
+
+        call_command(
+            "myinfo_loadtest", users=4, concurrency=1, rate=1000, history_months=2,
+            crypto_executor="process", json_path=path, stdout=StringIO(),
+        )
+
+        with open(path) as f:
+            report = json.load(f)
+        stages = report["stages"]
+        self.assertEqual(stages["queue"]["count"], 4)
+        # later arrivals waited for the single worker, and their total counts the wait
+        self.assertGreater(stages["queue"]["max"], 0)
+        self.assertEqual(report["crypto_executor"], "process")
+
+
+class FlowStateStoreTest(SimpleTestCase):
+
+    def test_serialization_round_trip(self):
+        keypair = generate_ephemeral_session_keypair()
+        flow_state = FlowState("abc123", keypair, 1700000000.5)
+
+        data = serialize_flow_state(flow_state)
+        restored = deserialize_flow_state("abc123", data)
+
+        self.assertEqual(len(data), 42)
+        self.assertEqual(restored.created_at, 1700000000.5)
+        self.assertEqual(restored.keypair.thumbprint(), keypair.thumbprint())
+        self.assertIsNone(restored.scope_profile)
+
+        restored = deserialize_flow_state(
+            "abc123", serialize_flow_state(flow_state._replace(scope_profile="identity"))
+        )
+        self.assertEqual(restored.scope_profile, "identity")
+        self.assertEqual(restored.keypair.thumbprint(), keypair.thumbprint())
+
+    def test_consume_once(self):
+        for store in (InMemoryFlowStateStore(), CacheFlowStateStore()):
+            with self.subTest(store=type(store).__name__):
+                keypair = generate_ephemeral_session_keypair()
+                store.create("abc123", keypair)
+
+                self.assertEqual(store.get("abc123").keypair.thumbprint(), keypair.thumbprint())
+                self.assertEqual(
+                    store.consume("abc123").keypair.thumbprint(), keypair.thumbprint()
+                )
+                self.assertIsNone(store.consume("abc123"))
+                self.assertIsNone(store.get("abc123"))
+
+    def test_expired(self):
+        store = InMemoryFlowStateStore()
+        store.create("abc123", ttl=0)
+
+        self.assertIsNone(store.consume("abc123"))
+
+
+@patch("myinfo_users.services.get_flow_state_store", return_value=InMemoryFlowStateStore())
+class MyInfoServiceTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    @patch("myinfo.client.MyInfoPersonalClientV4.retrieve_resource")
+    def test_retrieve_person_data(self, mock_retrieve_resource, _):
+        mock_retrieve_resource.return_value = {"uinfin": "S1234567D"}
+        flow = MyInfoService.initiate_myinfo_flow("http://localhost:3001/callback")
+        keypair = MyInfoService.get_session_keys(flow["state"])
+
+        result = MyInfoService.retrieve_person_data(
+            "valid_auth_code", flow["state"], "http://localhost:3001/callback"
+        )
+        duplicate = MyInfoService.retrieve_person_data(
+            "valid_auth_code", flow["state"], "http://localhost:3001/callback"
+        )
+        replayed = MyInfoService.retrieve_person_data(
+            "another_auth_code", flow["state"], "http://localhost:3001/callback"
+        )
+
+        self.assertEqual(result, ({"uinfin": "S1234567D"}, True))
+        self.assertEqual(duplicate, result)
+        self.assertEqual(replayed, ({"error": "Invalid state parameter"}, False))
+        mock_retrieve_resource.assert_called_once_with(
+            "valid_auth_code",
+            flow["state"],
+            "http://localhost:3001/callback",
+            session_ephemeral_keypair=keypair,
+            deadline=ANY,
+            scope_profile="credit",
+        )
+
+    @patch("myinfo.client.MyInfoPersonalClientV4.retrieve_resource")
+    def test_bogus_state_first_does_not_block_the_flow(self, mock_retrieve_resource, _):
+        mock_retrieve_resource.return_value = {"uinfin": "S1234567D"}
+        flow = MyInfoService.initiate_myinfo_flow("http://localhost:3001/callback")
+
+        bogus = MyInfoService.retrieve_person_data(
+            "valid_auth_code", "bogus", "http://localhost:3001/callback"
+        )
+        result = MyInfoService.retrieve_person_data(
+            "valid_auth_code", flow["state"], "http://localhost:3001/callback"
+        )
+
+        self.assertEqual(bogus, ({"error": "Invalid state parameter"}, False))
+        self.assertEqual(result, ({"uinfin": "S1234567D"}, True))
+        self.assertFalse(MyInfoService.verify_state(flow["state"]))
+
+    @patch("myinfo.client.MyInfoPersonalClientV4.retrieve_resource")
+    def test_open_token_circuit_keeps_the_flow(self, mock_retrieve_resource, _):
+        mock_retrieve_resource.side_effect = [CircuitOpenError("token", 5), {"uinfin": "S1234567D"}]
+        flow = MyInfoService.initiate_myinfo_flow("http://localhost:3001/callback")
+
+        failed = MyInfoService.retrieve_person_data(
+            "valid_auth_code", flow["state"], "http://localhost:3001/callback"
+        )
+        self.assertTrue(MyInfoService.verify_state(flow["state"]))
+        result = MyInfoService.retrieve_person_data(
+            "valid_auth_code", flow["state"], "http://localhost:3001/callback"
+        )
+
+        self.assertEqual(failed, ({"error": "Myinfo is unavailable, try again later"}, False))
+        self.assertEqual(result, ({"uinfin": "S1234567D"}, True))
+        first, second = (c.kwargs["session_ephemeral_keypair"] for c in mock_retrieve_resource.call_args_list)
+        self.assertEqual(first.thumbprint(), second.thumbprint())
+
+    @patch("myinfo.client.MyInfoPersonalClientV4.retrieve_resource")
+    def test_full_person_bulkhead_ends_the_flow(self, mock_retrieve_resource, _):
+        mock_retrieve_resource.side_effect = BulkheadFullError("person")
+        flow = MyInfoService.initiate_myinfo_flow("http://localhost:3001/callback")
+
+        result = MyInfoService.retrieve_person_data(
+            "valid_auth_code", flow["state"], "http://localhost:3001/callback"
+        )
+        replayed = MyInfoService.retrieve_person_data(
+            "valid_auth_code", flow["state"], "http://localhost:3001/callback"
+        )
+
+        self.assertEqual(result, ({"error": "Myinfo is unavailable, start the login again"}, False))
+        self.assertEqual(replayed, result)
+        self.assertEqual(mock_retrieve_resource.call_count, 1)
+        self.assertFalse(MyInfoService.verify_state(flow["state"]))
+
+    @patch("myinfo.client.MyInfoPersonalClientV4.retrieve_resource")
+    def test_retrieve_person_data_with_scope_profile(self, mock_retrieve_resource, _):
+        mock_retrieve_resource.return_value = {"uinfin": "S1234567D"}
+        flow = MyInfoService.initiate_myinfo_flow(
+            "http://localhost:3001/callback", scope_profile="identity"
+        )
+
+        MyInfoService.retrieve_person_data(
+            "valid_auth_code", flow["state"], "http://localhost:3001/callback"
+        )
+
+        self.assertIn("scope=uinfin%20name", flow["authorize_url"])
+        self.assertNotIn("cpfcontributions", flow["authorize_url"])
+        self.assertEqual(mock_retrieve_resource.call_args.kwargs["scope_profile"], "identity")
+
+    def test_unknown_scope_profile(self, _):
+        with self.assertRaises(ValueError):
+            MyInfoService.initiate_myinfo_flow(scope_profile="everything")
+
+
+class AdmissionControllerTest(SimpleTestCase):
+
+    def test_get_queue_wait(self):
+        now = time.time()
+
+        self.assertAlmostEqual(get_queue_wait({"HTTP_X_REQUEST_START": f"t={now - 2}"}), 2, 1)
+        self.assertAlmostEqual(
+            get_queue_wait({"HTTP_X_REQUEST_START": str(int((now - 2) * 1000))}), 2, 1
+        )
+        self.assertAlmostEqual(
+            get_queue_wait({"HTTP_X_REQUEST_START": f"t={int((now - 2) * 1e6)}"}), 2, 1
+        )
+        self.assertIsNone(get_queue_wait({}))
+        self.assertIsNone(get_queue_wait({"HTTP_X_REQUEST_START": "garbage"}))
+
+    def test_in_flight_limit(self):
+        admission_controller = AdmissionController(max_in_flight=2, max_queue_wait=0)
+
+        self.assertTrue(admission_controller.admit({}))
+        self.assertTrue(admission_controller.admit({}))
+        self.assertFalse(admission_controller.admit({}))
+        admission_controller.release()
+        self.assertTrue(admission_controller.admit({}))
+
+
+class MyinfoUsersConfigTest(SimpleTestCase):
+
+    @patch("myinfo.warmup.warm_up")
+    def test_warm_up(self, mock_warm_up):
+        app_config = apps.get_app_config("myinfo_users")
+
+        app_config.ready()
+        mock_warm_up.assert_not_called()
+
+        with patch.object(myinfo_settings, "MYINFO_WARMUP", "true"):
+            app_config.ready()
+        mock_warm_up.assert_called_once_with(process=True)
+
+        with patch.object(myinfo_settings, "MYINFO_WARMUP", "preload"):
+            app_config.ready()
+        mock_warm_up.assert_called_with(process=False)
+
+    @patch("myinfo.warmup.warm_up", side_effect=ValueError("MYINFO_PRIVATE_KEY_SIG must be..."))
+    def test_warm_up_fails_loudly(self, mock_warm_up):
+        with patch.object(myinfo_settings, "MYINFO_WARMUP", "true"):
+            with self.assertRaises(ImproperlyConfigured):
+                apps.get_app_config("myinfo_users").ready()
+
+    def test_scope_profile_names_are_checked(self):
+        profiles = {"x" * 256: "uinfin"}
+
+        with patch.object(myinfo_settings, "MYINFO_SCOPE_PROFILES", profiles):
+            with self.assertRaises(ImproperlyConfigured):
+                apps.get_app_config("myinfo_users").ready()
+
+
+class IdempotentCallbacksTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_duplicates_wait_for_the_first_call(self):
+        callbacks = IdempotentCallbacks()
+        started = threading.Event()
+        calls = []
+
+        def retrieve():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            return {"uinfin": "S1234567D"}, True
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            first = executor.submit(callbacks.run, "code", "state", retrieve)
+            started.wait(5)
+            duplicates = [
+                executor.submit(callbacks.run, "code", "state", retrieve) for _ in range(2)
+            ]
+            results = [first.result()] + [duplicate.result() for duplicate in duplicates]
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [({"uinfin": "S1234567D"}, True)] * 3)
+
+    def test_async_duplicates_wait_for_the_first_call(self):
+        callbacks = IdempotentCallbacks()
+        calls = []
+
+        async def retrieve():
+            calls.append(1)
+            await asyncio.sleep(0.2)
+            return {"uinfin": "S1234567D"}, True
+
+        async def main():
+            return await asyncio.gather(
+                *(callbacks.arun("code", "state", retrieve) for _ in range(3))
+            )
+
+        with patch("myinfo_users.idempotency.sync_to_async", wraps=sync_to_async) as mock:
+            results = asyncio.run(main())
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [({"uinfin": "S1234567D"}, True)] * 3)
+        # cache I/O stays off the single thread of thread-sensitive code
+        self.assertTrue(all(not call.kwargs["thread_sensitive"] for call in mock.call_args_list))
+
+    def test_result_is_encrypted_at_rest(self):
+        callbacks = IdempotentCallbacks()
+        callbacks.run("code", "state", lambda: ({"uinfin": "S1234567D"}, True))
+
+        data = cache.get(f"myinfo:idempotency:{get_idempotency_key('code')}")
+
+        self.assertNotIn(b"S1234567D", data)
+        self.assertNotIn("code", get_idempotency_key("code"))
+
+    def test_wait_timeout(self):
+        callbacks = IdempotentCallbacks(wait_timeout=0)
+        cache.add(f"myinfo:idempotency:{get_idempotency_key('code')}:lock", 1)
+
+        result = callbacks.run("code", "state", lambda: ({}, True))
+
+        self.assertEqual(result, ({"error": "Callback already in progress"}, False))
+
+    def test_wait_is_capped_at_the_callback_budget(self):
+        with patch.object(myinfo_settings, "MYINFO_CALLBACK_BUDGET", 0.1):
+            callbacks = IdempotentCallbacks(wait_timeout=30)
+        cache.add(f"myinfo:idempotency:{get_idempotency_key('code')}:lock", 1)
+
+        started_at = time.monotonic()
+        result = callbacks.run("code", "state", lambda: ({}, True))
+
+        self.assertEqual(result, ({"error": "Callback already in progress"}, False))
+        self.assertLess(time.monotonic() - started_at, 1)
@@ -1,8 +1,15 @@
 from django.urls import path
 
-from myinfo_users.views import MyInfoAuthView, MyInfoCallbackView
+from myinfo_users.views import (
+    AsyncMyInfoAuthView,
+    AsyncMyInfoCallbackView,
+    MyInfoAuthView,
+    MyInfoCallbackView,
+)
 
 urlpatterns = [
     path('auth', MyInfoAuthView.as_view(), name='myinfo-auth'),
     path('callback', MyInfoCallbackView.as_view(), name='myinfo-callback'),
+    path('async/auth', AsyncMyInfoAuthView.as_view(), name='myinfo-auth-async'),
+    path('async/callback', AsyncMyInfoCallbackView.as_view(), name='myinfo-callback-async'),
 ]
\ No newline at end of file
@@ -1,31 +1,170 @@
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django.views import View
+from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.exceptions import ValidationError
-from django.utils.crypto import get_random_string
-from myinfo.client import MyInfoPersonalClientV4
+from myinfo import metrics
+from myinfo_users.admission import OVERLOADED_ERROR, get_admission_controller
+from myinfo_users.flow_state import FLOW_STATE_TTL
+from myinfo_users.idempotency import IN_PROGRESS_ERROR
+from myinfo_users.services import (
+    DEADLINE_EXCEEDED_ERROR,
+    INVALID_STATE_ERROR,
+    RESTART_FLOW_ERROR,
+    UPSTREAM_UNAVAILABLE_ERROR,
+    MyInfoService,
+)
 
-state = get_random_string(length=16)
+STATE_COOKIE = "myinfo_state"
+STATE_COOKIE_SALT = "myinfo_users.state"
+
+
+def set_state_cookie(response, state: str) -> None:
+    """
+    Keeps the OAuth state of the flow on the browser, so that the callback can be served by any
+    worker: the flow itself lives in the shared flow state store.
+    """
+    response.set_signed_cookie(
+        STATE_COOKIE,
+        state,
+        salt=STATE_COOKIE_SALT,
+        max_age=FLOW_STATE_TTL,
+        httponly=True,
+        samesite="Lax",
+    )
+
+
+def get_state(request):
+    """
+    Returns the OAuth state from the `state` query parameter, or else from the state cookie.
+    """
+    return request.GET.get("state") or request.get_signed_cookie(
+        STATE_COOKIE, default=None, salt=STATE_COOKIE_SALT
+    )
+
+
+def get_error_status(result: dict) -> int:
+    if result.get("error") == INVALID_STATE_ERROR:
+        return status.HTTP_400_BAD_REQUEST
+    if result.get("error") == IN_PROGRESS_ERROR:
+        return status.HTTP_409_CONFLICT
+    if result.get("error") == DEADLINE_EXCEEDED_ERROR:
+        return status.HTTP_504_GATEWAY_TIMEOUT
+    if result.get("error") in (UPSTREAM_UNAVAILABLE_ERROR, RESTART_FLOW_ERROR):
+        return status.HTTP_503_SERVICE_UNAVAILABLE
+    return status.HTTP_502_BAD_GATEWAY
+
+
+def get_retry_after_headers() -> dict:
+    return {"Retry-After": str(get_admission_controller().retry_after)}
 
 
 class MyInfoAuthView(APIView):
 
     def get(self, request):
-        callback_url = "http://localhost:3001/callback"
-        client = MyInfoPersonalClientV4()
-        auth_url = client.get_authorise_url(oauth_state=state, callback_url=callback_url)
-        return Response(auth_url)
+        try:
+            flow = MyInfoService.initiate_myinfo_flow(
+                settings.MYINFO_CALLBACK_URL, request.query_params.get("scope_profile")
+            )
+        except ValueError as e:
+            raise ValidationError(str(e))
+        response = Response(flow["authorize_url"])
+        set_state_cookie(response, flow["state"])
+        return response
 
 
 class MyInfoCallbackView(APIView):
 
     def get(self, request):
         auth_code = request.query_params.get("code")
-        callback_url = "http://localhost:3001/callback"
+        oauth_state = get_state(request)
 
         if not auth_code:
             raise ValidationError("Missing 'code' parameter.")
+        if not oauth_state:
+            raise ValidationError("Missing 'state' parameter.")
+
+        # shed load before holding a worker on upstream calls that would time out anyway
+        admission_controller = get_admission_controller()
+        if not admission_controller.admit(request.META):
+            return Response(
+                {"error": OVERLOADED_ERROR},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers=get_retry_after_headers(),
+            )
+        try:
+            result, success = MyInfoService.retrieve_person_data(
+                auth_code, oauth_state, settings.MYINFO_CALLBACK_URL
+            )
+        finally:
+            admission_controller.release()
+        if not success:
+            return Response(result, status=get_error_status(result))
+
+        response = Response(result)
+        response.delete_cookie(STATE_COOKIE, samesite="Lax")
+        return response
+
 
-        client = MyInfoPersonalClientV4()
-        person_data = client.retrieve_resource(auth_code, state, callback_url)
+class AsyncMyInfoAuthView(View):
+    """
+    Async counterpart of MyInfoAuthView, for ASGI deployments (see core.asgi).
+    """
 
-        return Response(person_data)
+    async def get(self, request):
+        try:
+            flow = await MyInfoService.ainitiate_myinfo_flow(
+                settings.MYINFO_ASYNC_CALLBACK_URL, request.GET.get("scope_profile")
+            )
+        except ValueError as e:
+            return JsonResponse([str(e)], safe=False, status=400)
+        response = JsonResponse(flow["authorize_url"], safe=False)
+        set_state_cookie(response, flow["state"])
+        return response
+
+
+class AsyncMyInfoCallbackView(View):
+    """
+    Async counterpart of MyInfoCallbackView. Upstream calls don't hold a worker thread, so one
+    ASGI worker can serve many logins concurrently.
+    """
+
+    async def get(self, request):
+        auth_code = request.GET.get("code")
+        oauth_state = get_state(request)
+
+        if not auth_code:
+            return JsonResponse(["Missing 'code' parameter."], safe=False, status=400)
+        if not oauth_state:
+            return JsonResponse(["Missing 'state' parameter."], safe=False, status=400)
+
+        admission_controller = get_admission_controller()
+        if not admission_controller.admit(request.META):
+            return JsonResponse(
+                {"error": OVERLOADED_ERROR}, status=503, headers=get_retry_after_headers()
+            )
+        try:
+            result, success = await MyInfoService.aretrieve_person_data(
+                auth_code, oauth_state, settings.MYINFO_ASYNC_CALLBACK_URL
+            )
+        finally:
+            admission_controller.release()
+        if not success:
+            return JsonResponse(result, status=get_error_status(result))
+
+        response = JsonResponse(result)
+        response.delete_cookie(STATE_COOKIE, samesite="Lax")
+        return response
+
+
+class MyInfoMetricsView(View):
+    """
+    Metrics of the Myinfo flow for this process, in the Prometheus text format.
+    """
+
+    def get(self, request):
+        return HttpResponse(
+            metrics.registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+        )